@@ -1,4 +1,5 @@
 from uuid import UUID
+from typing import Union
 
 import random
 from common.misc_schemas import QueryData
@@ -6,7 +7,13 @@ from common.misc_schemas import QueryData
 from common.file_schemas import ConversationInformation, DocumentStatus
 
 import logging
-from daemon_state import STARTUP_DAEMON_STATE, DaemonState, validateAllValuesDefined
+from daemon_state import (
+    STARTUP_DAEMON_STATE,
+    DaemonState,
+    fillUndefinedValues,
+    stageConcurrencyLimit,
+    validateAllValuesDefined,
+)
 from logic.insert_file_logic import (
     add_url_raw,
     upsert_full_file_to_db,
@@ -14,42 +21,77 @@ from logic.insert_file_logic import (
 
 from logic.file_validation import validate_and_rectify_file_extension
 from logic.process_file_logic import process_file_raw
+from logic.retry_policy import classify_failure, retry_backoff_seconds, should_retry
+from util.file_io import get_s3_file_manager, run_in_s3_executor
 
 import asyncio
-import redis
 from util.redis_utils import (
-    increment_doc_counter,
-    task_pop_from_queue,
+    DaemonStateCache,
+    default_redis_client,
+    hash_registry_record,
+    migrate_legacy_queue_entries,
+    prune_task_index,
+    publish_daemon_state,
+    semaphore_acquire_many,
+    semaphore_in_flight_count,
+    semaphore_release,
+    semaphore_renew,
+    reap_expired_task_leases,
+    requeue_due_retries,
+    publish_task_event,
+    s3_known_hashes_claim_warm,
+    s3_known_hashes_release_warm,
+    task_advance_stage,
+    task_dedup_release,
+    task_lease_ack,
+    task_lease_renew,
+    task_lease_return,
+    task_pop_batch_from_queue,
+    task_pop_batch_from_queue_blocking,
     task_push_to_queue,
+    task_schedule_retry,
+    task_trace_save,
     task_upsert,
+    wait_for_queue_doorbell,
 )
 import traceback
 
 from constants import (
-    REDIS_HOST,
+    DOCPROC_QUEUE_LEASE_SECONDS,
+    DOCPROC_QUEUE_REAPER_INTERVAL_SECONDS,
+    DOCPROC_RETRY_POLL_SECONDS,
+    DOCPROC_SEMAPHORE_LEASE_SECONDS,
     REDIS_MAIN_PROCESS_LOOP_CONFIG,
-    REDIS_PORT,
-    REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS,
+    S3_KNOWN_HASHES_WARM_POLL_SECONDS,
 )
 
 from pydantic import BaseModel
+from common.task_trace import start_task_trace, trace_span
 from common.task_schema import (
     CompleteFileSchema,
     DatabaseInteraction,
     ScraperInfo,
     Task,
+    TaskEventType,
+    TaskStage,
     TaskType,
     create_task,
+    task_stage,
 )
 
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+redis_client = default_redis_client
 default_logger = logging.getLogger(__name__)
+daemon_state_cache = DaemonStateCache(redis_client=redis_client)
 
 
 async def initialize_process_loop_configuration():
     try:
-        config_str = redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
+        config_str = await redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
         config = DaemonState.model_validate_json(config_str)
+        if not validateAllValuesDefined(config):
+            # Keep the existing settings when new config fields have been added since it was saved.
+            config = fillUndefinedValues(config)
+            await publish_daemon_state(config, redis_client=redis_client)
         valid_config = validateAllValuesDefined(config)
         if not valid_config:
             raise Exception(
@@ -59,14 +101,11 @@ async def initialize_process_loop_configuration():
         default_logger.error(
             f"Could not get redis config, setting to default values: {e}"
         )
-        redis_client.set(
-            REDIS_MAIN_PROCESS_LOOP_CONFIG,
-            DaemonState.model_dump_json(STARTUP_DAEMON_STATE),
-        )
+        await publish_daemon_state(STARTUP_DAEMON_STATE, redis_client=redis_client)
 
 
 async def main_processing_loop() -> None:
-    redis_client.set(REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS, 0)
+    # The in flight count lives in the cluster semaphore now, dont reset anything here since other workers are still holding slots.
     await asyncio.sleep(
         5
     )  # Wait 10 seconds until application has finished loading to do anything
@@ -76,19 +115,18 @@ async def main_processing_loop() -> None:
     # FML Forgetting to uncomment this line cost around 8 hours of work.
     # clear_file_queue(redis_client=redis_client)
     default_logger.info("Starting the daemon processes docs in the queue.")
+    await asyncio.gather(*[stage_processing_loop(stage) for stage in TaskStage])
+
 
+async def stage_processing_loop(stage: TaskStage) -> None:
+    # One of these per stage, each only pulls from its own queue and only counts against its own limit.
     async def activity():
         try:
-            concurrent_docs = int(
-                redis_client.get(REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS)
-            )
-            # FIXME: CACHE FOR MORE EFFICIENCY, AND MAYBE ONLY GET 1/10 of the time
-            main_processing_loop_config_str = redis_client.get(
-                REDIS_MAIN_PROCESS_LOOP_CONFIG
-            )
-            main_processing_loop_config = DaemonState.model_validate_json(
-                main_processing_loop_config_str
+            concurrent_docs = await semaphore_in_flight_count(
+                stage=stage, redis_client=redis_client
             )
+            # Kept up to date over pub/sub, this only hits redis when the cache is past its refresh interval.
+            main_processing_loop_config = await daemon_state_cache.get()
         except Exception as e:
             default_logger.error(
                 f"Could not get number of currently processing docs from redis, stopping document processing out of an abundance of caution: {e}"
@@ -102,39 +140,113 @@ async def main_processing_loop() -> None:
             await asyncio.sleep(2)
             return None
         # TODO: Have better error handling for this, but this also should never fire.
-        assert main_processing_loop_config.maximum_concurrent_cluster_tasks is not None
-        if (
-            concurrent_docs
-            >= main_processing_loop_config.maximum_concurrent_cluster_tasks
-        ):
+        stage_limit = stageConcurrencyLimit(main_processing_loop_config, stage)
+        assert stage_limit is not None
+        free_slots = stage_limit - concurrent_docs
+        if free_slots <= 0:
             if random.randint(1, 10) == 1:
-                default_logger.info("At Capacity, Not adding any more documents.")
+                default_logger.info(
+                    f"{stage.value} stage at capacity, Not adding any more documents."
+                )
             await asyncio.sleep(2)
             return None
+        assert main_processing_loop_config.dequeue_block_timeout_seconds is not None
+        assert main_processing_loop_config.reliable_queue is not None
+        assert main_processing_loop_config.priority_aging_seconds is not None
+        block_timeout = main_processing_loop_config.dequeue_block_timeout_seconds
+        reliable = main_processing_loop_config.reliable_queue
+        weights = main_processing_loop_config.priority_level_weights
+        aging_seconds = main_processing_loop_config.priority_aging_seconds
         try:
-            pull_obj = task_pop_from_queue(redis_client=redis_client)
+            if not reliable and block_timeout > 0:
+                pulled_tasks = await task_pop_batch_from_queue_blocking(
+                    block_timeout,
+                    free_slots,
+                    stage=stage,
+                    weights=weights,
+                    aging_seconds=aging_seconds,
+                    redis_client=redis_client,
+                )
+            else:
+                pulled_tasks = await task_pop_batch_from_queue(
+                    free_slots,
+                    stage=stage,
+                    reliable=reliable,
+                    weights=weights,
+                    aging_seconds=aging_seconds,
+                    redis_client=redis_client,
+                )
         except Exception as e:
             default_logger.error(f"Redis Error getting task from queue {e}")
             await asyncio.sleep(2)
             return None
 
-        if pull_obj is None:
+        if len(pulled_tasks) == 0:
             if random.randint(1, 50) == 1:
                 default_logger.info("found no documents")
-            await asyncio.sleep(2)
+            if reliable and block_timeout > 0:
+                # The leasing pop cant block, wait for the next push to ring the doorbell instead.
+                try:
+                    await wait_for_queue_doorbell(
+                        block_timeout, stage=stage, redis_client=redis_client
+                    )
+                except Exception as e:
+                    default_logger.error(f"Redis Error waiting for queue doorbell {e}")
+                    await asyncio.sleep(2)
+            # The blocking pop already waited for the timeout, so only sleep when polling.
+            elif block_timeout <= 0:
+                await asyncio.sleep(2)
+            return None
+        # The fetch lists predate the stages and still hold process tasks, send those on to the stage they belong to.
+        misplaced_tasks = [task for task in pulled_tasks if task_stage(task) != stage]
+        for task in misplaced_tasks:
+            await task_advance_stage(task, task_stage(task), redis_client=redis_client)
+        pulled_tasks = [task for task in pulled_tasks if task_stage(task) == stage]
+        if len(pulled_tasks) == 0:
             return None
         try:
-            asyncio.create_task(
-                execute_task(task=pull_obj, config=main_processing_loop_config)
+            # Other workers can take slots between the capacity check and the pop, anything that didnt get one is handed back.
+            granted = set(
+                await semaphore_acquire_many(
+                    [str(task.id) for task in pulled_tasks],
+                    stage_limit,
+                    stage=stage,
+                    redis_client=redis_client,
+                )
             )
-            # Give some time for the process to update the ratelimit in redis, if this is causing a throughput issue it should be okay to bring it down to .01 seconds or 10 miliseconds
-            await asyncio.sleep(0.1)
-
         except Exception as e:
-            default_logger.error(
-                f"Encountered error while creating an async task object: {e}"
-            )
+            default_logger.error(f"Redis Error acquiring processing slots {e}")
+            granted = set()
+        for task in pulled_tasks:
+            if str(task.id) in granted:
+                continue
+            if not await task_lease_return(task.id, redis_client=redis_client):
+                task.stage = stage
+                await task_push_to_queue(
+                    task, redis_client=redis_client, push_to_front=True
+                )
+        for task in pulled_tasks:
+            if str(task.id) not in granted:
+                continue
+            try:
+                asyncio.create_task(
+                    execute_task(
+                        task=task, config=main_processing_loop_config, stage=stage
+                    )
+                )
+            except Exception as e:
+                await semaphore_release(
+                    str(task.id), stage=stage, redis_client=redis_client
+                )
+                await task_lease_return(task.id, redis_client=redis_client)
+                default_logger.error(
+                    f"Encountered error while creating an async task object: {e}"
+                )
+        if len(granted) < len(pulled_tasks):
             await asyncio.sleep(2)
+        else:
+            # The slots are taken before the tasks are scheduled, so the next pop can go right away, just let the new tasks start first.
+            await asyncio.sleep(0)
         return None
 
     # Logic to force it to process each loop sequentially
@@ -146,40 +258,162 @@ async def main_processing_loop() -> None:
             result = None
 
 
+async def lease_reaper_loop() -> None:
+    # Every worker runs this, the reap is a single lua script so they cant double requeue a task.
+    try:
+        await migrate_legacy_queue_entries(redis_client=redis_client)
+    except Exception as e:
+        default_logger.error(f"Redis Error migrating queued task payloads {e}")
+    while True:
+        await asyncio.sleep(DOCPROC_QUEUE_REAPER_INTERVAL_SECONDS)
+        try:
+            reaped = await reap_expired_task_leases(redis_client=redis_client)
+            if reaped > 0:
+                default_logger.info(
+                    f"Requeued {reaped} tasks whose worker stopped renewing their lease"
+                )
+        except Exception as e:
+            default_logger.error(f"Redis Error reaping expired task leases {e}")
+        try:
+            await prune_task_index(redis_client=redis_client)
+        except Exception as e:
+            default_logger.error(f"Redis Error pruning the task index {e}")
+
+
+async def retry_scheduler_loop() -> None:
+    while True:
+        await asyncio.sleep(DOCPROC_RETRY_POLL_SECONDS)
+        try:
+            requeued = await requeue_due_retries(redis_client=redis_client)
+            if requeued > 0:
+                default_logger.info(f"Requeued {requeued} tasks after their retry backoff")
+        except Exception as e:
+            default_logger.error(f"Redis Error requeueing scheduled retries {e}")
+
+
+async def s3_known_hashes_warm_loop() -> None:
+    # Polls for the claim, whichever worker gets it relists the bucket and the rest keep going off the shared index.
+    while True:
+        claimed = False
+        try:
+            claimed = await s3_known_hashes_claim_warm(redis_client=redis_client)
+            if claimed:
+                file_manager = get_s3_file_manager()
+                count = await run_in_s3_executor(file_manager.warm_known_hashes_s3)
+                default_logger.info(f"Warmed the known S3 hash index with {count} hashes")
+        except Exception as e:
+            default_logger.error(f"Error warming the known S3 hash index {e}")
+            if claimed:
+                # Let the next poll on any worker try again instead of waiting out the whole period.
+                try:
+                    await s3_known_hashes_release_warm(redis_client=redis_client)
+                except Exception:
+                    pass
+        await asyncio.sleep(S3_KNOWN_HASHES_WARM_POLL_SECONDS)
+
+
 def initialize_background_loops() -> None:
+    asyncio.create_task(daemon_state_cache.listen())
     asyncio.create_task(main_processing_loop())
+    asyncio.create_task(lease_reaper_loop())
+    asyncio.create_task(retry_scheduler_loop())
+    asyncio.create_task(s3_known_hashes_warm_loop())
+
+
+async def renew_task_leases(task_id: UUID, stage: TaskStage) -> None:
+    # Keeps the semaphore slot and the reliable queue lease alive while the task runs, cancelled once the task finishes.
+    holder = str(task_id)
+    while True:
+        await asyncio.sleep(
+            min(DOCPROC_SEMAPHORE_LEASE_SECONDS, DOCPROC_QUEUE_LEASE_SECONDS) / 3
+        )
+        try:
+            if not await semaphore_renew(
+                holder, stage=stage, redis_client=redis_client
+            ):
+                default_logger.error(
+                    f"Processing slot lease for {holder} expired before it could be renewed"
+                )
+            await task_lease_renew(task_id, redis_client=redis_client)
+        except Exception as e:
+            default_logger.error(f"Redis Error renewing task leases {e}")
 
 
-async def execute_task(task: Task, config: DaemonState) -> None:
+async def execute_task(task: Task, config: DaemonState, stage: TaskStage) -> None:
     assert config.insert_process_task_after_ingest is not None
     assert config.insert_process_to_front_of_queue is not None
     assert config.disable_ingest_if_hash_identified is not None
-    increment_doc_counter(1, redis_client=redis_client)
+    # The slot was acquired by the main loop before this task was scheduled.
+    holder = str(task.id)
+    lease_renewal = asyncio.create_task(renew_task_leases(task.id, stage))
+    finished = False
     logger = default_logger
+    # Everything traced while this stage runs lands here, saved once the stage is done.
+    trace = start_task_trace(task.id, stage)
     # logger.info(f"Executing task of type {task.task_type.value}: {task.id}")
     try:
-        match task.task_type:
-            case TaskType.add_file_scraper:
-                task.obj = ScraperInfo.model_validate(task.obj)
-                await process_add_file_scraper(
-                    task=task,
-                    insert_processing_task=config.insert_process_task_after_ingest,
-                    add_process_task_to_front=config.insert_process_to_front_of_queue,
-                    disable_ingest_if_hash=config.disable_ingest_if_hash_identified,
-                )
-            case TaskType.process_existing_file:
-                task.obj = CompleteFileSchema.model_validate(task.obj)
-                await process_existing_file(task)
+        try:
+            await publish_task_event(
+                task.id,
+                TaskEventType.stage_started,
+                stage=stage,
+                redis_client=redis_client,
+            )
+        except Exception as e:
+            logger.error(f"Redis Error publishing task event {e}")
+        with trace_span("stage"):
+            match task.task_type:
+                case TaskType.add_file_scraper:
+                    task.obj = ScraperInfo.model_validate(task.obj)
+                    await process_add_file_scraper(
+                        task=task,
+                        insert_processing_task=config.insert_process_task_after_ingest,
+                        add_process_task_to_front=config.insert_process_to_front_of_queue,
+                        disable_ingest_if_hash=config.disable_ingest_if_hash_identified,
+                    )
+                case TaskType.process_existing_file:
+                    task.obj = CompleteFileSchema.model_validate(task.obj)
+                    await process_existing_file(task, stage)
+        finished = True
     except Exception:
+        finished = True
         logger.error(
             "Somehow an exception made it to the top task excecution level, this shouldnt happen, exception handling should be done inside each task function."
         )
     finally:
-        increment_doc_counter(-1, redis_client=redis_client)
+        lease_renewal.cancel()
+        # A cancelled task (worker shutdown or reload) goes straight back on its queue instead of waiting on the reaper.
+        # Once a task has moved on its lease belongs to the next stage, so leave it alone.
+        if task_stage(task) == stage:
+            if finished:
+                await task_lease_ack(task.id, redis_client=redis_client)
+                # A task waiting on a retry still holds its file.
+                if task.retry_at is None:
+                    await task_dedup_release(task.id, redis_client=redis_client)
+            else:
+                await task_lease_return(task.id, redis_client=redis_client)
+        await semaphore_release(holder, stage=stage, redis_client=redis_client)
+        try:
+            await task_trace_save(trace, redis_client=redis_client)
+        except Exception as e:
+            logger.error(f"Redis Error saving task trace {e}")
 
     # logger.info(f"Finished executing task of type {task.task_type.value}: {task.id}")
 
 
+async def schedule_retry_if_transient(task: Task, error: Union[Exception, str]) -> bool:
+    # Returns True if the task went into the retry schedule, otherwise the caller records the failure like before.
+    task.failure_class = classify_failure(error)
+    task.attempts += 1
+    if not should_retry(task.failure_class, task.attempts):
+        return False
+    task.error = str(error)
+    await task_schedule_retry(
+        task, retry_backoff_seconds(task.attempts), redis_client=redis_client
+    )
+    return True
+
+
 def evolve_db_interact(
     interact: DatabaseInteraction, next_task_type: TaskType
 ) -> DatabaseInteraction:
@@ -255,7 +489,7 @@ async def process_add_file_scraper(
             return_task.obj = result_file
             return_task.completed = True
             return_task.success = True
-            task_upsert(return_task)
+            await task_upsert(return_task)
             return None
 
         if task.database_interact == DatabaseInteraction.insert:
@@ -263,9 +497,10 @@ async def process_add_file_scraper(
             # assert (
             #     False
             # ), "At this point with updates not working inserts shouldnt happen at the beginning of file processing."
-            result_file = await upsert_full_file_to_db(
-                result_file, interact=task.database_interact
-            )
+            with trace_span("kessler_upsert"):
+                result_file = await upsert_full_file_to_db(
+                    result_file, interact=task.database_interact
+                )
             assert isinstance(result_file.id, UUID)
             assert result_file.id != UUID(
                 "00000000-0000-0000-0000-000000000000"
@@ -275,11 +510,14 @@ async def process_add_file_scraper(
         return_task = task
         logger.error(e)
         logger.error(tb)
+        if await schedule_retry_if_transient(task, e):
+            return None
         logger.error("Encountered error while adding file: {e}")
         return_task.error = str(e)
+        return_task.error_traceback = tb
         return_task.completed = True
         return_task.success = False
-        task_upsert(return_task)
+        await task_upsert(return_task)
     else:
         return_task = task
         return_task.obj = result_file
@@ -298,32 +536,77 @@ async def process_add_file_scraper(
             assert (
                 new_task is not None
             ), "ASSERTION ERROR: Encountered logic error relating to an empty task, create task on those inputs should never make an empty task."
+            # If the file is already being processed the followup is the task doing that.
+            new_task = await task_push_to_queue(
+                new_task, push_to_front=add_process_task_to_front
+            )
             return_task.followup_task_id = new_task.id
             return_task.followup_task_url = new_task.url
-            task_push_to_queue(new_task, push_to_front=add_process_task_to_front)
-        task_upsert(return_task)
+            await publish_task_event(
+                return_task.id,
+                TaskEventType.followup_created,
+                stage=TaskStage.fetch,
+                detail=str(new_task.id),
+                redis_client=redis_client,
+            )
+        await task_upsert(return_task)
 
 
-async def process_existing_file(task: Task) -> None:
+async def process_existing_file(task: Task, stage: TaskStage) -> None:
     obj = task.obj
     assert isinstance(obj, CompleteFileSchema)
     logger = default_logger
 
-    if obj.stage.skip_processing:
+    # Files flagged during extract still go through persist to record why.
+    if obj.stage.skip_processing and stage != TaskStage.persist:
         logger.info(f"Skipping file tag is true, skipping file: {obj.id}")
+        # Still finish the task, otherwise its record never expires and it shows as running forever.
+        task.completed = True
+        task.success = True
+        await task_upsert(task)
         return None
     try:
-        error, result_file = await process_file_raw(
-            obj, stop_at=DocumentStatus.completed, priority=task.priority
-        )
+        next_stage = None
+        result_file = obj
+        match stage:
+            case TaskStage.extract:
+                # Validation, OCR and translation, the work that runs on the marker cluster.
+                error, result_file = await process_file_raw(
+                    obj, stop_at=DocumentStatus.stage3, priority=task.priority
+                )
+                next_stage = TaskStage.enrich
+            case TaskStage.enrich:
+                # LLM extras and embeddings, picks up at stage 3 where extract left the file.
+                error, result_file = await process_file_raw(
+                    obj, stop_at=DocumentStatus.completed, priority=task.priority
+                )
+                next_stage = TaskStage.persist
+            case TaskStage.persist:
+                error = None
+            case _:
+                raise Exception(f"Process tasks dont run in the {stage.value} stage")
+        # Errored files skip straight to persist so the error still makes it into the db, unless its worth another try.
+        if error is not None:
+            task.obj = result_file
+            if await schedule_retry_if_transient(task, error):
+                return None
+            task.error = str(error)
+            task.error_traceback = "".join(traceback.format_exception(error))
+            task.failed_stage = stage
+            next_stage = TaskStage.persist
+        if next_stage is not None:
+            task.obj = result_file
+            await task_advance_stage(task, next_stage, redis_client=redis_client)
+            return None
 
         if (
             task.database_interact == DatabaseInteraction.insert
             or task.database_interact == DatabaseInteraction.update
         ):
-            result_file = await upsert_full_file_to_db(
-                result_file, interact=task.database_interact
-            )
+            with trace_span("kessler_upsert"):
+                result_file = await upsert_full_file_to_db(
+                    result_file, interact=task.database_interact
+                )
             assert isinstance(result_file.id, UUID)
             assert result_file.id != UUID(
                 "00000000-0000-0000-0000-000000000000"
@@ -333,15 +616,24 @@ async def process_existing_file(task: Task) -> None:
         return_task = task
         logger.error(e)
         logger.error(tb)
+        if await schedule_retry_if_transient(task, e):
+            return None
         logger.error(f"encountered error while adding file: {e}")
         return_task.error = f"encountered error while adding file: {e}, \n {tb}"
         task.completed = True
         return_task.success = False
         return_task.error = str(e)
-        task_upsert(return_task)
+        return_task.error_traceback = tb
+        await task_upsert(return_task)
     else:
         return_task = task
         return_task.obj = result_file
         task.completed = True
-        return_task.success = True
-        task_upsert(return_task)
+        # Errored files only came through persist to get their error into the db, the task still failed.
+        return_task.success = not result_file.stage.is_errored
+        if return_task.success and not result_file.stage.skip_processing:
+            try:
+                await hash_registry_record(result_file, redis_client=redis_client)
+            except Exception as e:
+                logger.error(f"Redis Error recording {result_file.hash} in the hash registry {e}")
+        await task_upsert(return_task)
@@ -0,0 +1,95 @@
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Optional
+import asyncio
+import logging
+import shutil
+
+from constants import (
+    DOWNLOAD_DISK_BUDGET_BYTES,
+    DOWNLOAD_DISK_MIN_FREE_BYTES,
+    OS_TMPDIR,
+)
+
+default_logger = logging.getLogger(__name__)
+
+
+class DiskReservation:
+    def __init__(self, budget: "DiskBudget", nbytes: int) -> None:
+        self.budget = budget
+        self.nbytes = nbytes
+
+    def grow(self, nbytes: int) -> None:
+        # Never waits, a download that turns out bigger than guessed is already half on disk, so it gets finished and new admissions wait instead.
+        if nbytes > self.nbytes:
+            self.budget.in_flight_bytes += nbytes - self.nbytes
+            self.nbytes = nbytes
+
+
+# Tracks bytes being downloaded by this process and holds new downloads back once the budget or the disk is full.
+class DiskBudget:
+    def __init__(
+        self,
+        budget_bytes: int,
+        min_free_bytes: int,
+        logger: Optional[logging.Logger] = None,
+    ) -> None:
+        if logger is None:
+            logger = default_logger
+        self.budget_bytes = budget_bytes
+        self.min_free_bytes = min_free_bytes
+        self.in_flight_bytes = 0
+        self.in_flight_count = 0
+        self.logger = logger
+        self.condition = asyncio.Condition()
+
+    def fits(self, nbytes: int, directory: Path) -> bool:
+        # Always let one download through, otherwise a file bigger than the whole budget could never be fetched.
+        if self.in_flight_count == 0:
+            return True
+        if self.in_flight_bytes + nbytes > self.budget_bytes:
+            return False
+        try:
+            free_bytes = shutil.disk_usage(directory).free
+        except OSError:
+            return True
+        return free_bytes - nbytes >= self.min_free_bytes
+
+    @asynccontextmanager
+    async def reserve(
+        self, nbytes: int, directory: Optional[Path] = None
+    ) -> AsyncIterator[DiskReservation]:
+        if directory is None:
+            directory = OS_TMPDIR
+        async with self.condition:
+            if not self.fits(nbytes, directory):
+                self.logger.info(
+                    f"Waiting for disk budget, {self.in_flight_bytes} bytes across {self.in_flight_count} downloads in flight"
+                )
+                await self.condition.wait_for(lambda: self.fits(nbytes, directory))
+            self.in_flight_bytes += nbytes
+            self.in_flight_count += 1
+        reservation = DiskReservation(self, nbytes)
+        try:
+            yield reservation
+        finally:
+            async with self.condition:
+                self.in_flight_bytes -= reservation.nbytes
+                self.in_flight_count -= 1
+                self.condition.notify_all()
+
+
+_download_disk_budget: Optional[DiskBudget] = None
+_download_disk_budget_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_download_disk_budget() -> DiskBudget:
+    # Shared by every download in the process, remade if the event loop changed like the http session.
+    global _download_disk_budget, _download_disk_budget_loop
+    loop = asyncio.get_running_loop()
+    if _download_disk_budget is None or _download_disk_budget_loop is not loop:
+        _download_disk_budget = DiskBudget(
+            DOWNLOAD_DISK_BUDGET_BYTES, DOWNLOAD_DISK_MIN_FREE_BYTES
+        )
+        _download_disk_budget_loop = loop
+    return _download_disk_budget
@@ -10,6 +10,7 @@ from typing import Any, Dict, List
 
 
 from enum import Enum
+from datetime import datetime
 
 from common.org_schemas import OrganizationSchema, IndividualSchema
 
@@ -71,6 +72,28 @@ class FileGeneratedExtras(BaseModel):
     impressiveness: float = 0.0
 
 
+# Whatever a document had produced by the last stage it finished, so a retry can pick up from there.
+# The texts live in s3, only their keys are kept here.
+class DocProcCheckpoint(BaseModel):
+    hash: str
+    lang: str
+    docproc_stage: DocumentStatus
+    extension: str = ""
+    original_text_key: str = ""
+    english_text_key: str = ""
+    # Extras depend on the document metadata as well as the text, so they are only reused for the same document.
+    source_id: UUID = UUID("00000000-0000-0000-0000-000000000000")
+    extra: Optional[FileGeneratedExtras] = None
+
+
+# Content that made it all the way through processing and into the db, keyed by hash so a re-filed copy of the same bytes can be skipped.
+class HashRegistryEntry(BaseModel):
+    hash: str
+    file_id: UUID
+    extension: str = ""
+    processed_at: datetime
+
+
 class AuthorInformation(BaseModel):
     author_id: UUID = UUID("00000000-0000-0000-0000-000000000000")
     author_name: str
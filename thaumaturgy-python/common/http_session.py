@@ -0,0 +1,45 @@
+import asyncio
+from typing import Optional
+
+import aiohttp
+
+from constants import (
+    DOWNLOAD_CONNECT_TIMEOUT_SECONDS,
+    DOWNLOAD_READ_TIMEOUT_SECONDS,
+    DOWNLOAD_TIMEOUT_SECONDS,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+)
+
+_shared_session: Optional[aiohttp.ClientSession] = None
+_shared_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_shared_http_session() -> aiohttp.ClientSession:
+    # One session per process so downloads reuse pooled connections, remade if it was closed or belongs to an old event loop.
+    global _shared_session, _shared_session_loop
+    loop = asyncio.get_running_loop()
+    if (
+        _shared_session is None
+        or _shared_session.closed
+        or _shared_session_loop is not loop
+    ):
+        _shared_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=HTTP_MAX_CONNECTIONS, limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=DOWNLOAD_TIMEOUT_SECONDS,
+                connect=DOWNLOAD_CONNECT_TIMEOUT_SECONDS,
+                sock_read=DOWNLOAD_READ_TIMEOUT_SECONDS,
+            ),
+        )
+        _shared_session_loop = loop
+    return _shared_session
+
+
+async def close_shared_http_session() -> None:
+    global _shared_session
+    if _shared_session is not None and not _shared_session.closed:
+        await _shared_session.close()
+    _shared_session = None
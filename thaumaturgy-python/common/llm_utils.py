@@ -11,6 +11,7 @@ from enum import Enum
 from typing import Optional, List, Union, Any, Dict
 
 import asyncio
+import random
 
 
 import logging
@@ -200,7 +201,8 @@ class KeLLMUtils:
         self.request_tries = (
             1 + slow_retry * 2
         )  # Only try once if slow_retry is false, else try 3 times
-        self.retry_timeout_seconds = 60
+        # Kept short since the caller is holding a processing slot, longer outages go through the task retry schedule instead.
+        self.retry_timeout_seconds = 2
 
     async def achat(self, chat_history: Any) -> Any:
         logger = default_logger
@@ -214,7 +216,9 @@ class KeLLMUtils:
                 logger.info(f"Encountered error during llm response {e}")
                 if i == self.request_tries - 1:
                     raise e
-                await asyncio.sleep(self.retry_timeout_seconds)
+                await asyncio.sleep(
+                    self.retry_timeout_seconds * 2**i * random.uniform(0.5, 1.5)
+                )
             else:
                 break
         if response is None:
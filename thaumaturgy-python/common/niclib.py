@@ -2,7 +2,6 @@ import base64
 import secrets
 import os
 import glob
-import requests
 import hashlib
 import itertools
 import math
@@ -13,16 +12,27 @@ from datetime import datetime, timezone
 
 from pathlib import Path
 
-from typing import Union, Optional, Any, Tuple
+from typing import Union, Optional, Any, Tuple, BinaryIO
 from typing import Callable
 
 import logging
 
 import asyncio
+import aiohttp
 
 import tokenizers
 import math
 
+from common.disk_budget import get_download_disk_budget
+from common.http_session import get_shared_http_session
+from constants import (
+    DOWNLOAD_CHUNK_SIZE_BYTES,
+    DOWNLOAD_CONNECT_TIMEOUT_SECONDS,
+    DOWNLOAD_DISK_DEFAULT_RESERVATION_BYTES,
+    DOWNLOAD_MAX_BYTES,
+    DOWNLOAD_READ_TIMEOUT_SECONDS,
+)
+
 default_logger = logging.getLogger(__name__)
 
 
@@ -134,18 +144,89 @@ def secs_since_1970() -> int:
     return int(datetime.now(timezone.utc).timestamp())
 
 
-async def download_file(url: str, savedir: Path) -> Path:
+class DownloadTooLargeError(Exception):
+    pass
+
+
+async def stream_url_to_file(
+    url: str,
+    file: BinaryIO,
+    chunk_size: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    timeout_seconds: Optional[float] = None,
+    hash_object: Optional[Any] = None,
+    directory: Optional[Path] = None,
+) -> int:
+    # Streams the body into file on the shared session, returns the number of bytes written.
+    # A hashlib object passed as hash_object is fed the same bytes, so the file never has to be read back to hash it.
+    if chunk_size is None:
+        chunk_size = DOWNLOAD_CHUNK_SIZE_BYTES
+    if max_bytes is None:
+        max_bytes = DOWNLOAD_MAX_BYTES
+    request_kwargs = {}
+    if timeout_seconds is not None:
+        request_kwargs["timeout"] = aiohttp.ClientTimeout(
+            total=timeout_seconds,
+            connect=DOWNLOAD_CONNECT_TIMEOUT_SECONDS,
+            sock_read=DOWNLOAD_READ_TIMEOUT_SECONDS,
+        )
+    session = get_shared_http_session()
+    written = 0
+    # Admitted before connecting so a waiting download doesnt sit on an open socket, directory is only used to check free space.
+    async with get_download_disk_budget().reserve(
+        min(DOWNLOAD_DISK_DEFAULT_RESERVATION_BYTES, max_bytes), directory
+    ) as reservation:
+        async with session.get(url, **request_kwargs) as response:
+            response.raise_for_status()
+            if response.content_length is not None:
+                if response.content_length > max_bytes:
+                    raise DownloadTooLargeError(
+                        f"{url} is {response.content_length} bytes, which exceeds the maximum download size of {max_bytes} bytes"
+                    )
+                reservation.grow(response.content_length)
+            # The socket hands back whatever has arrived, buffer it so the disk sees a few large writes.
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(chunk_size):
+                written += len(chunk)
+                if written > max_bytes:
+                    raise DownloadTooLargeError(
+                        f"{url} exceeds the maximum download size of {max_bytes} bytes"
+                    )
+                reservation.grow(written)
+                buffer += chunk
+                if hash_object is not None:
+                    hash_object.update(chunk)
+                if len(buffer) >= chunk_size:
+                    file.write(buffer)
+                    buffer.clear()
+            if len(buffer) > 0:
+                file.write(buffer)
+    return written
+
+
+async def download_file(
+    url: str,
+    savedir: Path,
+    chunk_size: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    timeout_seconds: Optional[float] = None,
+) -> Path:
     # TODO: Use a temporary directory for downloads or archive it in some other way.
     local_filename = savedir
-    # NOTE the stream=True parameter below
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
+    try:
         with open(local_filename, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                # If you have chunk encoded response uncomment if
-                # and set chunk_size parameter to None.
-                # if chunk:
-                f.write(chunk)
+            await stream_url_to_file(
+                url,
+                f,
+                chunk_size=chunk_size,
+                max_bytes=max_bytes,
+                timeout_seconds=timeout_seconds,
+                directory=local_filename.parent,
+            )
+    except BaseException:
+        # Dont leave a truncated file behind for something else to pick up.
+        local_filename.unlink(missing_ok=True)
+        raise
     return local_filename
 
 
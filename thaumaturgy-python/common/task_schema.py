@@ -2,6 +2,7 @@
 
 
 from pydantic import BaseModel
+import re
 import uuid
 from typing import List, Optional, Any
 from datetime import datetime
@@ -17,6 +18,40 @@ class TaskType(str, Enum):
     add_nypuc_conversation_docket = "add_nypuc_conversation_docket"
 
 
+# Pipeline stages a document moves through, every stage has its own queue and concurrency limit.
+class TaskStage(str, Enum):
+    fetch = "fetch"
+    extract = "extract"
+    enrich = "enrich"
+    persist = "persist"
+
+
+class FailureClass(str, Enum):
+    # Worth trying again later, rate limits, timeouts, a service being down.
+    transient = "transient"
+    # Will fail the same way every time, bad files, validation errors, programming errors.
+    permanent = "permanent"
+
+
+class TaskEventType(str, Enum):
+    queued = "queued"
+    stage_started = "stage_started"
+    stage_finished = "stage_finished"
+    retry_scheduled = "retry_scheduled"
+    followup_created = "followup_created"
+    completed = "completed"
+    failed = "failed"
+
+
+# Where a task is in its life, kept in the task index rather than on the task record.
+class TaskStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    retrying = "retrying"
+    completed = "completed"
+    failed = "failed"
+
+
 class DatabaseInteraction(str, Enum):
     none = "none"
     insert_later = "insert_later"
@@ -31,6 +66,8 @@ class Task(BaseModel):
     id: uuid.UUID = uuid.uuid4()
     url: str = f"https://thaum.kessler.xyz/v1/status/"
     priority: bool = True
+    # Overrides priority when set, 0 is the highest level.
+    priority_level: Optional[int] = None
     database_interact: DatabaseInteraction
     task_type: TaskType
     table_name: str = ""
@@ -42,9 +79,152 @@ class Task(BaseModel):
     success: bool = False
     followup_task_id: Optional[uuid.UUID] = None
     followup_task_url: Optional[str] = None
+    # None until the task has been moved past the first stage for its type.
+    stage: Optional[TaskStage] = None
+    attempts: int = 0
+    failure_class: Optional[FailureClass] = None
+    # Set while the task is waiting in the retry schedule.
+    retry_at: Optional[datetime] = None
+    # Where and how the task failed, the error can be recorded a stage later than it happened.
+    failed_stage: Optional[TaskStage] = None
+    error_traceback: str = ""
     obj: Any
 
 
+class TaskEvent(BaseModel):
+    # Stream entry id, pass the last one seen back in to only get newer events.
+    id: str = ""
+    task_id: uuid.UUID
+    event: TaskEventType
+    stage: Optional[TaskStage] = None
+    detail: str = ""
+    at: datetime
+
+
+# What the task listing returns, the task without its payload.
+class TaskSummary(BaseModel):
+    id: uuid.UUID
+    url: str
+    task_type: TaskType
+    status: TaskStatus
+    stage: TaskStage
+    priority: bool
+    priority_level: Optional[int] = None
+    attempts: int = 0
+    error: str = ""
+    created_at: datetime
+    updated_at: datetime
+    retry_at: Optional[datetime] = None
+    followup_task_id: Optional[uuid.UUID] = None
+
+
+# Failed tasks are kept here until they are requeued, the task itself is stored separately since it carries the whole file.
+class DeadLetter(BaseModel):
+    task_id: uuid.UUID
+    task_type: TaskType
+    stage: TaskStage
+    failure_class: Optional[FailureClass] = None
+    error: str = ""
+    # Failures with the same cause share this, see dead_letter_error_group.
+    error_group: str = ""
+    traceback: str = ""
+    attempts: int = 0
+    failed_at: datetime
+
+
+class DeadLetterFilter(BaseModel):
+    error_group: Optional[str] = None
+    error_contains: Optional[str] = None
+    stage: Optional[TaskStage] = None
+    failure_class: Optional[FailureClass] = None
+    task_type: Optional[TaskType] = None
+    failed_after: Optional[datetime] = None
+    failed_before: Optional[datetime] = None
+
+
+def dead_letter_error_group(error: str) -> str:
+    # First line of the error with ids, urls and numbers blanked out, so the same failure on different files groups together.
+    lines = error.strip().splitlines()
+    group = lines[0] if len(lines) > 0 else ""
+    group = re.sub(
+        r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}",
+        "<id>",
+        group,
+    )
+    group = re.sub(r"https?://\S+", "<url>", group)
+    group = re.sub(r"\b[0-9a-fA-F]{32,}\b", "<hash>", group)
+    group = re.sub(r"\d+", "<n>", group)
+    return group[:200]
+
+
+def naive_local_datetime(value: datetime) -> datetime:
+    # Task timestamps are naive local time, bring timezone aware filter values in line before comparing.
+    if value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+
+def dead_letter_matches(entry: DeadLetter, filter: DeadLetterFilter) -> bool:
+    if filter.error_group is not None and entry.error_group != filter.error_group:
+        return False
+    if (
+        filter.error_contains is not None
+        and filter.error_contains.lower() not in entry.error.lower()
+    ):
+        return False
+    if filter.stage is not None and entry.stage != filter.stage:
+        return False
+    if filter.failure_class is not None and entry.failure_class != filter.failure_class:
+        return False
+    if filter.task_type is not None and entry.task_type != filter.task_type:
+        return False
+    failed_at = naive_local_datetime(entry.failed_at)
+    if filter.failed_after is not None and failed_at < naive_local_datetime(
+        filter.failed_after
+    ):
+        return False
+    if filter.failed_before is not None and failed_at > naive_local_datetime(
+        filter.failed_before
+    ):
+        return False
+    return True
+
+
+def task_stage(task: Task) -> TaskStage:
+    if task.stage is not None:
+        return task.stage
+    if task.task_type == TaskType.process_existing_file:
+        return TaskStage.extract
+    return TaskStage.fetch
+
+
+def task_status(task: Task) -> TaskStatus:
+    # Running isnt on the record, only the index knows a task was popped.
+    if task.completed:
+        return TaskStatus.completed if task.success else TaskStatus.failed
+    if task.retry_at is not None:
+        return TaskStatus.retrying
+    return TaskStatus.queued
+
+
+def task_summary(task: Task, status: Optional[TaskStatus] = None) -> TaskSummary:
+    return TaskSummary(
+        id=task.id,
+        url=task.url,
+        task_type=task.task_type,
+        status=status if status is not None else task_status(task),
+        stage=task_stage(task),
+        priority=task.priority,
+        priority_level=task.priority_level,
+        attempts=task.attempts,
+        error=task.error,
+        created_at=task.created_at,
+        updated_at=task.updated_at,
+        retry_at=task.retry_at,
+        followup_task_id=task.followup_task_id,
+    )
+
+
 def task_validate_object(task: Task, panic_if_invalid: bool = False) -> Task:
     convert_type = None
     if task.task_type == TaskType.add_file_scraper and not isinstance(
@@ -0,0 +1,101 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Iterator, List, Optional
+import time
+import uuid
+
+from pydantic import BaseModel
+
+from common.task_schema import TaskStage
+
+
+class TraceSpan(BaseModel):
+    name: str
+    stage: Optional[TaskStage] = None
+    started_at: datetime
+    # Monotonic offsets from the start of the stage run the span belongs to, only comparable within one run.
+    start_seconds: float
+    end_seconds: float
+    duration_seconds: float
+    error: str = ""
+
+
+class TimingPercentiles(BaseModel):
+    count: int
+    mean_seconds: float
+    p50_seconds: float
+    p90_seconds: float
+    p99_seconds: float
+    max_seconds: float
+
+
+# Collects the spans of one stage run of a task, execute_task saves them once the stage is done.
+class TaskTrace:
+    def __init__(self, task_id: uuid.UUID, stage: TaskStage) -> None:
+        self.task_id = task_id
+        self.stage = stage
+        self.started_monotonic = time.monotonic()
+        self.spans: List[TraceSpan] = []
+
+
+# Set per asyncio task, asyncio.to_thread copies it so spans inside threads end up on the same trace.
+current_task_trace: ContextVar[Optional[TaskTrace]] = ContextVar(
+    "current_task_trace", default=None
+)
+
+
+def start_task_trace(task_id: uuid.UUID, stage: TaskStage) -> TaskTrace:
+    trace = TaskTrace(task_id, stage)
+    current_task_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def trace_span(name: str) -> Iterator[None]:
+    # Does nothing outside of a task, so the traced functions can still be called on their own.
+    trace = current_task_trace.get()
+    if trace is None:
+        yield
+        return
+    started_at = datetime.now()
+    start = time.monotonic()
+    error = ""
+    try:
+        yield
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"[:500]
+        raise
+    finally:
+        end = time.monotonic()
+        trace.spans.append(
+            TraceSpan(
+                name=name,
+                stage=trace.stage,
+                started_at=started_at,
+                start_seconds=start - trace.started_monotonic,
+                end_seconds=end - trace.started_monotonic,
+                duration_seconds=end - start,
+                error=error,
+            )
+        )
+
+
+def timing_percentiles(durations: List[float]) -> Optional[TimingPercentiles]:
+    if len(durations) == 0:
+        return None
+    durations = sorted(durations)
+
+    def percentile(fraction: float) -> float:
+        # Nearest rank, plenty for a few hundred samples.
+        index = min(len(durations) - 1, max(0, int(round(fraction * len(durations))) - 1))
+        return durations[index]
+
+    return TimingPercentiles(
+        count=len(durations),
+        mean_seconds=sum(durations) / len(durations),
+        p50_seconds=percentile(0.5),
+        p90_seconds=percentile(0.9),
+        p99_seconds=percentile(0.99),
+        max_seconds=durations[-1],
+    )
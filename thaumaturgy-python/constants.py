@@ -42,20 +42,150 @@ S3_FILE_BUCKET = "kesslerproddocs"
 
 S3_ACCESS_KEY = os.environ["S3_ACCESS_KEY"]
 S3_SECRET_KEY = os.environ["S3_SECRET_KEY"]
+# S3 calls run on their own thread pool so big transfers dont starve asyncio.to_thread for everything else.
+S3_THREAD_POOL_WORKERS = int(os.getenv("S3_THREAD_POOL_WORKERS", 32))
+# Files above the threshold go up and down as multipart transfers, with this many parts in flight per file.
+S3_MULTIPART_THRESHOLD_BYTES = int(
+    os.getenv("S3_MULTIPART_THRESHOLD_BYTES", 16 * 1024 * 1024)
+)
+S3_MULTIPART_CHUNK_SIZE_BYTES = int(
+    os.getenv("S3_MULTIPART_CHUNK_SIZE_BYTES", 16 * 1024 * 1024)
+)
+S3_MULTIPART_MAX_CONCURRENCY = int(os.getenv("S3_MULTIPART_MAX_CONCURRENCY", 8))
+# Shared by every S3 call in the process, sized so each pool worker can have all of its parts in flight at once.
+# Botocore defaults to 10, nowhere near enough for parallel parts across concurrent transfers.
+S3_MAX_POOL_CONNECTIONS = int(
+    os.getenv(
+        "S3_MAX_POOL_CONNECTIONS",
+        S3_THREAD_POOL_WORKERS * S3_MULTIPART_MAX_CONCURRENCY,
+    )
+)
+
+# Downloads share one aiohttp session per process. Total is the whole transfer, read is the longest stall between chunks.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", 16))
+DOWNLOAD_CHUNK_SIZE_BYTES = int(os.getenv("DOWNLOAD_CHUNK_SIZE_BYTES", 1024 * 1024))
+DOWNLOAD_MAX_BYTES = int(os.getenv("DOWNLOAD_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", 30 * 60))
+DOWNLOAD_CONNECT_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_CONNECT_TIMEOUT_SECONDS", 30))
+DOWNLOAD_READ_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_READ_TIMEOUT_SECONDS", 120))
+# Partial downloads older than this were left by a worker that died mid download, no live download runs that long.
+DOWNLOAD_PARTIAL_MAX_AGE_SECONDS = float(
+    os.getenv("DOWNLOAD_PARTIAL_MAX_AGE_SECONDS", 2 * DOWNLOAD_TIMEOUT_SECONDS)
+)
+# Disk admission for downloads, the budget caps bytes in flight per worker and the floor keeps the disk from filling up.
+DOWNLOAD_DISK_BUDGET_BYTES = int(
+    os.getenv("DOWNLOAD_DISK_BUDGET_BYTES", 8 * 1024 * 1024 * 1024)
+)
+DOWNLOAD_DISK_MIN_FREE_BYTES = int(
+    os.getenv("DOWNLOAD_DISK_MIN_FREE_BYTES", 1024 * 1024 * 1024)
+)
+# Reserved up front when the size isnt known yet, the reservation grows once headers or bytes say otherwise.
+DOWNLOAD_DISK_DEFAULT_RESERVATION_BYTES = int(
+    os.getenv("DOWNLOAD_DISK_DEFAULT_RESERVATION_BYTES", 64 * 1024 * 1024)
+)
 
 REDIS_HOST = os.getenv("REDIS_HOST", "valkey")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Size of the per process asyncio connection pool, blocking pops and the pub/sub listener each hold one while they wait.
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
 
 
 REDIS_DOCPROC_PRIORITYQUEUE_KEY = "docproc_queue_priority"
 REDIS_DOCPROC_QUEUE_KEY = "docproc_queue_background"
+# Every stage queue is split into this many levels, 0 is served most often. The top and bottom
+# levels are the priority and background lists above.
+DOCPROC_PRIORITY_LEVELS = 3
+# When each queued id was pushed onto its current level, used to age waiting tasks upwards.
+REDIS_DOCPROC_QUEUE_ENQUEUED_AT = "docproc_queue_enqueued_at"
+# Weighted round robin state of the scheduler, one hash per stage.
+REDIS_DOCPROC_QUEUE_SCHEDULER = "docproc_queue_scheduler"
 
 REDIS_DOCPROC_INFORMATION = "docproc_information"
 
 REDIS_MAIN_PROCESS_LOOP_ENABLED = "main_process_daemon_enabled"
 REDIS_MAIN_PROCESS_LOOP_CONFIG = "main_process_loop_config"
+# set-daemon-state publishes the new config here so every worker picks it up without polling.
+REDIS_MAIN_PROCESS_LOOP_CONFIG_CHANNEL = "main_process_loop_config_updates"
+# Safety net for missed pub/sub messages, the cached config is re-read at least this often.
+DAEMON_STATE_REFRESH_SECONDS = 60
 REDIS_DOCPROC_BACKGROUND_PROCESSING_STOPS_AT = "docproc_background_stop_at"
 REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS = "docproc_currently_processing_docs"
+# Sorted set of task ids holding a cluster processing slot, scored by lease expiry.
+REDIS_DOCPROC_CLUSTER_SEMAPHORE = "docproc_cluster_semaphore"
+# Slots not renewed within this many seconds are handed back, so crashed workers dont leak capacity.
+DOCPROC_SEMAPHORE_LEASE_SECONDS = 300
+# Reliable queue bookkeeping, tasks popped in reliable mode stay here until they are acked.
+REDIS_DOCPROC_PROCESSING_LEASES = "docproc_processing_leases"
+REDIS_DOCPROC_PROCESSING_PAYLOADS = "docproc_processing_payloads"
+REDIS_DOCPROC_PROCESSING_ORIGINS = "docproc_processing_origins"
+# Pushes ring this list so workers waiting in reliable mode wake up without polling.
+REDIS_DOCPROC_QUEUE_DOORBELL = "docproc_queue_doorbell"
+REDIS_DOCPROC_QUEUE_MIGRATION_LOCK = "docproc_queue_migration_lock"
+DOCPROC_QUEUE_LEASE_SECONDS = 300
+# Failed tasks waiting out their backoff, scored by when they are due back on their queue.
+REDIS_DOCPROC_RETRY_SCHEDULE = "docproc_retry_schedule"
+REDIS_DOCPROC_RETRY_DRAIN_LOCK = "docproc_retry_drain_lock"
+DOCPROC_RETRY_POLL_SECONDS = 5
+# Transient failures are retried this many times, with the backoff doubling from the base up to the cap.
+DOCPROC_RETRY_MAX_ATTEMPTS = 5
+DOCPROC_RETRY_BASE_SECONDS = 30
+DOCPROC_RETRY_MAX_SECONDS = 60 * 60
+# Task lifecycle events, every event goes on the firehose stream and on a short stream per task.
+REDIS_DOCPROC_TASK_EVENTS = "docproc_task_events"
+DOCPROC_TASK_EVENTS_MAXLEN = 100000
+DOCPROC_TASK_EVENTS_PER_TASK_MAXLEN = 100
+DOCPROC_TASK_EVENTS_TTL_SECONDS = 60 * 60 * 24
+# Upper bound on how long a long poll holds one of the event connections.
+DOCPROC_TASK_EVENTS_MAX_BLOCK_SECONDS = 30
+# Long polls and streams waiting at once per worker, each holds a connection from the event pool
+# for its whole wait. Past this they get a 503 instead of queueing for a connection.
+DOCPROC_TASK_EVENTS_MAX_WAITERS = int(os.getenv("DOCPROC_TASK_EVENTS_MAX_WAITERS", 200))
+# Dedup index, maps file urls and hashes to the queued or running task holding them.
+REDIS_DOCPROC_DEDUP_INDEX = "docproc_dedup_index"
+# The index entries every holder claimed, so they can be released once the task is done.
+REDIS_DOCPROC_DEDUP_CLAIMS = "docproc_dedup_claims"
+# A claim whose task record hasnt been written yet is honoured this long before it counts as abandoned.
+DOCPROC_DEDUP_CLAIM_GRACE_SECONDS = 60
+# Idempotency keys map to the task ids the first request got back, kept after the tasks finish so a
+# retried request still gets the same tasks.
+REDIS_DOCPROC_IDEMPOTENCY_PREFIX = "docproc_idempotency"
+DOCPROC_IDEMPOTENCY_RETENTION_SECONDS = 60 * 60 * 24
+DOCPROC_QUEUE_REAPER_INTERVAL_SECONDS = 30
+# Secondary indexes over the task records, sorted sets per status and per task type scored by updated_at,
+# plus a hash of every indexed tasks current status.
+REDIS_DOCPROC_TASK_INDEX_PREFIX = "docproc_task_index"
+REDIS_DOCPROC_TASK_INDEX_STATUS = "docproc_task_index_status"
+DOCPROC_TASK_INDEX_SCAN_BATCH = 200
+# Per task timing spans, plus a rolling window of recent durations per stage and span for the percentiles.
+REDIS_DOCPROC_TASK_TRACE_PREFIX = "docproc_task_trace"
+DOCPROC_TASK_TRACE_TTL_SECONDS = 60 * 60 * 24
+DOCPROC_TASK_TRACE_MAX_SPANS = 500
+REDIS_DOCPROC_TIMING_SAMPLES_PREFIX = "docproc_timing_samples"
+REDIS_DOCPROC_TIMING_SAMPLE_KEYS = "docproc_timing_sample_keys"
+DOCPROC_TIMING_SAMPLES_PER_SPAN = 1000
+# Dead letters never expire, they stay until someone requeues them. Summaries and index are small, the tasks carry the file.
+REDIS_DOCPROC_DEAD_LETTERS = "docproc_dead_letters"
+REDIS_DOCPROC_DEAD_LETTER_TASKS = "docproc_dead_letter_tasks"
+REDIS_DOCPROC_DEAD_LETTER_INDEX = "docproc_dead_letter_index"
+REDIS_DOCPROC_DEAD_LETTER_REPLAY_PREFIX = "docproc_dead_letter_replay"
+DOCPROC_DEAD_LETTER_REPLAY_TTL_SECONDS = 60 * 60 * 24
+DOCPROC_DEAD_LETTER_SCAN_BATCH = 500
+# Requeues per second when replaying dead letters, so a big replay doesnt bury everything else on the queues.
+DOCPROC_DEAD_LETTER_REPLAY_RATE_PER_SECOND = 20
+DOCPROC_DEAD_LETTER_REPLAY_MAX_RATE_PER_SECOND = 500
+# Per document stage checkpoints, kept for a while so reprocessing a file later can skip the marker run.
+REDIS_DOCPROC_CHECKPOINT_PREFIX = "docproc_checkpoint"
+DOCPROC_CHECKPOINT_TTL_SECONDS = 60 * 60 * 24 * 30
+S3_CHECKPOINT_DIRECTORY = "checkpoints/"
+# Hash of every fully processed file to the id it was stored under, never expires since the files dont either.
+REDIS_DOCPROC_HASH_REGISTRY = "docproc_hash_registry"
+# Hashes known to be in the raw/ directory on S3, shared by every worker so existence checks skip the network.
+REDIS_S3_KNOWN_HASHES = "s3_known_raw_hashes"
+REDIS_S3_KNOWN_HASHES_WARM_CLAIM = "s3_known_raw_hashes_warm_claim"
+# One worker relists the bucket this often, to pick up anything uploaded outside of thaumaturgy.
+S3_KNOWN_HASHES_REWARM_SECONDS = 60 * 60 * 24
+S3_KNOWN_HASHES_WARM_POLL_SECONDS = 60 * 10
 
 
 # Congrats for finding the portal easter egg!
@@ -1,32 +1,87 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
+import logging
+
+from common.task_schema import TaskStage
+
+default_logger = logging.getLogger(__name__)
 
 
 class DaemonState(BaseModel):
     enabled: Optional[bool] = None
     insert_process_task_after_ingest: Optional[bool] = None
     insert_process_to_front_of_queue: Optional[bool] = None
+    # Per stage caps across the whole cluster, each stage is bottlenecked on something different
+    # (downloads and s3, the marker gpus, the llm provider rate limits, the kessler db).
+    maximum_concurrent_fetch_tasks: Optional[int] = None
+    maximum_concurrent_extract_tasks: Optional[int] = None
+    maximum_concurrent_enrich_tasks: Optional[int] = None
+    maximum_concurrent_persist_tasks: Optional[int] = None
+    # Deprecated, the old single cap over every stage. Still accepted from saved configs and
+    # set-daemon-state, where it seeds whichever per stage caps arent set and is then dropped.
     maximum_concurrent_cluster_tasks: Optional[int] = None
     disable_ingest_if_hash_identified: Optional[bool] = None
+    # Seconds a worker waits on its stage doorbell (a BLPOP) when the scheduler script finds nothing
+    # to pop, 0 skips the doorbell and sleeps between pops instead.
+    dequeue_block_timeout_seconds: Optional[float] = None
+    # Keep popped tasks leased until they finish so crashed workers dont lose them.
+    reliable_queue: Optional[bool] = None
+    # Share of pops each priority level gets while it has work, highest priority first.
+    priority_level_weights: Optional[List[int]] = None
+    # Tasks waiting this long on a level get moved up one, 0 turns aging off.
+    priority_aging_seconds: Optional[float] = None
 
 
 STARTUP_DAEMON_STATE = DaemonState(
     enabled=False,
     insert_process_task_after_ingest=True,
     insert_process_to_front_of_queue=False,
-    maximum_concurrent_cluster_tasks=60,
+    maximum_concurrent_fetch_tasks=30,
+    maximum_concurrent_extract_tasks=60,
+    maximum_concurrent_enrich_tasks=20,
+    maximum_concurrent_persist_tasks=30,
     disable_ingest_if_hash_identified=False,
+    dequeue_block_timeout_seconds=2.0,
+    reliable_queue=True,
+    priority_level_weights=[8, 3, 1],
+    priority_aging_seconds=900,
 )
 
 
+def stageConcurrencyLimit(existing_state: DaemonState, stage: TaskStage) -> Optional[int]:
+    return getattr(existing_state, f"maximum_concurrent_{stage.value}_tasks")
+
+
+DEPRECATED_DAEMON_STATE_FIELDS = ["maximum_concurrent_cluster_tasks"]
+
+
 def validateAllValuesDefined(existing_state: DaemonState) -> bool:
     # all function is a folding AND operation over a list of bools.
+    # Deprecated fields count as undefined values the other way round, they should have been migrated away.
     return all(
-        getattr(existing_state, field_name) is not None
+        (getattr(existing_state, field_name) is None)
+        == (field_name in DEPRECATED_DAEMON_STATE_FIELDS)
         for field_name in existing_state.model_fields.keys()
     )
 
 
+def migrateDeprecatedValues(state: DaemonState) -> DaemonState:
+    # The old cluster wide cap becomes the cap of every stage that doesnt have one of its own.
+    # Each stage gets the whole value, so the cluster as a whole can run more than it used to.
+    cluster_limit = state.maximum_concurrent_cluster_tasks
+    if cluster_limit is None:
+        return state
+    default_logger.warning(
+        f"maximum_concurrent_cluster_tasks is deprecated, using {cluster_limit} for every stage without its own maximum_concurrent_<stage>_tasks"
+    )
+    for stage in TaskStage:
+        field_name = f"maximum_concurrent_{stage.value}_tasks"
+        if getattr(state, field_name) is None:
+            setattr(state, field_name, cluster_limit)
+    state.maximum_concurrent_cluster_tasks = None
+    return state
+
+
 def updateExistingState(
     existing_state: DaemonState, new_state: DaemonState
 ) -> DaemonState:
@@ -35,3 +90,11 @@ def updateExistingState(
         if new_value is not None:
             setattr(existing_state, field_name, new_value)
     return existing_state
+
+
+def fillUndefinedValues(
+    existing_state: DaemonState, default_state: DaemonState = STARTUP_DAEMON_STATE
+) -> DaemonState:
+    # Fields added after a config was persisted come back as None, take the defaults for those instead of resetting the whole config.
+    existing_state = migrateDeprecatedValues(existing_state)
+    return updateExistingState(default_state.model_copy(), existing_state)
@@ -20,7 +20,7 @@ from util.gpu_compute_calls import (
     translate_text_api,
 )
 
-from util.file_io import S3FileManager
+from util.file_io import get_s3_file_manager
 
 import yaml
 
@@ -33,7 +33,7 @@ class MarkdownExtractor:
         self.tmpdir = tmpdir
         self.logger = logger
         self.priority = priority
-        self.s3_client = S3FileManager(logger=self.logger)
+        self.s3_client = get_s3_file_manager()
         # TODO : Add database connection.
 
     async def convert_text_into_eng(self, file_text: str, lang: str):
@@ -68,11 +68,11 @@ class MarkdownExtractor:
             return output_str
 
         if extension == "pdf":
-            s3_uri = self.s3_client.generate_s3_uri_from_hash(hash)
+            s3_uri = await self.s3_client.generate_s3_uri_from_hash_async(hash)
             if s3_uri is None:
                 raise Exception("File Not Found")
             return await process_pdf(s3_uri)
-        file_loc = self.s3_client.generate_local_filepath_from_hash(hash)
+        file_loc = await self.s3_client.generate_local_filepath_from_hash_async(hash)
         if file_loc is None:
             raise Exception("File Not Found")
 
@@ -2,7 +2,7 @@ import logging
 from pathlib import Path
 from typing import Tuple, Optional
 from common.misc_schemas import KnownFileExtension
-from util.file_io import S3FileManager
+from util.file_io import get_s3_file_manager
 import magic
 import chardet
 import PyPDF2
@@ -35,7 +35,7 @@ async def validate_file_hash_vs_extension(
     filehash: str, extension: KnownFileExtension
 ) -> Tuple[bool, str]:
     logger = default_logger
-    s3_client = S3FileManager()
+    s3_client = get_s3_file_manager()
     result_filepath = await s3_client.generate_local_filepath_from_hash_async(
         filehash, ensure_network=False, download_local=True
     )
@@ -5,9 +5,9 @@ from common.file_schemas import (
     CompleteFileSchema,
     getListAuthors,
 )
-from common.niclib import download_file
 from common.task_schema import DatabaseInteraction, Task
 from common.llm_utils import KeLLMUtils, ModelName
+from common.task_trace import trace_span
 import os
 from pathlib import Path
 
@@ -21,7 +21,9 @@ from typing import List, Optional
 # from routing.file_controller import QueryData
 
 import json
-from util.file_io import S3FileManager
+from urllib.parse import urlparse
+from util.file_io import SaveFilepathToHashResult, get_s3_file_manager
+from util.redis_utils import hash_registry_get
 
 # import base64
 
@@ -106,13 +108,15 @@ async def add_url_raw(
     file_obj: CompleteFileSchema,
     disable_ingest_if_hash: bool = False,
 ) -> Tuple[Optional[str], CompleteFileSchema]:
-    download_dir = OS_TMPDIR / Path("downloads")
-    result_path = await download_file(file_url, download_dir)
+    file_manager = get_s3_file_manager()
+    # Straight into the hash directory, hashed on the way in, so there is nothing to re-read or copy afterwards.
+    with trace_span("download"):
+        result = await file_manager.download_url_to_hash(file_url, OS_HASH_FILEDIR)
     doctype = file_obj.extension
     if doctype is None or doctype == "":
-        file_obj.extension = result_path.suffix.lstrip(".")
-    return await add_file_raw(
-        tmp_filepath=result_path,
+        file_obj.extension = Path(urlparse(file_url).path).suffix.lstrip(".")
+    return await add_file_metadata_raw(
+        result=result,
         file_obj=file_obj,
         disable_ingest_if_hash=disable_ingest_if_hash,
     )
@@ -162,7 +166,28 @@ async def add_file_raw(
     disable_ingest_if_hash: bool = False,
 ) -> Tuple[Optional[str], CompleteFileSchema]:
     logger = default_logger
-    file_manager = S3FileManager(logger=logger)
+    file_manager = get_s3_file_manager()
+    logger.info("Attempting to save data to file")
+    try:
+        result = await file_manager.save_filepath_to_hash_async(
+            tmp_filepath, OS_HASH_FILEDIR
+        )
+    finally:
+        # The hashed copy is all thats needed from here on, even a failed save shouldnt leave the temp file behind.
+        tmp_filepath.unlink(missing_ok=True)
+    return await add_file_metadata_raw(
+        result=result,
+        file_obj=file_obj,
+        disable_ingest_if_hash=disable_ingest_if_hash,
+    )
+
+
+async def add_file_metadata_raw(
+    result: SaveFilepathToHashResult,
+    file_obj: CompleteFileSchema,
+    disable_ingest_if_hash: bool = False,
+) -> Tuple[Optional[str], CompleteFileSchema]:
+    logger = default_logger
     # This step doesnt need anything super sophisticated, and also has contingecnices for failed requests, so retries are kinda unecessary
     small_llm = KeLLMUtils(
         ModelName.llama_70b, slow_retry=False
@@ -196,15 +221,20 @@ async def add_file_raw(
     # This assignment shouldnt be necessary, but I hate mutating variable bugs.
     file_obj.mdata = validate_metadata_mutable(file_obj.mdata)
 
-    logger.info("Attempting to save data to file")
-    result = await file_manager.save_filepath_to_hash_async(
-        tmp_filepath, OS_HASH_FILEDIR
-    )
     file_obj.hash = result.hash
-
-    os.remove(tmp_filepath)
+    # Having the bytes isnt enough, an earlier run could have died halfway, so only skip what the registry says finished.
     if result.did_exist and disable_ingest_if_hash:
-        return "file already exists", file_obj
+        try:
+            existing = await hash_registry_get(result.hash)
+        except Exception as e:
+            logger.error(f"Unable to check the hash registry for {result.hash}: {e}")
+            existing = None
+        if existing is not None:
+            logger.info(
+                f"File with hash {result.hash} was already processed as {existing.file_id}"
+            )
+            file_obj.id = existing.file_id
+            return "file already exists", file_obj
 
     # FIXME: RENEABLE BACKUPS AT SOME POINT
     # file_manager.backup_metadata_to_hash(metadata, filehash)
@@ -215,7 +245,8 @@ async def add_file_raw(
         author_names = ""
 
     # TODO: Add examples to this prompt for better author splitting results.
-    authors_info = await split_author_field_into_authordata(author_names, small_llm)
+    with trace_span("llm_authors"):
+        authors_info = await split_author_field_into_authordata(author_names, small_llm)
     file_obj.authors = authors_info
     authors_strings = getListAuthors(authors_info)
     file_obj.mdata["authors"] = authors_strings
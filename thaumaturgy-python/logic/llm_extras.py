@@ -4,6 +4,7 @@ from common.file_schemas import (
     get_english_text_from_fileschema,
 )
 from common.llm_utils import KeLLMUtils, ModelName, get_llm_from_model_name
+from common.task_trace import trace_span
 import logging
 
 default_logger = logging.getLogger(__name__)
@@ -29,13 +30,14 @@ class ExtraGenerator:
 
         doc_extras = FileGeneratedExtras()
         try:
-            doc_extras.summary = await self.big_llm.simple_summary_truncate(
-                english_text
-            )
-            short_sum_instruct = "Take this long summary and condense it into a 1-2 sentance short summary."
-            doc_extras.short_summary = await self.big_llm.simple_instruct(
-                content=doc_extras.summary, instruct=short_sum_instruct
-            )
+            with trace_span("llm_summary"):
+                doc_extras.summary = await self.big_llm.simple_summary_truncate(
+                    english_text
+                )
+                short_sum_instruct = "Take this long summary and condense it into a 1-2 sentance short summary."
+                doc_extras.short_summary = await self.big_llm.simple_instruct(
+                    content=doc_extras.summary, instruct=short_sum_instruct
+                )
         except Exception as e:
             self.logger.error(f"Failed to generate summary: {e}")
         document_content_string = english_text
@@ -49,18 +51,20 @@ class ExtraGenerator:
 
         try:
             impressiveness_instruct = "Award a score from 0-10 for how impressive the authorship behind this paper is in terms of credentials, and the persusasiveness and authority of the document itself, a result of 1 should be an anonomous author, with a relatively cursory overview, and a 10 should be an impressive thurough well resaerched document written by multiple authors from an extremely prestegious organization. (You can also choose any fractional number between 0 and 10, like 9.7, or 4.2)"
-            doc_extras.impressiveness = await self.big_llm.score_two_step(
-                content=document_content_string,
-                score_instruction=impressiveness_instruct,
-                renorm_score_val=10.0,
-            )
+            with trace_span("llm_impressiveness"):
+                doc_extras.impressiveness = await self.big_llm.score_two_step(
+                    content=document_content_string,
+                    score_instruction=impressiveness_instruct,
+                    renorm_score_val=10.0,
+                )
         except Exception as e:
             self.logger.error(f"Failed to score impressiveness: {e}")
         try:
             purpose_instruct = "Describe the purpose of this document, and what the author is wishing to acomplish by writing it."
-            doc_extras.purpose = await self.big_llm.simple_instruct(
-                content=document_content_string, instruct=purpose_instruct
-            )
+            with trace_span("llm_purpose"):
+                doc_extras.purpose = await self.big_llm.simple_instruct(
+                    content=document_content_string, instruct=purpose_instruct
+                )
         except Exception as e:
             self.logger.error(f"Failed calling llm to determine document purpose: {e}")
 
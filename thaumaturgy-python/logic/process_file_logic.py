@@ -15,6 +15,7 @@ from common.misc_schemas import KnownFileExtension
 from common.niclib import download_file
 from common.task_schema import DatabaseInteraction, Task
 from common.llm_utils import KeLLMUtils, ModelName
+from common.task_trace import trace_span
 import os
 from pathlib import Path
 
@@ -39,7 +40,8 @@ from typing import List, Optional
 import json
 from common.niclib import rand_string
 from logic.llm_extras import ExtraGenerator
-from util.file_io import S3FileManager
+from util.file_io import get_s3_file_manager
+from logic.stage_checkpoints import resume_from_checkpoint, save_stage_checkpoint
 
 # import base64
 
@@ -68,7 +70,7 @@ async def process_file_raw(
     obj: CompleteFileSchema,
     stop_at: Optional[DocumentStatus] = None,
     priority: bool = True,
-) -> Tuple[Optional[str], CompleteFileSchema]:
+) -> Tuple[Optional[Exception], CompleteFileSchema]:
     obj = CompleteFileSchema.model_validate(obj, strict=True)
     logger = default_logger
     hash = obj.hash
@@ -88,9 +90,14 @@ async def process_file_raw(
     )  # Maybe replace with something cheeper.
     extra_gen = ExtraGenerator()
     mdextract = MarkdownExtractor(logger, OS_TMPDIR, priority=priority)
-    file_manager = S3FileManager(logger=logger)
+    file_manager = get_s3_file_manager()
     text = {}
     # Move back to stage 1 after all files are in s3 to save bandwith
+    # Pick up from the furthest checkpoint, so a retry after a failed enrichment doesnt hit marker again.
+    with trace_span("checkpoint_resume"):
+        current_stage, checkpoint = await resume_from_checkpoint(
+            obj, current_stage, text, file_manager, logger
+        )
 
     async def process_stage_handle_extension():
         valid_extension = None
@@ -241,15 +248,20 @@ async def process_file_raw(
                 case DocumentStatus.unprocessed:
                     # Mark that an attempt to process the document starting at stage 1
                     # TODO: Add new stage for file validation, now just using unprocessed.
-                    current_stage = await process_stage_handle_extension()
+                    with trace_span("validate_extension"):
+                        current_stage = await process_stage_handle_extension()
                 case DocumentStatus.stage1:
-                    current_stage = await process_stage_one()
+                    with trace_span("extract_markdown"):
+                        current_stage = await process_stage_one()
                 case DocumentStatus.stage2:
-                    current_stage = await process_stage_two()
+                    with trace_span("translate"):
+                        current_stage = await process_stage_two()
                 case DocumentStatus.stage3:
-                    current_stage = await create_llm_extras()
+                    with trace_span("llm_extras"):
+                        current_stage = await create_llm_extras()
                 case DocumentStatus.summarization_completed:
-                    current_stage = await process_embeddings()
+                    with trace_span("embeddings"):
+                        current_stage = await process_embeddings()
                 case DocumentStatus.embeddings_completed:
                     current_stage = DocumentStatus.completed
                 case _:
@@ -258,6 +270,10 @@ async def process_file_raw(
                         try readding it again.\
                     "
                     )
+            with trace_span("checkpoint_save"):
+                checkpoint = await save_stage_checkpoint(
+                    obj, current_stage, text, checkpoint, file_manager, logger
+                )
         except Exception as e:
             tb = traceback.format_exc()
             logger.error(f"Document errored out during {current_stage.value} : {e}")
@@ -272,7 +288,7 @@ async def process_file_raw(
                 is_errored=True,
                 is_completed=True,
             )
-            return str(e), obj
+            return e, obj
     raise Exception(
         "Congradulations, encountered unreachable code after an infinite loop in processing a single document in file logic."
     )
@@ -0,0 +1,92 @@
+import asyncio
+import random
+import re
+from typing import Union
+
+import aiohttp
+from pydantic import ValidationError
+
+from common.task_schema import FailureClass
+from constants import (
+    DOCPROC_RETRY_BASE_SECONDS,
+    DOCPROC_RETRY_MAX_ATTEMPTS,
+    DOCPROC_RETRY_MAX_SECONDS,
+)
+
+# Checked before the transient markers, a bad file stays bad no matter how often it times out.
+PERMANENT_ERROR_MARKERS = [
+    "format error",
+    "does not match extension",
+    "invalid file extension",
+    "unable to get proper file extension",
+    "no english text",
+    "null uuid",
+    "exceeds the maximum download size",
+]
+
+TRANSIENT_ERROR_MARKERS = [
+    "timeout",
+    "timed out",
+    "temporarily",
+    "rate limit",
+    "too many requests",
+    "connection reset",
+    "connection refused",
+    "disconnected",
+    "unavailable",
+    "try again",
+]
+
+# Status codes in errors that only made it here as strings, "Response code: 503", "status 429" or
+# aiohttps own "503, message=...". Anchored so ids, byte counts and hashes that contain 503 dont count.
+HTTP_STATUS_PATTERNS = [
+    re.compile(r"\b(?:status|code)(?: code)?\s*[:=]?\s*(\d{3})\b"),
+    re.compile(r"^(\d{3}), message="),
+]
+
+
+def transient_http_status(status: int) -> bool:
+    # A missing or forbidden file wont show up on a retry, throttling and server errors might clear up.
+    return status in [408, 425, 429] or status >= 500
+
+
+def classify_failure(error: Union[BaseException, str]) -> FailureClass:
+    # Errors that only made it here as strings are classified on the message alone.
+    if isinstance(error, (AssertionError, ValidationError, TypeError, KeyError)):
+        return FailureClass.permanent
+    if isinstance(error, aiohttp.ClientResponseError):
+        if transient_http_status(error.status):
+            return FailureClass.transient
+        return FailureClass.permanent
+    if isinstance(
+        error,
+        (asyncio.TimeoutError, TimeoutError, ConnectionError, aiohttp.ClientError),
+    ):
+        return FailureClass.transient
+    message = str(error).lower()
+    if any(marker in message for marker in PERMANENT_ERROR_MARKERS):
+        return FailureClass.permanent
+    for pattern in HTTP_STATUS_PATTERNS:
+        match = pattern.search(message)
+        if match is not None:
+            if transient_http_status(int(match.group(1))):
+                return FailureClass.transient
+            return FailureClass.permanent
+    if any(marker in message for marker in TRANSIENT_ERROR_MARKERS):
+        return FailureClass.transient
+    return FailureClass.permanent
+
+
+def should_retry(failure_class: FailureClass, attempts: int) -> bool:
+    return (
+        failure_class == FailureClass.transient
+        and attempts < DOCPROC_RETRY_MAX_ATTEMPTS
+    )
+
+
+def retry_backoff_seconds(attempts: int) -> float:
+    # Exponential with equal jitter, so a batch that failed together doesnt all come back at the same moment.
+    backoff = min(
+        DOCPROC_RETRY_MAX_SECONDS, DOCPROC_RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0)
+    )
+    return backoff / 2 + random.uniform(0, backoff / 2)
@@ -0,0 +1,168 @@
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from common.file_schemas import (
+    CompleteFileSchema,
+    DocProcCheckpoint,
+    DocumentStatus,
+    FileTextSchema,
+    docstatus_index,
+)
+from util.file_io import S3FileManager
+from util.redis_utils import checkpoint_get, checkpoint_set
+
+default_logger = logging.getLogger(__name__)
+
+# Stages worth resuming from, furthest first. Everything after summarization is cheap to redo.
+CHECKPOINT_STAGES = [
+    DocumentStatus.summarization_completed,
+    DocumentStatus.stage3,
+    DocumentStatus.stage2,
+    DocumentStatus.stage1,
+]
+
+
+def replace_doc_text(obj: CompleteFileSchema, doc_text: FileTextSchema) -> None:
+    obj.doc_texts = [
+        existing
+        for existing in obj.doc_texts
+        if existing.is_original_text != doc_text.is_original_text
+        or existing.language != doc_text.language
+    ]
+    obj.doc_texts.append(doc_text)
+
+
+async def download_checkpoint_text(
+    key: str, file_manager: S3FileManager, logger: Any
+) -> Optional[str]:
+    if key == "":
+        return None
+    try:
+        return await file_manager.download_text_from_s3_async(key)
+    except Exception as e:
+        logger.error(f"Unable to download checkpointed text {key}: {e}")
+        return None
+
+
+async def resume_from_checkpoint(
+    obj: CompleteFileSchema,
+    current_stage: DocumentStatus,
+    text: Dict[str, str],
+    file_manager: S3FileManager,
+    logger: Optional[Any] = None,
+) -> Tuple[DocumentStatus, Optional[DocProcCheckpoint]]:
+    if logger is None:
+        logger = default_logger
+    try:
+        checkpoint = await checkpoint_get(obj.hash, obj.lang)
+    except Exception as e:
+        logger.error(f"Unable to load checkpoint for {obj.hash}: {e}")
+        return current_stage, None
+    if checkpoint is None or docstatus_index(
+        checkpoint.docproc_stage
+    ) <= docstatus_index(current_stage):
+        return current_stage, checkpoint
+
+    original_text = await download_checkpoint_text(
+        checkpoint.original_text_key, file_manager, logger
+    )
+    english_text = original_text
+    if obj.lang != "en":
+        english_text = await download_checkpoint_text(
+            checkpoint.english_text_key, file_manager, logger
+        )
+
+    # Walk back from the furthest checkpointed stage until one has everything it needs still around.
+    for stage in CHECKPOINT_STAGES:
+        if docstatus_index(stage) > docstatus_index(checkpoint.docproc_stage):
+            continue
+        if docstatus_index(stage) <= docstatus_index(current_stage):
+            break
+        if checkpoint.extension == "":
+            break
+        if docstatus_index(stage) >= docstatus_index(DocumentStatus.stage2):
+            if original_text is None:
+                continue
+        if docstatus_index(stage) >= docstatus_index(DocumentStatus.stage3):
+            if english_text is None:
+                continue
+        if stage == DocumentStatus.summarization_completed:
+            if checkpoint.extra is None or checkpoint.source_id != obj.id:
+                continue
+
+        obj.extension = checkpoint.extension
+        if original_text is not None and stage != DocumentStatus.stage1:
+            replace_doc_text(
+                obj,
+                FileTextSchema(
+                    is_original_text=True, language=obj.lang, text=original_text
+                ),
+            )
+            if obj.lang == "en":
+                text["english_text"] = original_text
+            else:
+                text["original_text"] = original_text
+        if (
+            obj.lang != "en"
+            and english_text is not None
+            and docstatus_index(stage) >= docstatus_index(DocumentStatus.stage3)
+        ):
+            replace_doc_text(
+                obj,
+                FileTextSchema(is_original_text=False, language="en", text=english_text),
+            )
+            text["english_text"] = english_text
+        if stage == DocumentStatus.summarization_completed and checkpoint.extra:
+            obj.extra = checkpoint.extra
+        logger.info(
+            f"Resuming {obj.hash} from checkpoint at {stage.value} instead of {current_stage.value}"
+        )
+        return stage, checkpoint
+    return current_stage, checkpoint
+
+
+# Called right after a stage finishes, so whatever it just produced is what gets saved.
+async def save_stage_checkpoint(
+    obj: CompleteFileSchema,
+    stage: DocumentStatus,
+    text: Dict[str, str],
+    checkpoint: Optional[DocProcCheckpoint],
+    file_manager: S3FileManager,
+    logger: Optional[Any] = None,
+) -> Optional[DocProcCheckpoint]:
+    if logger is None:
+        logger = default_logger
+    if stage not in CHECKPOINT_STAGES:
+        return checkpoint
+    # Validating the extension is the start of a fresh run, anything saved before it is stale.
+    if checkpoint is None or stage == DocumentStatus.stage1:
+        checkpoint = DocProcCheckpoint(
+            hash=obj.hash, lang=obj.lang, docproc_stage=stage
+        )
+    try:
+        match stage:
+            case DocumentStatus.stage2:
+                key = file_manager.checkpoint_text_key(obj.hash, obj.lang, True)
+                await file_manager.push_text_to_s3_async(text["original_text"], key)
+                checkpoint.original_text_key = key
+            case DocumentStatus.stage3:
+                # English documents skip translation, so their original text is also the english one.
+                is_original_text = obj.lang == "en"
+                key = file_manager.checkpoint_text_key(
+                    obj.hash, obj.lang, is_original_text
+                )
+                await file_manager.push_text_to_s3_async(text["english_text"], key)
+                if is_original_text:
+                    checkpoint.original_text_key = key
+                else:
+                    checkpoint.english_text_key = key
+            case DocumentStatus.summarization_completed:
+                checkpoint.extra = obj.extra
+                checkpoint.source_id = obj.id
+        checkpoint.docproc_stage = stage
+        checkpoint.extension = obj.extension
+        await checkpoint_set(checkpoint)
+    except Exception as e:
+        # A missing checkpoint only costs a rerun later, it shouldnt fail the document.
+        logger.error(f"Unable to save checkpoint for {obj.hash} at {stage.value}: {e}")
+    return checkpoint
@@ -17,6 +17,8 @@ from routing.docproc_controller import DocumentProcesserController
 
 
 from background_loops import initialize_background_loops
+from common.http_session import close_shared_http_session
+from util.file_io import create_local_dirs
 
 
 from constants import (
@@ -69,6 +71,8 @@ async def run_startup_env_checks():
 
 async def on_startup() -> None:
     await run_startup_env_checks()
+    # Also sweeps partial downloads left by a worker that was killed, off the loop since the raw dir can be big.
+    await asyncio.to_thread(create_local_dirs)
     initialize_background_loops()
 
 
@@ -96,6 +100,7 @@ api_router = Router(
 
 app = Litestar(
     on_startup=[on_startup],
+    on_shutdown=[close_shared_http_session],
     route_handlers=[api_router],
     cors_config=cors_config,
     logging_config=logging_config,
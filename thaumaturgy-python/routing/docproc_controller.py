@@ -1,10 +1,15 @@
 import aiohttp
+import asyncio
+import time
+from datetime import datetime
 from typing_extensions import List
 from pydantic import BaseModel, RootModel, TypeAdapter
-from typing import Optional
+from typing import Dict, Optional
 
 
 from litestar import Controller, Request, Response
+from litestar.exceptions import ServiceUnavailableException
+from litestar.response import ServerSentEvent, ServerSentEventMessage
 
 from litestar.handlers.http_handlers.decorators import get, post, delete
 
@@ -13,41 +18,77 @@ from litestar.params import Parameter
 from typing import Optional
 
 
-from common.file_schemas import NEWDOCSTAGE
+from common.file_schemas import NEWDOCSTAGE, DocProcStage, PGStage
 from constants import (
+    DOCPROC_DEAD_LETTER_REPLAY_MAX_RATE_PER_SECOND,
+    DOCPROC_DEAD_LETTER_REPLAY_RATE_PER_SECOND,
+    DOCPROC_DEAD_LETTER_REPLAY_TTL_SECONDS,
+    DOCPROC_TASK_EVENTS_MAX_BLOCK_SECONDS,
+    DOCPROC_TASK_EVENTS_MAX_WAITERS,
     KESSLER_API_URL,
-    REDIS_DOCPROC_PRIORITYQUEUE_KEY,
-    REDIS_DOCPROC_QUEUE_KEY,
-    REDIS_HOST,
+    REDIS_DOCPROC_DEAD_LETTER_REPLAY_PREFIX,
     REDIS_MAIN_PROCESS_LOOP_CONFIG,
-    REDIS_PORT,
 )
 
 
-import redis
+import redis.asyncio as aioredis
 import uuid
 
 from daemon_state import (
     DaemonState,
+    migrateDeprecatedValues,
     updateExistingState,
     validateAllValuesDefined,
 )
-from util.redis_utils import clear_file_queue, task_get, task_push_to_queue
+from util.redis_utils import (
+    clear_file_queue,
+    dead_letter_count,
+    dead_letter_restore,
+    dead_letter_scan,
+    dead_letter_take,
+    default_redis_client,
+    publish_daemon_state,
+    read_task_events,
+    task_events_redis_client,
+    s3_known_hashes_count,
+    scheduled_retry_count,
+    semaphore_in_flight_count,
+    stage_queue_depths,
+    task_get,
+    task_index_counts,
+    task_index_scan,
+    task_leased_count,
+    task_push_many_to_queue,
+    task_push_to_queue,
+    task_trace_get,
+    timing_percentiles_by_span,
+)
 
 
 from common.task_schema import (
     BulkProcessInfo,
     BulkProcessSchema,
     DatabaseInteraction,
+    DeadLetter,
+    DeadLetterFilter,
+    FailureClass,
     ScraperInfo,
     Task,
+    TaskEvent,
+    TaskEventType,
+    TaskStage,
+    TaskStatus,
+    TaskSummary,
     TaskType,
     create_task,
+    naive_local_datetime,
+    task_validate_object,
     CompleteFileSchema,
 )
+from common.task_trace import TimingPercentiles, TraceSpan
 import logging
 
-redis_client = redis.Redis(REDIS_HOST, port=REDIS_PORT)
+redis_client = default_redis_client
 default_logger = logging.getLogger(__name__)
 
 
@@ -81,25 +122,307 @@ def convert_ny_to_scraper_info(nypuc_scraper: NyPUCScraperSchema) -> ScraperInfo
     )
 
 
+class StageStatus(BaseModel):
+    background_task_queue_length: int = -1
+    priority_task_queue_length: int = -1
+    # Every priority level, highest first, the two above are the ends of this list.
+    level_queue_lengths: List[int] = []
+    # Queued tasks per source/state/docket key, tasks without any of those are under "".
+    fair_share_queue_lengths: Dict[str, int] = {}
+    currently_processing_tasks: int = -1
+
+
 class DaemonStatus(BaseModel):
     config: DaemonState = DaemonState()
+    # Totals across every stage.
     background_task_queue_length: int = -1
     priority_task_queue_length: int = -1
+    currently_processing_tasks: int = -1
+    leased_task_count: int = -1
+    scheduled_retry_count: int = -1
+    dead_letter_count: int = -1
+    s3_known_hash_count: int = -1
+    stages: Dict[TaskStage, StageStatus] = {}
 
 
-def getDaemonStatus(redis_client: redis.Redis) -> DaemonStatus:
-    existing_state_str = redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
+async def getDaemonStatus(redis_client: aioredis.Redis) -> DaemonStatus:
+    existing_state_str = await redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
     existing_state = DaemonState.model_validate_json(existing_state_str)
-    priority_task_queue_length = int(redis_client.llen(REDIS_DOCPROC_PRIORITYQUEUE_KEY))
-    background_task_queue_length = int(redis_client.llen(REDIS_DOCPROC_QUEUE_KEY))
+    stages = {}
+    for stage in TaskStage:
+        level_lengths, fair_share_lengths = await stage_queue_depths(
+            stage, redis_client=redis_client
+        )
+        stages[stage] = StageStatus(
+            background_task_queue_length=level_lengths[-1],
+            priority_task_queue_length=level_lengths[0],
+            level_queue_lengths=level_lengths,
+            fair_share_queue_lengths=fair_share_lengths,
+            currently_processing_tasks=await semaphore_in_flight_count(
+                stage=stage, redis_client=redis_client
+            ),
+        )
     status = DaemonStatus(
         config=existing_state,
-        background_task_queue_length=background_task_queue_length,
-        priority_task_queue_length=priority_task_queue_length,
+        background_task_queue_length=sum(
+            s.background_task_queue_length for s in stages.values()
+        ),
+        priority_task_queue_length=sum(
+            s.priority_task_queue_length for s in stages.values()
+        ),
+        currently_processing_tasks=sum(
+            s.currently_processing_tasks for s in stages.values()
+        ),
+        leased_task_count=await task_leased_count(redis_client=redis_client),
+        scheduled_retry_count=await scheduled_retry_count(redis_client=redis_client),
+        dead_letter_count=await dead_letter_count(redis_client=redis_client),
+        s3_known_hash_count=await s3_known_hashes_count(redis_client=redis_client),
+        stages=stages,
     )
     return status
 
 
+class TaskEventsRequest(BaseModel):
+    task_ids: List[uuid.UUID]
+    # Last event id seen per task, tasks left out get every event still kept.
+    cursors: Dict[str, str] = {}
+    timeout_seconds: float = 25
+
+
+class TaskEventsResponse(BaseModel):
+    events: List[TaskEvent]
+    # Send these back as the cursors of the next poll.
+    cursors: Dict[str, str]
+
+
+# Long polls and streams blocked on the event pool in this worker right now.
+task_event_waiters = 0
+
+
+def taskEventWaitersFull() -> bool:
+    return task_event_waiters >= DOCPROC_TASK_EVENTS_MAX_WAITERS
+
+
+async def waitForTaskEvents(
+    cursors: Dict[str, str], timeout_seconds: float
+) -> TaskEventsResponse:
+    # Returns right away if there is anything past the cursors, otherwise blocks until an event shows up or the timeout passes.
+    global task_event_waiters
+    timeout_seconds = min(max(timeout_seconds, 0), DOCPROC_TASK_EVENTS_MAX_BLOCK_SECONDS)
+    # Turn extra watchers away instead of letting them queue on the pool until its timeout.
+    if taskEventWaitersFull():
+        raise ServiceUnavailableException(
+            detail="Too many clients are waiting on task events, try again shortly"
+        )
+    task_event_waiters += 1
+    try:
+        events = await read_task_events(
+            cursors, block_seconds=timeout_seconds, redis_client=task_events_redis_client
+        )
+    finally:
+        task_event_waiters -= 1
+    cursors = dict(cursors)
+    for event in events:
+        cursors[str(event.task_id)] = event.id
+    return TaskEventsResponse(events=events, cursors=cursors)
+
+
+class TaskListPage(BaseModel):
+    tasks: List[TaskSummary]
+    # Pass back as the offset to get the next page, None once there is nothing left.
+    next_offset: Optional[int] = None
+    status_counts: Dict[TaskStatus, int] = {}
+
+
+class DeadLetterPage(BaseModel):
+    dead_letters: List[DeadLetter]
+    # Pass back as the offset to get the next page, None once there is nothing left.
+    next_offset: Optional[int] = None
+    total_dead_letters: int
+
+
+class DeadLetterGroup(BaseModel):
+    error_group: str
+    count: int
+    example_error: str
+    example_task_id: uuid.UUID
+    stages: Dict[TaskStage, int] = {}
+    first_failed_at: datetime
+    last_failed_at: datetime
+
+
+class DeadLetterRequeueRequest(BaseModel):
+    filter: DeadLetterFilter = DeadLetterFilter()
+    # Requeue at most this many, newest first. None requeues everything the filter matches.
+    limit: Optional[int] = None
+    rate_per_second: float = DOCPROC_DEAD_LETTER_REPLAY_RATE_PER_SECOND
+    # Leave unset to keep the priority each task was first queued with.
+    priority: Optional[bool] = None
+    # Only count what would be requeued.
+    dry_run: bool = False
+
+
+class DeadLetterReplay(BaseModel):
+    id: uuid.UUID
+    matched: int = 0
+    requeued: int = 0
+    # Taken by another replay, or dropped from the store before this one got to them.
+    skipped: int = 0
+    failed: int = 0
+    finished: bool = False
+    error: str = ""
+    started_at: datetime
+    updated_at: datetime
+
+
+def deadLetterFilterFromQuery(
+    error_group: Optional[str],
+    error_contains: Optional[str],
+    stage: Optional[TaskStage],
+    failure_class: Optional[FailureClass],
+    task_type: Optional[TaskType],
+    failed_after: Optional[datetime],
+    failed_before: Optional[datetime],
+) -> DeadLetterFilter:
+    return DeadLetterFilter(
+        error_group=error_group,
+        error_contains=error_contains,
+        stage=stage,
+        failure_class=failure_class,
+        task_type=task_type,
+        failed_after=failed_after,
+        failed_before=failed_before,
+    )
+
+
+async def groupDeadLetters(filter: DeadLetterFilter) -> List[DeadLetterGroup]:
+    entries, _ = await dead_letter_scan(filter, redis_client=redis_client)
+    groups: Dict[str, DeadLetterGroup] = {}
+    # The scan goes newest first, so the first entry of a group is its latest failure.
+    for entry in entries:
+        group = groups.get(entry.error_group)
+        if group is None:
+            group = DeadLetterGroup(
+                error_group=entry.error_group,
+                count=0,
+                example_error=entry.error,
+                example_task_id=entry.task_id,
+                first_failed_at=entry.failed_at,
+                last_failed_at=entry.failed_at,
+            )
+            groups[entry.error_group] = group
+        group.count += 1
+        group.stages[entry.stage] = group.stages.get(entry.stage, 0) + 1
+        group.first_failed_at = entry.failed_at
+    return sorted(groups.values(), key=lambda group: group.count, reverse=True)
+
+
+def resetDeadLetterTask(task: Task, priority: Optional[bool]) -> Task:
+    # Starts the task over from the first stage for its type, checkpoints make the stages it already finished cheap.
+    task.completed = False
+    task.success = False
+    task.error = ""
+    task.error_traceback = ""
+    task.failed_stage = None
+    task.failure_class = None
+    task.attempts = 0
+    task.retry_at = None
+    task.stage = None
+    if priority is not None:
+        task.priority = priority
+        task.priority_level = None
+    task = task_validate_object(task)
+    if isinstance(task.obj, CompleteFileSchema):
+        task.obj.stage = DocProcStage(
+            pg_stage=PGStage.PENDING,
+            docproc_stage=task.obj.stage.docproc_stage,
+            skip_processing=task.obj.stage.skip_processing,
+            ingest_error_msg=task.obj.stage.ingest_error_msg,
+        )
+    return task
+
+
+def deadLetterReplayKey(replay_id: uuid.UUID) -> str:
+    return f"{REDIS_DOCPROC_DEAD_LETTER_REPLAY_PREFIX}:{replay_id}"
+
+
+async def saveDeadLetterReplay(replay: DeadLetterReplay) -> None:
+    replay.updated_at = datetime.now()
+    await redis_client.set(
+        deadLetterReplayKey(replay.id),
+        replay.model_dump_json(),
+        ex=DOCPROC_DEAD_LETTER_REPLAY_TTL_SECONDS,
+    )
+
+
+async def replayDeadLetters(
+    replay: DeadLetterReplay,
+    task_ids: List[uuid.UUID],
+    rate_per_second: float,
+    priority: Optional[bool],
+) -> None:
+    logger = default_logger
+    # One batch a second, or one task every 1/rate seconds for rates under one.
+    batch_size = max(1, int(rate_per_second))
+    batch_interval = batch_size / rate_per_second
+    try:
+        for start in range(0, len(task_ids), batch_size):
+            batch_started = time.monotonic()
+            batch_ids = task_ids[start : start + batch_size]
+            taken = await dead_letter_take(batch_ids, redis_client=redis_client)
+            replay.skipped += len(batch_ids) - len(taken)
+            tasks = [resetDeadLetterTask(task, priority) for _, task in taken]
+            try:
+                await task_push_many_to_queue(tasks, redis_client=redis_client)
+                replay.requeued += len(tasks)
+            except Exception as e:
+                logger.error(f"Unable to requeue dead letters, putting them back: {e}")
+                await dead_letter_restore(taken, redis_client=redis_client)
+                replay.failed += len(taken)
+                replay.error = str(e)
+            await saveDeadLetterReplay(replay)
+            await asyncio.sleep(
+                max(0, batch_interval - (time.monotonic() - batch_started))
+            )
+    except Exception as e:
+        logger.error(f"Dead letter replay {replay.id} stopped early: {e}")
+        replay.error = str(e)
+    replay.finished = True
+    await saveDeadLetterReplay(replay)
+
+
+# Keeps the running replays referenced so they arent garbage collected halfway through.
+running_dead_letter_replays = set()
+
+
+async def startDeadLetterReplay(data: DeadLetterRequeueRequest) -> DeadLetterReplay:
+    entries, _ = await dead_letter_scan(
+        data.filter, limit=data.limit, redis_client=redis_client
+    )
+    now = datetime.now()
+    replay = DeadLetterReplay(
+        id=uuid.uuid4(),
+        matched=len(entries),
+        started_at=now,
+        updated_at=now,
+        finished=data.dry_run or len(entries) == 0,
+    )
+    if replay.finished:
+        return replay
+    rate_per_second = min(
+        max(data.rate_per_second, 0.01), DOCPROC_DEAD_LETTER_REPLAY_MAX_RATE_PER_SECOND
+    )
+    await saveDeadLetterReplay(replay)
+    replay_task = asyncio.create_task(
+        replayDeadLetters(
+            replay, [entry.task_id for entry in entries], rate_per_second, data.priority
+        )
+    )
+    running_dead_letter_replays.add(replay_task)
+    replay_task.add_done_callback(running_dead_letter_replays.discard)
+    return replay
+
+
 class ListCompleteFileSchema(RootModel):
     root: List[CompleteFileSchema]
 
@@ -108,15 +431,13 @@ async def backgroundRequestDocuments(
     request_size: int,
     check_if_empty: bool = True,
     priority: bool = False,
-    redis_client: redis.Redis = redis_client,
+    redis_client: aioredis.Redis = redis_client,
 ) -> str:
     if check_if_empty:
-        background_not_empty = int(redis_client.llen(REDIS_DOCPROC_QUEUE_KEY)) != 0
-        priority_not_empty = (
-            int(redis_client.llen(REDIS_DOCPROC_PRIORITYQUEUE_KEY)) != 0
-        )
-        if background_not_empty or priority_not_empty:
-            return "queue not empty"
+        for stage in TaskStage:
+            level_lengths, _ = await stage_queue_depths(stage, redis_client=redis_client)
+            if sum(level_lengths) != 0:
+                return "queue not empty"
     async with aiohttp.ClientSession() as session:
         response = await session.get(
             f"{KESSLER_API_URL}/v2/admin/get-unverified-docs/{request_size}"
@@ -133,19 +454,22 @@ async def backgroundRequestDocuments(
 
         files = ListCompleteFileSchema.model_validate(result_json)
         files = files.root
-        process_existing_docs(files=files, priority=priority, redis_client=redis_client)
+        await process_existing_docs(
+            files=files, priority=priority, redis_client=redis_client
+        )
 
     return "complete"
 
 
-def process_existing_docs(
+async def process_existing_docs(
     files: List[CompleteFileSchema],
     priority: bool = False,
-    redis_client: redis.Redis = redis_client,
+    idempotency_key: Optional[str] = None,
+    redis_client: aioredis.Redis = redis_client,
 ) -> List[Task]:
     logger = default_logger
 
-    def create_push_file(file: CompleteFileSchema) -> Task:
+    def create_file_task(file: CompleteFileSchema) -> Task:
         # Reset
         if file.stage.database_error_msg != "":
             logger.error(
@@ -161,11 +485,12 @@ def process_existing_docs(
         )
         if task is None:
             raise Exception("Unable to create task")
-        task_push_to_queue(task, redis_client=redis_client)
         return task
 
-    return_tasks = map(create_push_file, files)
-    return list(return_tasks)
+    return_tasks = list(map(create_file_task, files))
+    return await task_push_many_to_queue(
+        return_tasks, redis_client=redis_client, idempotency_key=idempotency_key
+    )
 
 
 class DocumentProcesserController(Controller):
@@ -175,26 +500,27 @@ class DocumentProcesserController(Controller):
 
     @post(path="/dangerous/set-daemon-state")
     async def set_daemon_state(self, data: DaemonState) -> str:
-        existing_state_str = redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
+        existing_state_str = await redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
         existing_state = DaemonState.model_validate_json(existing_state_str)
-        existing_state = updateExistingState(existing_state, data)
+        existing_state = updateExistingState(
+            existing_state, migrateDeprecatedValues(data)
+        )
         assert validateAllValuesDefined(
             existing_state
         ), "All values for the daemon state must be defined, this is likely a programming error"
-        existing_state_str = DaemonState.model_dump_json(existing_state)
-        redis_client.set(REDIS_MAIN_PROCESS_LOOP_CONFIG, existing_state_str)
+        await publish_daemon_state(existing_state, redis_client=redis_client)
         return "Daemon State Updated"
 
     # TODO: Change this method to a delete, last time I did it caused some unkown issues I didnt want to debug
     # I should probably just read the litestar documentation - nic
     @post(path="/dangerous/clear-queue")
     async def clear_queue(self) -> str:
-        clear_file_queue(redis_client=redis_client)
+        await clear_file_queue(redis_client=redis_client)
         return "Queue cleared"
 
     @get(path="/dangerous/get-daemon-status")
     async def get_daemon_status(self) -> DaemonStatus:
-        status = getDaemonStatus(redis_client=redis_client)
+        status = await getDaemonStatus(redis_client=redis_client)
         return status
 
     @get(path="/status/{task_id:uuid}")
@@ -202,11 +528,177 @@ class DocumentProcesserController(Controller):
         self,
         task_id: uuid.UUID = Parameter(title="Task ID", description="Task to retieve"),
     ) -> Response:
-        task = task_get(task_id)
+        task = await task_get(task_id)
         if task is None:
             return Response(status_code=404, content="Task not found")
         return Response(status_code=200, content=task)
 
+    @get(path="/status/{task_id:uuid}/trace")
+    async def get_task_trace(
+        self,
+        task_id: uuid.UUID = Parameter(title="Task ID", description="Task to retieve"),
+    ) -> List[TraceSpan]:
+        return await task_trace_get(task_id, redis_client=redis_client)
+
+    # Percentiles over the recent runs of every stage and traced call, keyed by "stage:span".
+    @get(path="/status/timings")
+    async def get_stage_timings(self) -> Dict[str, TimingPercentiles]:
+        return await timing_percentiles_by_span(redis_client=redis_client)
+
+    @get(path="/status/{task_id:uuid}/events")
+    async def get_task_events(
+        self,
+        task_id: uuid.UUID = Parameter(title="Task ID", description="Task to watch"),
+        last_event_id: str = "0",
+        timeout_seconds: float = 25,
+    ) -> TaskEventsResponse:
+        return await waitForTaskEvents({str(task_id): last_event_id}, timeout_seconds)
+
+    @post(path="/status/events")
+    async def get_batch_task_events(self, data: TaskEventsRequest) -> TaskEventsResponse:
+        cursors = {
+            str(task_id): data.cursors.get(str(task_id), "0") for task_id in data.task_ids
+        }
+        return await waitForTaskEvents(cursors, data.timeout_seconds)
+
+    @get(path="/status/{task_id:uuid}/stream")
+    async def stream_task_events(
+        self,
+        task_id: uuid.UUID = Parameter(title="Task ID", description="Task to watch"),
+        last_event_id: str = "0",
+        # Sent by browsers when they reconnect a dropped stream.
+        reconnect_event_id: Optional[str] = Parameter(
+            header="Last-Event-ID", required=False, default=None
+        ),
+    ) -> ServerSentEvent:
+        if reconnect_event_id is not None:
+            last_event_id = reconnect_event_id
+        if taskEventWaitersFull():
+            raise ServiceUnavailableException(
+                detail="Too many clients are waiting on task events, try again shortly"
+            )
+
+        async def event_stream():
+            cursors = {str(task_id): last_event_id}
+            while True:
+                try:
+                    response = await waitForTaskEvents(
+                        cursors, DOCPROC_TASK_EVENTS_MAX_BLOCK_SECONDS
+                    )
+                except ServiceUnavailableException:
+                    # The stream is already open, so back off and keep it alive until a slot frees up.
+                    yield ServerSentEventMessage(comment="keepalive")
+                    await asyncio.sleep(1)
+                    continue
+                cursors = response.cursors
+                for event in response.events:
+                    yield ServerSentEventMessage(
+                        data=event.model_dump_json(), event=event.event.value, id=event.id
+                    )
+                    if event.event in [TaskEventType.completed, TaskEventType.failed]:
+                        return
+                if len(response.events) == 0:
+                    # Keeps proxies from closing an idle stream.
+                    yield ServerSentEventMessage(comment="keepalive")
+
+        return ServerSentEvent(event_stream())
+
+    @get(path="/tasks")
+    async def list_tasks(
+        self,
+        status: Optional[TaskStatus] = None,
+        task_type: Optional[TaskType] = Parameter(query="type", default=None),
+        # Only tasks last updated in this window, use before with queued or running to find stuck tasks.
+        since: Optional[datetime] = None,
+        before: Optional[datetime] = None,
+        offset: int = 0,
+        limit: int = Parameter(default=100, ge=1, le=1000),
+    ) -> TaskListPage:
+        tasks, next_offset = await task_index_scan(
+            status=status,
+            task_type=task_type,
+            since=naive_local_datetime(since) if since is not None else None,
+            before=naive_local_datetime(before) if before is not None else None,
+            offset=offset,
+            limit=limit,
+            redis_client=redis_client,
+        )
+        return TaskListPage(
+            tasks=tasks,
+            next_offset=next_offset,
+            status_counts=await task_index_counts(redis_client=redis_client),
+        )
+
+    @get(path="/dead-letters")
+    async def get_dead_letters(
+        self,
+        offset: int = 0,
+        limit: int = Parameter(default=100, ge=1, le=1000),
+        error_group: Optional[str] = None,
+        error_contains: Optional[str] = None,
+        stage: Optional[TaskStage] = None,
+        failure_class: Optional[FailureClass] = None,
+        task_type: Optional[TaskType] = None,
+        failed_after: Optional[datetime] = None,
+        failed_before: Optional[datetime] = None,
+    ) -> DeadLetterPage:
+        filter = deadLetterFilterFromQuery(
+            error_group,
+            error_contains,
+            stage,
+            failure_class,
+            task_type,
+            failed_after,
+            failed_before,
+        )
+        entries, next_offset = await dead_letter_scan(
+            filter, offset=offset, limit=limit, redis_client=redis_client
+        )
+        return DeadLetterPage(
+            dead_letters=entries,
+            next_offset=next_offset,
+            total_dead_letters=await dead_letter_count(redis_client=redis_client),
+        )
+
+    @get(path="/dead-letters/groups")
+    async def get_dead_letter_groups(
+        self,
+        error_contains: Optional[str] = None,
+        stage: Optional[TaskStage] = None,
+        failure_class: Optional[FailureClass] = None,
+        task_type: Optional[TaskType] = None,
+        failed_after: Optional[datetime] = None,
+        failed_before: Optional[datetime] = None,
+    ) -> List[DeadLetterGroup]:
+        filter = deadLetterFilterFromQuery(
+            None,
+            error_contains,
+            stage,
+            failure_class,
+            task_type,
+            failed_after,
+            failed_before,
+        )
+        return await groupDeadLetters(filter)
+
+    @post(path="/dead-letters/requeue")
+    async def requeue_dead_letters(
+        self, data: DeadLetterRequeueRequest
+    ) -> DeadLetterReplay:
+        return await startDeadLetterReplay(data)
+
+    @get(path="/dead-letters/requeue/{replay_id:uuid}")
+    async def get_dead_letter_replay(
+        self,
+        replay_id: uuid.UUID = Parameter(title="Replay ID", description="Replay to check"),
+    ) -> Response:
+        replay_str = await redis_client.get(deadLetterReplayKey(replay_id))
+        if replay_str is None:
+            return Response(status_code=404, content="Replay not found")
+        return Response(
+            status_code=200, content=DeadLetterReplay.model_validate_json(replay_str)
+        )
+
     @post(path="/get-docs-from-kessler")
     async def get_from_kessler(
         self, max_docs: int = 1000, check_if_empty: bool = True, priority: bool = False
@@ -224,20 +716,41 @@ class DocumentProcesserController(Controller):
 
     @post(path="/process-existing-document")
     async def process_existing_document_handler(
-        self, data: CompleteFileSchema, priority: bool
+        self,
+        data: CompleteFileSchema,
+        priority: bool,
+        idempotency_key: Optional[str] = Parameter(
+            header="Idempotency-Key", required=False, default=None
+        ),
     ) -> Task:
-        return process_existing_docs(files=[data], priority=priority)[0]
+        return (
+            await process_existing_docs(
+                files=[data], priority=priority, idempotency_key=idempotency_key
+            )
+        )[0]
 
     @post(path="/process-existing-document/list")
     async def process_existing_documents_handler(
-        self, data: List[CompleteFileSchema], priority: bool
+        self,
+        data: List[CompleteFileSchema],
+        priority: bool,
+        idempotency_key: Optional[str] = Parameter(
+            header="Idempotency-Key", required=False, default=None
+        ),
     ) -> List[Task]:
-        return process_existing_docs(files=data, priority=priority)
+        return await process_existing_docs(
+            files=data, priority=priority, idempotency_key=idempotency_key
+        )
 
     # https://thaum.kessler.xyz/v1/process-scraped-doc
     @post(path="/process-scraped-doc")
     async def process_scraped_document_handler(
-        self, data: ScraperInfo, priority: bool
+        self,
+        data: ScraperInfo,
+        priority: bool,
+        idempotency_key: Optional[str] = Parameter(
+            header="Idempotency-Key", required=False, default=None
+        ),
     ) -> Task:
         task = create_task(
             data,
@@ -248,12 +761,16 @@ class DocumentProcesserController(Controller):
         )
         if task is None:
             raise Exception("Unable to create task")
-        task_push_to_queue(task)
-        return task
+        return await task_push_to_queue(task, idempotency_key=idempotency_key)
 
     @post(path="/process-scraped-docs-bulk")
     async def process_scraped_documents_bulk_handler(
-        self, data: BulkProcessSchema, priority: bool
+        self,
+        data: BulkProcessSchema,
+        priority: bool,
+        idempotency_key: Optional[str] = Parameter(
+            header="Idempotency-Key", required=False, default=None
+        ),
     ) -> List[Task]:
         scraperlist = data.scraper_info_list
         bulk_info = data.bulk_info
@@ -268,15 +785,17 @@ class DocumentProcesserController(Controller):
             )
             if task is None:
                 raise Exception("Unable to create task")
-            task_push_to_queue(task)
             tasklist.append(task)
-        return tasklist
+        return await task_push_many_to_queue(tasklist, idempotency_key=idempotency_key)
 
     @post(path="/process-scraped-doc/ny-puc/")
     async def process_nypuc_scraped_document_handler(
         self,
         data: NyPUCScraperSchema,
         priority: bool,
+        idempotency_key: Optional[str] = Parameter(
+            header="Idempotency-Key", required=False, default=None
+        ),
     ) -> Task:
         actual_data = convert_ny_to_scraper_info(data)
         task = create_task(
@@ -288,14 +807,16 @@ class DocumentProcesserController(Controller):
         )
         if task is None:
             raise Exception("Unable to create task")
-        task_push_to_queue(task)
-        return task
+        return await task_push_to_queue(task, idempotency_key=idempotency_key)
 
     @post(path="/process-scraped-doc/ny-puc/list")
     async def process_nypuc_scraped_document_handler_list(
         self,
         data: List[NyPUCScraperSchema],
         priority: bool = False,
+        idempotency_key: Optional[str] = Parameter(
+            header="Idempotency-Key", required=False, default=None
+        ),
     ) -> List[Task]:
         tasklist: List[Task] = []
         for data_instance in data:
@@ -309,6 +830,5 @@ class DocumentProcesserController(Controller):
             )
             if task is None:
                 raise Exception("Unable to create task")
-            task_push_to_queue(task)
             tasklist.append(task)
-        return tasklist
+        return await task_push_many_to_queue(tasklist, idempotency_key=idempotency_key)
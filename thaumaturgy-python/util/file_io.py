@@ -5,39 +5,79 @@ import yaml
 from common.niclib import rand_string, rand_filepath
 
 
-from typing import Optional, Any, Tuple
+from typing import Optional, Any, Set, Tuple, BinaryIO
 
 import logging
-import requests
 from pathlib import Path
-from common.niclib import rand_string, get_blake2
+from common.niclib import rand_string, get_blake2, download_file, stream_url_to_file
 from tempfile import TemporaryFile
 
 
+import os
 import shutil
 import hashlib
 import base64
+import time
 
 import botocore
 
 from urllib.parse import urlparse
 
 from common.niclib import create_markdown_string, seperate_markdown_string
+from common.task_trace import trace_span
 from constants import (
     OS_TMPDIR,
     OS_HASH_FILEDIR,
     OS_BACKUP_FILEDIR,
     CLOUD_REGION,
+    DOWNLOAD_PARTIAL_MAX_AGE_SECONDS,
     S3_SECRET_KEY,
     S3_ACCESS_KEY,
     S3_ENDPOINT,
     S3_FILE_BUCKET,
+    S3_CHECKPOINT_DIRECTORY,
+    S3_MAX_POOL_CONNECTIONS,
+    S3_MULTIPART_CHUNK_SIZE_BYTES,
+    S3_MULTIPART_MAX_CONCURRENCY,
+    S3_MULTIPART_THRESHOLD_BYTES,
+    S3_THREAD_POOL_WORKERS,
 )
 
 import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotocoreConfig
+
+from util.redis_utils import s3_known_hash_exists, s3_known_hashes_add
 
 default_logger = logging.getLogger(__name__)
 
+# Raw files are content addressed and never deleted, so once a hash is seen on S3 it stays there for the life of the process.
+known_s3_raw_hashes: Set[str] = set()
+
+# Every blocking S3 call goes through here, the multipart parts themselves run on s3transfer's own threads.
+s3_executor = ThreadPoolExecutor(
+    max_workers=S3_THREAD_POOL_WORKERS, thread_name_prefix="s3"
+)
+s3_transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD_BYTES,
+    multipart_chunksize=S3_MULTIPART_CHUNK_SIZE_BYTES,
+    max_concurrency=S3_MULTIPART_MAX_CONCURRENCY,
+)
+
+
+async def run_in_s3_executor(function: Any, *args: Any) -> Any:
+    # Same as asyncio.to_thread but on the S3 pool, the context is copied so trace spans still land on the task.
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        s3_executor, functools.partial(context.run, function, *args)
+    )
+
 
 class SaveFilepathToHashResult(BaseModel):
     path: Path
@@ -45,6 +85,74 @@ class SaveFilepathToHashResult(BaseModel):
     did_exist: bool
 
 
+_shared_s3_client: Optional[Any] = None
+_shared_s3_file_manager: Optional["S3FileManager"] = None
+_local_dirs_created = False
+# Building a boto3 client isnt thread safe, using one is, so only construction needs the lock.
+_s3_init_lock = threading.Lock()
+
+
+def get_shared_s3_client() -> Any:
+    global _shared_s3_client
+    if _shared_s3_client is None:
+        with _s3_init_lock:
+            if _shared_s3_client is None:
+                _shared_s3_client = boto3.client(
+                    "s3",
+                    endpoint_url=S3_ENDPOINT,
+                    aws_access_key_id=S3_ACCESS_KEY,
+                    aws_secret_access_key=S3_SECRET_KEY,
+                    region_name=CLOUD_REGION,
+                    config=BotocoreConfig(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS
+                    ),
+                )
+    return _shared_s3_client
+
+
+def sweep_stale_partial_downloads(
+    directory: Path, max_age_seconds: float = DOWNLOAD_PARTIAL_MAX_AGE_SECONDS
+) -> int:
+    # Only the except in download_url_to_hash cleans up partial files, a worker killed mid download leaves them behind.
+    # Going by age leaves alone the downloads other workers sharing the directory still have running.
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for partial_path in directory.glob(".partial-*"):
+        try:
+            if partial_path.stat().st_mtime < cutoff:
+                partial_path.unlink()
+                removed += 1
+        except OSError as e:
+            default_logger.error(f"Could not remove stale partial download {partial_path}: {e}")
+    if removed > 0:
+        default_logger.info(f"Removed {removed} stale partial downloads from {directory}")
+    return removed
+
+
+def create_local_dirs() -> None:
+    global _local_dirs_created
+    if _local_dirs_created:
+        return
+    with _s3_init_lock:
+        if not _local_dirs_created:
+            OS_TMPDIR.mkdir(parents=True, exist_ok=True)
+            OS_HASH_FILEDIR.mkdir(parents=True, exist_ok=True)
+            OS_BACKUP_FILEDIR.mkdir(parents=True, exist_ok=True)
+            sweep_stale_partial_downloads(OS_HASH_FILEDIR)
+            _local_dirs_created = True
+
+
+def get_s3_file_manager() -> "S3FileManager":
+    # The manager holds no per task state, so one per process does for every caller.
+    global _shared_s3_file_manager
+    if _shared_s3_file_manager is None:
+        manager = S3FileManager()
+        with _s3_init_lock:
+            if _shared_s3_file_manager is None:
+                _shared_s3_file_manager = manager
+    return _shared_s3_file_manager
+
+
 # TODO: Remove all the code that saves hashes to a local dir, we arent serving them later so all that can be removed
 class S3FileManager:
     def __init__(self, logger: Optional[Any] = None) -> None:
@@ -56,49 +164,94 @@ class S3FileManager:
         self.endpoint = S3_ENDPOINT
         self.logger = logger
 
-        # Create directories if they don't exist
-        self.tmpdir.mkdir(parents=True, exist_ok=True)
-        self.rawfile_savedir.mkdir(parents=True, exist_ok=True)
-        self.metadata_backupdir.mkdir(parents=True, exist_ok=True)
-
-        self.s3 = boto3.client(
-            "s3",
-            endpoint_url=self.endpoint,
-            aws_access_key_id=S3_ACCESS_KEY,
-            aws_secret_access_key=S3_SECRET_KEY,
-            region_name=CLOUD_REGION,
-        )
+        # Create directories if they don't exist, only the first manager in the process actually touches the disk.
+        create_local_dirs()
+
+        self.s3 = get_shared_s3_client()
         self.bucket = S3_FILE_BUCKET
         self.s3_raw_directory = "raw/"
+        self.s3_checkpoint_directory = S3_CHECKPOINT_DIRECTORY
 
     async def save_filepath_to_hash_async(
         self, filepath: Path, hashpath: Optional[Path] = None, network: bool = True
     ) -> SaveFilepathToHashResult:
-        return await asyncio.to_thread(
+        return await run_in_s3_executor(
             self.save_filepath_to_hash, filepath, hashpath, network
         )
 
     def save_filepath_to_hash(
         self, filepath: Path, hashpath: Optional[Path] = None, network: bool = True
     ) -> SaveFilepathToHashResult:
-        did_exist = False
         if hashpath is None:
             hashpath = self.rawfile_savedir
         filepath.parent.mkdir(exist_ok=True, parents=True)
         self.logger.info("Getting hash")
-        b264_hash = self.get_blake2_str(filepath)
+        with trace_span("hash"):
+            b264_hash = self.get_blake2_str(filepath)
         self.logger.info(f"Got hash {b264_hash}")
         saveloc = self.get_default_filepath_from_hash(b264_hash, hashpath)
+        # Content addressed, so a file already under this hash is these exact bytes.
+        did_exist = saveloc.is_file()
+
+        if not did_exist:
+            self.logger.info(f"Saving file to {saveloc}")
+            shutil.copyfile(filepath, saveloc)
+            if saveloc.exists():
+                self.logger.info(f"Successfully Saved File to: {saveloc}")
+            else:
+                self.logger.error(f"File could not be saved to : {saveloc}")
+        if network:
+            with trace_span("s3_upload"):
+                was_on_s3, _ = self.push_raw_file_to_s3(saveloc, b264_hash)
+            did_exist = did_exist or was_on_s3
+        return SaveFilepathToHashResult(
+            path=saveloc, hash=b264_hash, did_exist=did_exist
+        )
 
-        self.logger.info(f"Saving file to {saveloc}")
-        shutil.copyfile(filepath, saveloc)
-        if saveloc.exists():
-            self.logger.info(f"Successfully Saved File to: {saveloc}")
-        else:
-            self.logger.error(f"File could not be saved to : {saveloc}")
+    async def download_url_to_hash(
+        self,
+        url: str,
+        hashpath: Optional[Path] = None,
+        network: bool = True,
+        max_bytes: Optional[int] = None,
+    ) -> SaveFilepathToHashResult:
+        # Hashes while downloading and renames the download into place, so each byte is written once and never read back.
+        if hashpath is None:
+            hashpath = self.rawfile_savedir
+        hashpath.mkdir(exist_ok=True, parents=True)
+        # Next to its final location so the rename stays on one filesystem and is atomic.
+        partial_path = hashpath / Path(f".partial-{rand_string()}")
+        hash_object = hashlib.blake2b()
+        try:
+            with open(partial_path, "wb") as f:
+                await stream_url_to_file(
+                    url,
+                    f,
+                    max_bytes=max_bytes,
+                    hash_object=hash_object,
+                    directory=hashpath,
+                )
+            b264_hash = base64.urlsafe_b64encode(hash_object.digest()).decode()
+            self.logger.info(f"Got hash {b264_hash} while downloading {url}")
+            saveloc = self.get_default_filepath_from_hash(b264_hash, hashpath)
+            did_exist = saveloc.is_file()
+            if did_exist:
+                # Same hash, same bytes, keep the copy thats already there.
+                partial_path.unlink()
+            else:
+                os.replace(partial_path, saveloc)
+        except BaseException:
+            partial_path.unlink(missing_ok=True)
+            raise
         if network:
-            self.push_raw_file_to_s3(saveloc, b264_hash)
-        return SaveFilepathToHashResult(path=saveloc, hash=b264_hash, did_exist=False)
+            with trace_span("s3_upload"):
+                was_on_s3, _ = await run_in_s3_executor(
+                    self.push_raw_file_to_s3_known_hash, saveloc, b264_hash
+                )
+            did_exist = did_exist or was_on_s3
+        return SaveFilepathToHashResult(
+            path=saveloc, hash=b264_hash, did_exist=did_exist
+        )
 
     def get_default_filepath_from_hash(
         self, hash: str, hashpath: Optional[Path] = None
@@ -156,31 +309,28 @@ class S3FileManager:
         with open(backuppath, "w") as text_file:
             text_file.write(savestring)
 
-    def download_file_to_path(self, url: str, savepath: Path) -> Path:
+    async def download_file_to_path(
+        self, url: str, savepath: Path, max_bytes: Optional[int] = None
+    ) -> Path:
         savepath.parent.mkdir(exist_ok=True, parents=True)
         self.logger.info(f"Downloading file to dir: {savepath}")
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with open(savepath, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    # If you have chunk encoded response uncomment if
-                    # and set chunk_size parameter to None.
-                    # if chunk:
-                    f.write(chunk)
-        return savepath
-
-    # TODO : Get types for temporary file
-    def download_file_to_tmpfile(self, url: str) -> Any:
+        return await download_file(url, savepath, max_bytes=max_bytes)
+
+    async def download_file_to_tmpfile(
+        self, url: str, max_bytes: Optional[int] = None
+    ) -> BinaryIO:
+        # Returned open and rewound, the file is deleted once the caller closes it.
         self.logger.info(f"Downloading file to temporary file")
-        with requests.get(url, stream=True) as r:
-            r.raise_for_status()
-            with TemporaryFile("wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    # If you have chunk encoded response uncomment if
-                    # and set chunk_size parameter to None.
-                    # if chunk:
-                    f.write(chunk)
-                return f
+        f = TemporaryFile("w+b", dir=self.tmpdir)
+        try:
+            await stream_url_to_file(
+                url, f, max_bytes=max_bytes, directory=self.tmpdir
+            )
+        except BaseException:
+            f.close()
+            raise
+        f.seek(0)
+        return f
 
     # S3 Stuff Below this point
 
@@ -190,7 +340,7 @@ class S3FileManager:
     async def generate_local_filepath_from_hash_async(
         self, hash: str, ensure_network: bool = True, download_local: bool = True
     ) -> Optional[Path]:
-        return await asyncio.to_thread(
+        return await run_in_s3_executor(
             self.generate_local_filepath_from_hash, hash, ensure_network, download_local
         )
 
@@ -209,11 +359,18 @@ class S3FileManager:
         s3_hash_name = self.s3_raw_directory + hash
         return self.download_s3_file_to_path(s3_hash_name, local_filepath)
 
+    async def generate_s3_uri_from_hash_async(
+        self, hash: str, upload_local: bool = True
+    ) -> Optional[str]:
+        return await run_in_s3_executor(
+            self.generate_s3_uri_from_hash, hash, upload_local
+        )
+
     def generate_s3_uri_from_hash(
         self, hash: str, upload_local: bool = True
     ) -> Optional[str]:
         fileid = self.hash_to_fileid(hash)
-        if self.does_file_exist_s3(fileid):
+        if self.does_hash_exist_s3(hash):
             return self.generate_s3_uri(fileid)
         if upload_local:
             local_filepath = self.get_default_filepath_from_hash(hash)
@@ -229,7 +386,9 @@ class S3FileManager:
         if file_path.is_file():
             raise Exception("File Already Present at Path, not downloading")
         try:
-            self.s3.download_file(bucket, file_name, str(file_path))
+            self.s3.download_file(
+                bucket, file_name, str(file_path), Config=s3_transfer_config
+            )
             return file_path
         except Exception as e:
             self.logger.error(
@@ -276,39 +435,131 @@ class S3FileManager:
         if bucket is None:
             bucket = self.bucket
 
+        # HEAD instead of GET, a GET starts sending the whole object just to say its there.
         try:
-            self.s3.get_object(
+            self.s3.head_object(
                 Bucket=bucket,
                 Key=key,
             )
             return True
-        except self.s3.exceptions.NoSuchKey:
-            return False
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            if error_code in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
 
     def does_hash_exist_s3(self, hash: str, bucket: Optional[str] = None) -> bool:
         if bucket is None:
             bucket = self.bucket
         fileid = self.hash_to_fileid(hash)
-        return self.does_file_exist_s3(fileid, bucket)
+        if bucket != self.bucket:
+            return self.does_file_exist_s3(fileid, bucket)
+        if hash in known_s3_raw_hashes:
+            return True
+        try:
+            if s3_known_hash_exists(hash):
+                known_s3_raw_hashes.add(hash)
+                return True
+        except Exception as e:
+            self.logger.error(f"Unable to check the known hash index for {hash}: {e}")
+        if self.does_file_exist_s3(fileid, bucket):
+            self.mark_hash_known_s3(hash)
+            return True
+        return False
 
-    def download_file_to_file_in_tmpdir(
-        self, url: str
-    ) -> Any:  # TODO : Get types for temporary file
+    def mark_hash_known_s3(self, hash: str) -> None:
+        known_s3_raw_hashes.add(hash)
+        try:
+            s3_known_hashes_add([hash])
+        except Exception as e:
+            self.logger.error(f"Unable to add {hash} to the known hash index: {e}")
+
+    def warm_known_hashes_s3(self) -> int:
+        # One paginated listing of raw/ into the shared index, returns how many hashes it found.
+        paginator = self.s3.get_paginator("list_objects_v2")
+        count = 0
+        for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=self.s3_raw_directory
+        ):
+            hashes = [
+                obj["Key"][len(self.s3_raw_directory) :]
+                for obj in page.get("Contents", [])
+            ]
+            hashes = [hash for hash in hashes if hash != ""]
+            s3_known_hashes_add(hashes)
+            count += len(hashes)
+        return count
+
+    async def download_file_to_file_in_tmpdir(self, url: str) -> Path:
         savedir = self.tmpdir / Path(rand_string())
-        return self.download_file_to_path(url, savedir)
+        return await self.download_file_to_path(url, savedir)
 
     def push_file_to_s3(
         self, filepath: Path, file_upload_name: str, bucket: Optional[str] = None
     ) -> str:
         if bucket is None:
             bucket = self.bucket
-        return self.s3.upload_file(str(filepath), bucket, file_upload_name)
+        return self.s3.upload_file(
+            str(filepath), bucket, file_upload_name, Config=s3_transfer_config
+        )
+
+    def checkpoint_text_key(self, hash: str, lang: str, is_original_text: bool) -> str:
+        kind = "original" if is_original_text else "english"
+        return f"{self.s3_checkpoint_directory}{hash}/{kind}_{lang}.md"
+
+    async def push_text_to_s3_async(
+        self, text: str, file_upload_name: str, bucket: Optional[str] = None
+    ) -> str:
+        return await run_in_s3_executor(
+            self.push_text_to_s3, text, file_upload_name, bucket
+        )
+
+    def push_text_to_s3(
+        self, text: str, file_upload_name: str, bucket: Optional[str] = None
+    ) -> str:
+        if bucket is None:
+            bucket = self.bucket
+        self.s3.put_object(
+            Bucket=bucket,
+            Key=file_upload_name,
+            Body=text.encode("utf-8"),
+            ContentType="text/markdown; charset=utf-8",
+        )
+        return file_upload_name
+
+    async def download_text_from_s3_async(
+        self, file_name: str, bucket: Optional[str] = None
+    ) -> Optional[str]:
+        return await run_in_s3_executor(self.download_text_from_s3, file_name, bucket)
+
+    def download_text_from_s3(
+        self, file_name: str, bucket: Optional[str] = None
+    ) -> Optional[str]:
+        if bucket is None:
+            bucket = self.bucket
+        try:
+            response = self.s3.get_object(Bucket=bucket, Key=file_name)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return response["Body"].read().decode("utf-8")
 
     def push_raw_file_to_s3_novalid(self, filepath: Path, hash: str) -> str:
         if not filepath.is_file():
             raise Exception("File does not exist")
         filename = self.hash_to_fileid(hash)
-        return self.push_file_to_s3(filepath, filename)
+        result = self.push_file_to_s3(filepath, filename)
+        self.mark_hash_known_s3(hash)
+        return result
+
+    def push_raw_file_to_s3_known_hash(
+        self, filepath: Path, hash: str
+    ) -> Tuple[bool, str]:
+        # For files hashed on the way in, skips reading the whole file again just to check the hash.
+        if not filepath.is_file():
+            raise Exception("File does not exist")
+        if not self.does_hash_exist_s3(hash):
+            return False, self.push_raw_file_to_s3_novalid(filepath, hash)
+        return True, self.hash_to_fileid(hash)
 
     def push_raw_file_to_s3(
         self, filepath: Path, hash: Optional[str] = None
@@ -17,6 +17,8 @@ import asyncio
 
 from pydantic import BaseModel
 
+from common.task_trace import trace_span
+
 from constants import (
     MARKER_MAX_POLLS,
     MARKER_SECONDS_PER_POLL,
@@ -146,31 +148,36 @@ class GPUComputeEndpoint:
             data = {"s3_url": s3_uri}
             logger.info(data)
             # data = {"langs": "en", "force_ocr": "false", "paginate": "true"}
-            async with aiohttp.ClientSession() as session:
-                async with session.post(marker_url_endpoint, json=data) as response:
-                    response_data = await response.json()
-                    # await the json if async
-                    request_check_url_leaf = response_data.get("request_check_url_leaf")
+            # Marker only reports "processing" while polling, so waiting in its queue and the OCR itself both count as marker_wait.
+            with trace_span("marker_submit"):
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(marker_url_endpoint, json=data) as response:
+                        response_data = await response.json()
+                        # await the json if async
+                        request_check_url_leaf = response_data.get(
+                            "request_check_url_leaf"
+                        )
 
-                    if request_check_url_leaf is None:
-                        raise Exception(
-                            "Failed to get request_check_url from marker API response"
+                        if request_check_url_leaf is None:
+                            raise Exception(
+                                "Failed to get request_check_url from marker API response"
+                            )
+                        request_check_url = base_url + request_check_url_leaf
+                        self.logger.info(
+                            f"Got response from marker server, polling to see when file is finished processing at url: {request_check_url}"
                         )
-                    request_check_url = base_url + request_check_url_leaf
-                    self.logger.info(
-                        f"Got response from marker server, polling to see when file is finished processing at url: {request_check_url}"
-                    )
             assert (
                 MARKER_MAX_POLLS is not None
             ), "MARKER_MAX_POLLS is None, consider defining it!"
             assert (
                 MARKER_SECONDS_PER_POLL is not None
             ), "MARKER_SECONDS_PER_POLL is None, consider defining it!"
-            return await self.pull_marker_endpoint_for_response(
-                request_check_url=request_check_url,
-                max_polls=MARKER_MAX_POLLS,
-                poll_wait=3 + (MARKER_SECONDS_PER_POLL - 3) * int(not priority),
-            )
+            with trace_span("marker_wait"):
+                return await self.pull_marker_endpoint_for_response(
+                    request_check_url=request_check_url,
+                    max_polls=MARKER_MAX_POLLS,
+                    poll_wait=3 + (MARKER_SECONDS_PER_POLL - 3) * int(not priority),
+                )
 
     # Commenting out, we should never need  to use datalab.
     # async def transcribe_pdf_filepath(
@@ -8,39 +8,905 @@
 # REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS = "docproc_currently_processing_docs"
 from pymilvus.client import re
 from constants import (
+    DAEMON_STATE_REFRESH_SECONDS,
+    DOCPROC_CHECKPOINT_TTL_SECONDS,
+    DOCPROC_DEAD_LETTER_SCAN_BATCH,
+    DOCPROC_TASK_INDEX_SCAN_BATCH,
+    DOCPROC_TASK_TRACE_MAX_SPANS,
+    DOCPROC_TASK_TRACE_TTL_SECONDS,
+    DOCPROC_TIMING_SAMPLES_PER_SPAN,
+    DOCPROC_DEDUP_CLAIM_GRACE_SECONDS,
+    DOCPROC_IDEMPOTENCY_RETENTION_SECONDS,
+    DOCPROC_PRIORITY_LEVELS,
+    DOCPROC_QUEUE_LEASE_SECONDS,
+    DOCPROC_TASK_EVENTS_MAX_WAITERS,
+    DOCPROC_TASK_EVENTS_MAXLEN,
+    DOCPROC_TASK_EVENTS_PER_TASK_MAXLEN,
+    DOCPROC_TASK_EVENTS_TTL_SECONDS,
+    DOCPROC_SEMAPHORE_LEASE_SECONDS,
+    REDIS_DOCPROC_CHECKPOINT_PREFIX,
+    REDIS_DOCPROC_CLUSTER_SEMAPHORE,
+    REDIS_DOCPROC_DEAD_LETTER_INDEX,
+    REDIS_DOCPROC_DEAD_LETTER_TASKS,
+    REDIS_DOCPROC_DEAD_LETTERS,
+    REDIS_DOCPROC_DEDUP_CLAIMS,
+    REDIS_DOCPROC_DEDUP_INDEX,
+    REDIS_DOCPROC_HASH_REGISTRY,
+    REDIS_DOCPROC_IDEMPOTENCY_PREFIX,
+    REDIS_DOCPROC_PROCESSING_LEASES,
+    REDIS_DOCPROC_PROCESSING_ORIGINS,
+    REDIS_DOCPROC_PROCESSING_PAYLOADS,
+    REDIS_DOCPROC_QUEUE_DOORBELL,
+    REDIS_DOCPROC_QUEUE_ENQUEUED_AT,
     REDIS_DOCPROC_QUEUE_KEY,
-    REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS,
+    REDIS_DOCPROC_QUEUE_MIGRATION_LOCK,
+    REDIS_DOCPROC_QUEUE_SCHEDULER,
+    REDIS_DOCPROC_RETRY_DRAIN_LOCK,
+    REDIS_DOCPROC_RETRY_SCHEDULE,
+    REDIS_DOCPROC_TASK_EVENTS,
+    REDIS_DOCPROC_TASK_INDEX_PREFIX,
+    REDIS_DOCPROC_TASK_INDEX_STATUS,
+    REDIS_DOCPROC_TASK_TRACE_PREFIX,
+    REDIS_DOCPROC_TIMING_SAMPLE_KEYS,
+    REDIS_DOCPROC_TIMING_SAMPLES_PREFIX,
     REDIS_HOST,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_MAIN_PROCESS_LOOP_CONFIG,
+    REDIS_MAIN_PROCESS_LOOP_CONFIG_CHANNEL,
     REDIS_PORT,
     REDIS_DOCPROC_PRIORITYQUEUE_KEY,
+    REDIS_S3_KNOWN_HASHES,
+    REDIS_S3_KNOWN_HASHES_WARM_CLAIM,
+    S3_KNOWN_HASHES_REWARM_SECONDS,
 )
-from typing import Any, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import redis
+import redis.asyncio as aioredis
 import logging
+import time
+import asyncio
 from uuid import UUID
-from common.task_schema import Task
+from common.file_schemas import CompleteFileSchema, DocProcCheckpoint, HashRegistryEntry
+from common.task_schema import (
+    DeadLetter,
+    DeadLetterFilter,
+    ScraperInfo,
+    Task,
+    TaskEvent,
+    TaskEventType,
+    TaskStage,
+    TaskStatus,
+    TaskSummary,
+    TaskType,
+    dead_letter_error_group,
+    dead_letter_matches,
+    task_stage,
+    task_status,
+    task_summary,
+    task_validate_object,
+)
+from common.task_trace import TaskTrace, TimingPercentiles, TraceSpan, timing_percentiles
+from daemon_state import DaemonState
 
 from datetime import datetime
 
 
-# TODO : Mabye asycnify all the redis calls
-
-default_redis_client = redis.Redis(
-    host=REDIS_HOST, port=REDIS_PORT, decode_responses=True
+# One pool per process, shared by the daemon loops and the controllers. Connections are only
+# opened on first use, so every uvicorn worker ends up with its own pool on its own event loop.
+# The blocking pool makes callers wait for a free connection instead of erroring when it runs dry.
+default_redis_client = aioredis.Redis(
+    connection_pool=aioredis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=20,
+    )
+)
+# Blocking event reads sit on their connection for up to DOCPROC_TASK_EVENTS_MAX_BLOCK_SECONDS, so
+# they get a pool of their own and a crowd of watchers cant starve the daemon loops of connections.
+task_events_redis_client = aioredis.Redis(
+    connection_pool=aioredis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        decode_responses=True,
+        max_connections=DOCPROC_TASK_EVENTS_MAX_WAITERS,
+        timeout=20,
+    )
+)
+# The S3 code is sync and runs in threads, where the async pool cant be used, so it gets a small pool of its own.
+default_sync_redis_client = redis.Redis(
+    connection_pool=redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=20,
+    )
 )
 default_logger = logging.getLogger(__name__)
 
+TASK_RECORD_TTL_SECONDS = 60 * 60
+
+
+def stage_queue_keys(stage: TaskStage) -> List[str]:
+    # One list per priority level, highest first. Fetch keeps the original list names so everything queued before the stages existed still gets picked up.
+    keys = (
+        [REDIS_DOCPROC_PRIORITYQUEUE_KEY]
+        + [
+            f"{REDIS_DOCPROC_QUEUE_KEY}_level{level}"
+            for level in range(1, DOCPROC_PRIORITY_LEVELS - 1)
+        ]
+        + [REDIS_DOCPROC_QUEUE_KEY]
+    )
+    if stage == TaskStage.fetch:
+        return keys
+    return [f"{key}:{stage.value}" for key in keys]
+
+
+def stage_scheduler_key(stage: TaskStage) -> str:
+    return f"{REDIS_DOCPROC_QUEUE_SCHEDULER}:{stage.value}"
+
+
+def task_priority_level(task: Task) -> int:
+    if task.priority_level is not None:
+        return min(max(task.priority_level, 0), DOCPROC_PRIORITY_LEVELS - 1)
+    if task.priority:
+        return 0
+    return DOCPROC_PRIORITY_LEVELS - 1
+
+
+def task_fair_share_key(task: Task) -> str:
+    # Tasks from the same source, state and docket share a sub queue inside their level, the scheduler
+    # rotates between sub queues so one huge docket cant hold up everything queued behind it.
+    obj = task_validate_object(task.model_copy()).obj
+    if isinstance(obj, ScraperInfo):
+        parts = [obj.internal_source_name, obj.state, obj.docket_id]
+    elif isinstance(obj, CompleteFileSchema):
+        parts = [
+            str(obj.mdata.get("source", "")),
+            obj.conversation.state,
+            obj.conversation.docket_id,
+        ]
+    else:
+        return ""
+    # '#' separates the level from the key in sub queue names.
+    parts = [part.strip().lower().replace("#", "") for part in parts]
+    if all(part == "" for part in parts):
+        return ""
+    return "/".join(parts)
+
+
+def fair_share_list_key(level_key: str, fair_share_key: str) -> str:
+    # Tasks without a key, and everything queued before sub queues existed, stay on the level list itself.
+    if fair_share_key == "":
+        return level_key
+    return f"{level_key}#{fair_share_key}"
+
+
+def fair_share_active_key(level_key: str) -> str:
+    # Sub queues of a level with work in them, scored by when they are next due to be served.
+    return f"{level_key}:active"
+
+
+def scheduler_weights(weights: Optional[List[int]]) -> List[int]:
+    # One weight per level, a config written for a different number of levels is padded with 1s, and a level is never weighted out completely.
+    if weights is None:
+        weights = []
+    weights = list(weights[:DOCPROC_PRIORITY_LEVELS])
+    weights += [1] * (DOCPROC_PRIORITY_LEVELS - len(weights))
+    return [max(int(weight), 1) for weight in weights]
+
+
+def stage_semaphore_key(stage: TaskStage) -> str:
+    return f"{REDIS_DOCPROC_CLUSTER_SEMAPHORE}:{stage.value}"
+
+
+def stage_doorbell_key(stage: TaskStage) -> str:
+    return f"{REDIS_DOCPROC_QUEUE_DOORBELL}:{stage.value}"
+
+
+# The queue lists only hold task ids, the payload lives once under the task id (the same record
+# task_get reads). Lists written before this change still hold whole Task json blobs, every pop
+# and migrate_legacy_queue_entries turn those into a record plus an id as they come across them.
+# Lua snippet shared by the scripts below, converts a legacy blob into its id and makes sure the
+# record is there and wont expire while the task is waiting.
+_legacy_entry_lua = """
+    local function entry_to_id(entry)
+        if string.sub(entry, 1, 1) ~= '{' then
+            return entry
+        end
+        local ok, decoded = pcall(cjson.decode, entry)
+        if not ok or type(decoded) ~= 'table' or type(decoded['id']) ~= 'string' then
+            return nil
+        end
+        if not redis.call('SET', decoded['id'], entry, 'NX') then
+            redis.call('PERSIST', decoded['id'])
+        end
+        return decoded['id']
+    end
+"""
+
+
+async def task_pop_from_queue(redis_client: Optional[Any] = None) -> Optional[Task]:
+    tasks = await task_pop_batch_from_queue(
+        1, reliable=False, redis_client=redis_client
+    )
+    if len(tasks) == 0:
+        return None
+    return tasks[0]
+
+
+async def task_pop_batch_from_queue_blocking(
+    timeout: float,
+    count: int,
+    stage: TaskStage = TaskStage.fetch,
+    weights: Optional[List[int]] = None,
+    aging_seconds: float = 0,
+    redis_client: Optional[Any] = None,
+) -> List[Task]:
+    # Pops through the scheduler script, and only when it finds every level empty waits up to timeout seconds
+    # on the stage doorbell BLPOP for the next push. Only the pooled connection waits, the event loop keeps running.
+    if redis_client is None:
+        redis_client = default_redis_client
+    tasks = await task_pop_batch_from_queue(
+        count,
+        stage=stage,
+        reliable=False,
+        weights=weights,
+        aging_seconds=aging_seconds,
+        redis_client=redis_client,
+    )
+    if len(tasks) > 0:
+        return tasks
+    # The work is spread over fair share sub queues no single blocking pop can watch, so wait for a push to ring the doorbell and run the script once more.
+    if not await wait_for_queue_doorbell(timeout, stage=stage, redis_client=redis_client):
+        return []
+    return await task_pop_batch_from_queue(
+        count,
+        stage=stage,
+        reliable=False,
+        weights=weights,
+        aging_seconds=aging_seconds,
+        redis_client=redis_client,
+    )
+
+
+# Shared by the semaphore and the reliable queue, pushes the deadline of an existing lease forward.
+_lease_renew_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    return redis.call('ZADD', KEYS[1], 'XX', 'CH', now + tonumber(ARGV[2]), ARGV[1])
+    """
+)
+
+# Batch pop and scheduler. KEYS[6..] are the priority levels of one stage, highest first. Every
+# level is split into fair share sub queues (see task_fair_share_key), the level list itself is
+# the sub queue for tasks without a key. Which sub queues have work, and when each is next due,
+# is kept in a sorted set next to the level.
+# First the heads of the lower levels that have waited longer than ARGV[4] seconds (per KEYS[4])
+# are moved up one level, with their clock reset, so a task climbs one level per aging period.
+# Then up to ARGV[2] ids are taken with smooth weighted round robin over the non empty levels,
+# using the weights in ARGV[5..] and the running credit kept in KEYS[5]. A busy top level gets
+# most pops but never all of them, and an empty level doesnt bank credit while it waits.
+# Inside a level the sub queues are served round robin: the one due soonest gives up one task and
+# goes to the back of the round. A new sub queue comes in due right away, so a small docket gets
+# its first task out on the next pop no matter how big the dockets ahead of it are.
+# With ARGV[3] set this is the reliable queue: every popped id is moved into a lease sorted set
+# scored by the lease deadline and the list it came from is kept next to it, so the reaper can
+# put it back exactly where it was if the worker never acks it. Without it the record gets the lease
+# length as its TTL instead, so a task lost with its worker doesnt keep its record, or its dedup
+# claim, forever.
+_batch_pop_script = default_redis_client.register_script(
+    _legacy_entry_lua
+    + """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local remaining = tonumber(ARGV[2])
+    local leased = ARGV[3] == '1'
+    local aging = tonumber(ARGV[4])
+    local levels = #KEYS - 5
+    local function active_key(level)
+        return KEYS[5 + level] .. ':active'
+    end
+    local function sub_queue(level, member)
+        if member == '' then
+            return KEYS[5 + level]
+        end
+        return KEYS[5 + level] .. '#' .. member
+    end
+    local function level_has_work(level)
+        -- The level list is only registered lazily, it still holds everything queued before sub queues.
+        if redis.call('LLEN', KEYS[5 + level]) > 0 then
+            redis.call('ZADD', active_key(level), 'NX', 0, '')
+            return true
+        end
+        return redis.call('ZCARD', active_key(level)) > 0
+    end
+    if aging > 0 then
+        -- Bounded so a big backlog ages over several pops instead of in one long script.
+        local promoted = 0
+        for level = 2, levels do
+            level_has_work(level)
+            for _, member in ipairs(redis.call('ZRANGE', active_key(level), 0, 99)) do
+                local key = sub_queue(level, member)
+                while promoted < 100 do
+                    local entry = redis.call('LINDEX', key, 0)
+                    if not entry then
+                        break
+                    end
+                    local id = entry_to_id(entry)
+                    if id then
+                        local queued_at = redis.call('HGET', KEYS[4], id)
+                        if not queued_at then
+                            -- Requeued by the reaper or pushed before aging existed, start its clock now.
+                            redis.call('HSET', KEYS[4], id, now)
+                            break
+                        end
+                        if tonumber(queued_at) > now - aging then
+                            break
+                        end
+                    end
+                    redis.call('LPOP', key)
+                    if id then
+                        redis.call('RPUSH', sub_queue(level - 1, member), id)
+                        redis.call('ZADD', active_key(level - 1), 'NX', 0, member)
+                        redis.call('HSET', KEYS[4], id, now)
+                        promoted = promoted + 1
+                    end
+                end
+                if redis.call('LLEN', key) == 0 then
+                    redis.call('ZREM', active_key(level), member)
+                end
+            end
+        end
+    end
+    local function pop_from_level(level)
+        local active = active_key(level)
+        local round = tonumber(redis.call('HGET', KEYS[5], 'round' .. level) or '0')
+        while true do
+            local due = redis.call('ZRANGE', active, 0, 0, 'WITHSCORES')
+            if #due == 0 then
+                return nil, nil
+            end
+            local member = due[1]
+            local key = sub_queue(level, member)
+            local entry = redis.call('LPOP', key)
+            if entry then
+                round = math.max(round, tonumber(due[2]))
+                redis.call('HSET', KEYS[5], 'round' .. level, round)
+                if redis.call('LLEN', key) == 0 then
+                    redis.call('ZREM', active, member)
+                else
+                    redis.call('ZADD', active, round + 1, member)
+                end
+                return entry, key
+            end
+            redis.call('ZREM', active, member)
+        end
+    end
+    local weights = {}
+    local credit = {}
+    for level = 1, levels do
+        weights[level] = tonumber(ARGV[4 + level]) or 1
+        credit[level] = tonumber(redis.call('HGET', KEYS[5], level) or '0')
+    end
+    local popped = {}
+    while remaining > 0 do
+        local best = nil
+        local total = 0
+        for level = 1, levels do
+            if level_has_work(level) then
+                credit[level] = credit[level] + weights[level]
+                total = total + weights[level]
+                if best == nil or credit[level] > credit[best] then
+                    best = level
+                end
+            end
+        end
+        if best == nil then
+            break
+        end
+        credit[best] = credit[best] - total
+        remaining = remaining - 1
+        local entry, origin = pop_from_level(best)
+        local id = entry and entry_to_id(entry)
+        if id then
+            redis.call('HDEL', KEYS[4], id)
+            local payload = redis.call('GET', id)
+            if payload then
+                if leased then
+                    redis.call('ZADD', KEYS[1], now + tonumber(ARGV[1]), id)
+                    redis.call('HSET', KEYS[3], id, origin)
+                else
+                    -- No lease to reap, the record expires instead unless the worker keeps renewing it.
+                    redis.call('EXPIRE', id, tonumber(ARGV[1]))
+                end
+                table.insert(popped, payload)
+            end
+        end
+    end
+    for level = 1, levels do
+        redis.call('HSET', KEYS[5], level, credit[level])
+    end
+    return popped
+    """
+)
 
-def task_pop_from_queue(redis_client: Optional[Any] = None) -> Optional[Task]:
+# Puts leased task ids back on the front of the list they were popped from. With ARGV[2] set only
+# that task is returned, otherwise up to ARGV[1] leases past their deadline are. Leases taken
+# before the queue held ids kept their payload in KEYS[2], that is turned back into a record.
+# Origins are sub queues, so the sub queue is also put back in its levels rotation. Returned ids get
+# a fresh KEYS[4] entry so aging and the dedup liveness check see them as queued again. The
+# doorbells in KEYS[5..] are all rung since the origin list can belong to any stage.
+# Returns the ids that went back on a queue.
+_lease_return_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local ids
+    if ARGV[2] and ARGV[2] ~= '' then
+        ids = {ARGV[2]}
+    else
+        ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+    end
+    local returned = {}
+    for _, id in ipairs(ids) do
+        local legacy_payload = redis.call('HGET', KEYS[2], id)
+        if legacy_payload then
+            redis.call('SET', id, legacy_payload)
+        end
+        local origin = redis.call('HGET', KEYS[3], id)
+        if origin then
+            redis.call('PERSIST', id)
+            redis.call('LPUSH', origin, id)
+            redis.call('HSET', KEYS[4], id, now)
+            -- Put the sub queue back in the rotation, it may have been emptied by this pop.
+            local level_key, member = string.match(origin, '^([^#]*)#(.*)$')
+            if not level_key then
+                level_key = origin
+                member = ''
+            end
+            redis.call('ZADD', level_key .. ':active', 'NX', 0, member)
+            for i = 5, #KEYS do
+                redis.call('RPUSH', KEYS[i], '1')
+            end
+            table.insert(returned, id)
+        end
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('HDEL', KEYS[2], id)
+        redis.call('HDEL', KEYS[3], id)
+    end
+    return returned
+    """
+)
+
+# Rotates ARGV[1] entries from the head of the list to its tail, converting legacy blobs on the
+# way. Rotating the whole length of the list leaves it in its original order.
+_migrate_entries_script = default_redis_client.register_script(
+    _legacy_entry_lua
+    + """
+    local converted = 0
+    for i = 1, tonumber(ARGV[1]) do
+        local entry = redis.call('LPOP', KEYS[1])
+        if not entry then
+            break
+        end
+        local id = entry_to_id(entry)
+        if id then
+            if id ~= entry then
+                converted = converted + 1
+            end
+            redis.call('RPUSH', KEYS[1], id)
+        end
+    end
+    return converted
+    """
+)
+
+_lease_keys = [
+    REDIS_DOCPROC_PROCESSING_LEASES,
+    REDIS_DOCPROC_PROCESSING_PAYLOADS,
+    REDIS_DOCPROC_PROCESSING_ORIGINS,
+]
+_all_doorbell_keys = [stage_doorbell_key(stage) for stage in TaskStage]
+
+
+async def task_pop_batch_from_queue(
+    count: int,
+    stage: TaskStage = TaskStage.fetch,
+    reliable: bool = True,
+    lease_seconds: int = DOCPROC_QUEUE_LEASE_SECONDS,
+    weights: Optional[List[int]] = None,
+    aging_seconds: float = 0,
+    redis_client: Optional[Any] = None,
+) -> List[Task]:
+    # Fills up to count free slots in one round trip, leasing every task when reliable is set.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    if count <= 0:
+        return []
+    request_strings = await _batch_pop_script(
+        keys=_lease_keys
+        + [REDIS_DOCPROC_QUEUE_ENQUEUED_AT, stage_scheduler_key(stage)]
+        + stage_queue_keys(stage),
+        args=[lease_seconds, count, 1 if reliable else 0, aging_seconds]
+        + scheduler_weights(weights),
+        client=redis_client,
+    )
+    tasks = []
+    for request_string in request_strings:
+        task = parse_task_string(request_string, logger=logger)
+        if task is not None:
+            tasks.append(task)
+    if len(tasks) > 0:
+        pipe = redis_client.pipeline(transaction=False)
+        for task in tasks:
+            add_task_index_to_pipeline(pipe, task.id, TaskStatus.running, task.task_type)
+        await pipe.execute()
+    return tasks
+
+
+async def migrate_legacy_queue_entries(
+    chunk_size: int = 500, redis_client: Optional[Any] = None
+) -> int:
+    # One pass over both lists replacing json blobs with ids. Only one worker in the cluster runs it at a time, the pops handle any blob it doesnt get to.
     logger = default_logger
     if redis_client is None:
         redis_client = default_redis_client
-    # TODO : Clean up code logic
-    request_string = redis_client.lpop(REDIS_DOCPROC_PRIORITYQUEUE_KEY)
-    if request_string is None:
-        request_string = redis_client.lpop(REDIS_DOCPROC_QUEUE_KEY)
-    if request_string is None:
+    if not await redis_client.set(
+        REDIS_DOCPROC_QUEUE_MIGRATION_LOCK, "1", nx=True, ex=60 * 10
+    ):
+        return 0
+    converted = 0
+    try:
+        # Only the original lists, the ones that existed before tasks were queued by id.
+        for queue_key in stage_queue_keys(TaskStage.fetch):
+            length = int(await redis_client.llen(queue_key))
+            for offset in range(0, length, chunk_size):
+                converted += int(
+                    await _migrate_entries_script(
+                        keys=[queue_key],
+                        args=[min(chunk_size, length - offset)],
+                        client=redis_client,
+                    )
+                )
+    finally:
+        await redis_client.delete(REDIS_DOCPROC_QUEUE_MIGRATION_LOCK)
+    if converted > 0:
+        logger.info(f"Migrated {converted} queued task payloads to id entries")
+    return converted
+
+
+async def task_lease_renew(
+    task_id: UUID,
+    lease_seconds: int = DOCPROC_QUEUE_LEASE_SECONDS,
+    redis_client: Optional[Any] = None,
+) -> bool:
+    if redis_client is None:
+        redis_client = default_redis_client
+    renewed = await _lease_renew_script(
+        keys=[REDIS_DOCPROC_PROCESSING_LEASES],
+        args=[str(task_id), lease_seconds],
+        client=redis_client,
+    )
+    # Tasks popped without a lease carry it as the TTL on their record. GT only ever pushes an
+    # expiry out, so records without a TTL stay that way and finished ones keep their longer TTL.
+    await redis_client.expire(str(task_id), lease_seconds, gt=True)
+    return int(renewed) == 1
+
+
+async def task_lease_ack(task_id: UUID, redis_client: Optional[Any] = None) -> None:
+    if redis_client is None:
+        redis_client = default_redis_client
+    string_id = str(task_id)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.zrem(REDIS_DOCPROC_PROCESSING_LEASES, string_id)
+    pipe.hdel(REDIS_DOCPROC_PROCESSING_PAYLOADS, string_id)
+    pipe.hdel(REDIS_DOCPROC_PROCESSING_ORIGINS, string_id)
+    await pipe.execute()
+
+
+async def task_lease_return(task_id: UUID, redis_client: Optional[Any] = None) -> bool:
+    # Gives a leased task back to its queue right away, for when a worker knows it cant finish it.
+    if redis_client is None:
+        redis_client = default_redis_client
+    returned = await _lease_return_script(
+        keys=_lease_keys + [REDIS_DOCPROC_QUEUE_ENQUEUED_AT] + _all_doorbell_keys,
+        args=[1, str(task_id)],
+        client=redis_client,
+    )
+    await mark_tasks_queued(returned, redis_client=redis_client)
+    return len(returned) == 1
+
+
+async def reap_expired_task_leases(
+    max_reaped: int = 1000, redis_client: Optional[Any] = None
+) -> int:
+    if redis_client is None:
+        redis_client = default_redis_client
+    returned = await _lease_return_script(
+        keys=_lease_keys + [REDIS_DOCPROC_QUEUE_ENQUEUED_AT] + _all_doorbell_keys,
+        args=[max_reaped, ""],
+        client=redis_client,
+    )
+    await mark_tasks_queued(returned, redis_client=redis_client)
+    return len(returned)
+
+
+async def mark_tasks_queued(task_ids: List[str], redis_client: Any) -> None:
+    if len(task_ids) == 0:
         return None
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in task_ids:
+        add_task_index_to_pipeline(pipe, task_id, TaskStatus.queued)
+    await pipe.execute()
+
+
+async def task_leased_count(redis_client: Optional[Any] = None) -> int:
+    if redis_client is None:
+        redis_client = default_redis_client
+    return int(await redis_client.zcard(REDIS_DOCPROC_PROCESSING_LEASES))
+
+
+def ring_queue_doorbell(pushed: int, pipe: Any, stage: TaskStage = TaskStage.fetch) -> None:
+    # Queued onto the callers pipeline so it goes out with the push. Capped so a long idle period doesnt leave thousands of stale wakeups behind.
+    doorbell_key = stage_doorbell_key(stage)
+    pipe.rpush(doorbell_key, *(["1"] * min(pushed, 64)))
+    pipe.ltrim(doorbell_key, -64, -1)
+
+
+async def wait_for_queue_doorbell(
+    timeout: float,
+    stage: TaskStage = TaskStage.fetch,
+    redis_client: Optional[Any] = None,
+) -> bool:
+    # Lua scripts cant block, so reliable mode waits here for a push before trying another pop.
+    if redis_client is None:
+        redis_client = default_redis_client
+    return (
+        await redis_client.blpop([stage_doorbell_key(stage)], timeout)
+    ) is not None
+
+
+def task_event_stream_key(task_id: Union[UUID, str]) -> str:
+    return f"{REDIS_DOCPROC_TASK_EVENTS}:{task_id}"
+
+
+def add_task_event_to_pipeline(
+    pipe: Any,
+    task_id: Union[UUID, str],
+    event: TaskEventType,
+    stage: Optional[TaskStage] = None,
+    detail: str = "",
+) -> None:
+    # Goes out with whatever the callers pipeline is doing, so an event is never published for a change that didnt happen.
+    fields = {
+        "task_id": str(task_id),
+        "event": event.value,
+        "stage": stage.value if stage is not None else "",
+        "detail": detail,
+        "at": datetime.now().isoformat(),
+    }
+    pipe.xadd(
+        REDIS_DOCPROC_TASK_EVENTS,
+        fields,
+        maxlen=DOCPROC_TASK_EVENTS_MAXLEN,
+        approximate=True,
+    )
+    task_stream_key = task_event_stream_key(task_id)
+    pipe.xadd(
+        task_stream_key,
+        fields,
+        maxlen=DOCPROC_TASK_EVENTS_PER_TASK_MAXLEN,
+        approximate=True,
+    )
+    pipe.expire(task_stream_key, DOCPROC_TASK_EVENTS_TTL_SECONDS)
+
+
+async def publish_task_event(
+    task_id: Union[UUID, str],
+    event: TaskEventType,
+    stage: Optional[TaskStage] = None,
+    detail: str = "",
+    redis_client: Optional[Any] = None,
+) -> None:
+    if redis_client is None:
+        redis_client = default_redis_client
+    pipe = redis_client.pipeline(transaction=False)
+    add_task_event_to_pipeline(pipe, task_id, event, stage=stage, detail=detail)
+    await pipe.execute()
+
+
+def task_index_key(
+    status: Optional[TaskStatus] = None, task_type: Optional[TaskType] = None
+) -> str:
+    if status is not None:
+        return f"{REDIS_DOCPROC_TASK_INDEX_PREFIX}:status:{status.value}"
+    if task_type is not None:
+        return f"{REDIS_DOCPROC_TASK_INDEX_PREFIX}:type:{task_type.value}"
+    return f"{REDIS_DOCPROC_TASK_INDEX_PREFIX}:all"
+
+
+def add_task_index_to_pipeline(
+    pipe: Any,
+    task_id: Union[UUID, str],
+    status: TaskStatus,
+    task_type: Optional[TaskType] = None,
+    updated_at: Optional[float] = None,
+) -> None:
+    # The lease scripts only hand back ids, so the type set is only moved forward when the caller knows the type.
+    if updated_at is None:
+        updated_at = time.time()
+    string_id = str(task_id)
+    for other_status in TaskStatus:
+        if other_status != status:
+            pipe.zrem(task_index_key(status=other_status), string_id)
+    pipe.zadd(task_index_key(status=status), {string_id: updated_at})
+    pipe.zadd(task_index_key(), {string_id: updated_at})
+    if task_type is not None:
+        pipe.zadd(task_index_key(task_type=task_type), {string_id: updated_at})
+    pipe.hset(REDIS_DOCPROC_TASK_INDEX_STATUS, string_id, status.value)
+
+
+def remove_task_index_from_pipeline(pipe: Any, task_ids: List[str]) -> None:
+    for status in TaskStatus:
+        pipe.zrem(task_index_key(status=status), *task_ids)
+    for task_type in TaskType:
+        pipe.zrem(task_index_key(task_type=task_type), *task_ids)
+    pipe.zrem(task_index_key(), *task_ids)
+    pipe.hdel(REDIS_DOCPROC_TASK_INDEX_STATUS, *task_ids)
+
+
+async def task_index_scan(
+    status: Optional[TaskStatus] = None,
+    task_type: Optional[TaskType] = None,
+    since: Optional[datetime] = None,
+    before: Optional[datetime] = None,
+    offset: int = 0,
+    limit: int = 100,
+    redis_client: Optional[Any] = None,
+) -> Tuple[List[TaskSummary], Optional[int]]:
+    # Most recently updated first. Walks the status set when filtering on both and checks the type on the records.
+    # Entries whose record has expired are dropped from the index as they are found.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    index_key = task_index_key(
+        status=status, task_type=task_type if status is None else None
+    )
+    maximum = before.timestamp() if before is not None else "+inf"
+    minimum = since.timestamp() if since is not None else "-inf"
+    summaries = []
+    stale_ids = []
+    position = offset
+    next_offset = None
+    while next_offset is None:
+        ids = await redis_client.zrevrangebyscore(
+            index_key,
+            maximum,
+            minimum,
+            start=position,
+            num=DOCPROC_TASK_INDEX_SCAN_BATCH,
+        )
+        if len(ids) == 0:
+            break
+        records = await redis_client.mget(ids)
+        statuses = await redis_client.hmget(REDIS_DOCPROC_TASK_INDEX_STATUS, ids)
+        for task_id, record, status_str in zip(ids, records, statuses):
+            position += 1
+            task = parse_task_string(record, logger=logger) if record is not None else None
+            if task is None:
+                stale_ids.append(task_id)
+                continue
+            if task_type is not None and task.task_type != task_type:
+                continue
+            indexed_status = None
+            if status_str is not None and status_str in TaskStatus.__members__:
+                indexed_status = TaskStatus(status_str)
+            summaries.append(task_summary(task, indexed_status))
+            if len(summaries) >= limit:
+                next_offset = position
+                break
+        if len(ids) < DOCPROC_TASK_INDEX_SCAN_BATCH:
+            break
+    if len(stale_ids) > 0:
+        pipe = redis_client.pipeline(transaction=False)
+        remove_task_index_from_pipeline(pipe, stale_ids)
+        await pipe.execute()
+        # Everything removed sat before the next offset, so the next page moves up by as much.
+        if next_offset is not None:
+            next_offset -= len(stale_ids)
+    return summaries, next_offset
+
+
+async def task_index_counts(
+    redis_client: Optional[Any] = None,
+) -> Dict[TaskStatus, int]:
+    if redis_client is None:
+        redis_client = default_redis_client
+    pipe = redis_client.pipeline(transaction=False)
+    for status in TaskStatus:
+        pipe.zcard(task_index_key(status=status))
+    return dict(zip(TaskStatus, await pipe.execute()))
+
+
+async def prune_task_index(
+    max_pruned: int = 1000, redis_client: Optional[Any] = None
+) -> int:
+    # Finished task records expire on their own, this drops their index entries once the records are gone.
+    if redis_client is None:
+        redis_client = default_redis_client
+    cutoff = time.time() - TASK_RECORD_TTL_SECONDS
+    pruned = 0
+    for status in [TaskStatus.completed, TaskStatus.failed]:
+        ids = await redis_client.zrangebyscore(
+            task_index_key(status=status), "-inf", cutoff, start=0, num=max_pruned
+        )
+        if len(ids) == 0:
+            continue
+        pipe = redis_client.pipeline(transaction=False)
+        for task_id in ids:
+            pipe.exists(task_id)
+        expired_ids = [
+            task_id for task_id, exists in zip(ids, await pipe.execute()) if not exists
+        ]
+        if len(expired_ids) == 0:
+            continue
+        pipe = redis_client.pipeline(transaction=False)
+        remove_task_index_from_pipeline(pipe, expired_ids)
+        await pipe.execute()
+        pruned += len(expired_ids)
+    return pruned
+
+
+async def read_task_events(
+    cursors: Dict[str, str],
+    block_seconds: float = 0,
+    count: int = 100,
+    redis_client: Optional[Any] = None,
+) -> List[TaskEvent]:
+    # cursors maps task ids to the last event id the caller has seen, "0" for everything still kept.
+    # With block_seconds set this waits until any of the tasks has a new event, one XREAD over all of them.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    if len(cursors) == 0:
+        return []
+    streams = {
+        task_event_stream_key(task_id): cursor for task_id, cursor in cursors.items()
+    }
+    result = await redis_client.xread(
+        streams,
+        count=count,
+        block=int(block_seconds * 1000) if block_seconds > 0 else None,
+    )
+    events = []
+    for _, entries in result or []:
+        for entry_id, fields in entries:
+            try:
+                events.append(
+                    TaskEvent(
+                        id=entry_id,
+                        task_id=fields["task_id"],
+                        event=fields["event"],
+                        stage=fields.get("stage") or None,
+                        detail=fields.get("detail", ""),
+                        at=fields["at"],
+                    )
+                )
+            except Exception as e:
+                logger.error(f"Skipping malformed task event {entry_id}: {e}")
+    return events
+
+
+def parse_task_string(
+    request_string: str, logger: Optional[Any] = None
+) -> Optional[Task]:
+    if logger is None:
+        logger = default_logger
     try:
         obj = Task.model_validate_json(request_string)
     except Exception as e:
@@ -50,47 +916,496 @@ def task_pop_from_queue(redis_client: Optional[Any] = None) -> Optional[Task]:
     return obj
 
 
-def task_push_to_queue(
-    task: Task, redis_client: Optional[Any] = None, push_to_front: bool = False
+def task_queue_key(task: Task) -> str:
+    return stage_queue_keys(task_stage(task))[task_priority_level(task)]
+
+
+def task_dedup_keys(task: Task) -> List[str]:
+    # A file url or hash can only be held by one queued or running task of each type at a time.
+    obj = task_validate_object(task.model_copy()).obj
+    if isinstance(obj, ScraperInfo):
+        url, file_hash = obj.file_url, obj.hash
+    elif isinstance(obj, CompleteFileSchema):
+        url, file_hash = str(obj.mdata.get("url", "")), obj.hash
+    else:
+        return []
+    keys = []
+    if url.strip() != "":
+        keys.append(f"{task.task_type.value}:url:{url.strip()}")
+    if file_hash.strip() != "":
+        keys.append(f"{task.task_type.value}:hash:{file_hash.strip()}")
+    return keys
+
+
+# Claims the dedup index entries for a batch of tasks. ARGV[1] is the grace period, ARGV[2] the
+# idempotency key ('' for none) and ARGV[3] its retention, then every task is its id, the number of
+# keys and the keys. If the idempotency key is already stored the stored ids come back after 'replay'
+# and nothing is claimed. Otherwise 'new' comes first, then a task whose keys are all free, or held by
+# a task that is no longer live or is itself, takes them all and gets '' back, otherwise it gets the
+# id of the task already holding one, and the ids the batch ended up with are stored under the key. A finished holder never is, otherwise it is live while it sits on a queue (KEYS[3]), holds a lease
+# (KEYS[4]) or waits on a retry (KEYS[5]). Tasks popped without a lease have their record on a TTL
+# that the worker keeps renewing, so an unfinished record with a TTL is a running task and one lost
+# with its worker lets go once the TTL runs out. A claim younger than the grace period is live too,
+# the pusher queues the task right after claiming. Tasks earlier in the same batch count as live.
+_dedup_claim_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local grace = tonumber(ARGV[1])
+    local idempotency_key = ARGV[2]
+    if idempotency_key ~= '' then
+        local stored = redis.call('GET', idempotency_key)
+        if stored then
+            local ok, decoded = pcall(cjson.decode, stored)
+            if ok and type(decoded) == 'table' then
+                table.insert(decoded, 1, 'replay')
+                return decoded
+            end
+        end
+    end
+    local function holder_is_live(holder)
+        local record = redis.call('GET', holder)
+        if record then
+            local ok, decoded = pcall(cjson.decode, record)
+            if ok and type(decoded) == 'table' and decoded['completed'] == true then
+                return false
+            end
+        end
+        if redis.call('HEXISTS', KEYS[3], holder) == 1
+            or redis.call('ZSCORE', KEYS[4], holder)
+            or redis.call('ZSCORE', KEYS[5], holder) then
+            return true
+        end
+        if record and redis.call('PTTL', holder) > 0 then
+            return true
+        end
+        local claim = redis.call('HGET', KEYS[2], holder)
+        if not claim then
+            return false
+        end
+        local ok, decoded = pcall(cjson.decode, claim)
+        return ok and type(decoded) == 'table' and tonumber(decoded['claimed_at']) > now - grace
+    end
+    local claimed = {}
+    local results = {'new'}
+    local final_ids = {}
+    local i = 4
+    while i <= #ARGV do
+        local id = ARGV[i]
+        local keys = {}
+        for j = 1, tonumber(ARGV[i + 1]) do
+            keys[j] = ARGV[i + 1 + j]
+        end
+        i = i + 2 + #keys
+        local existing = nil
+        for _, key in ipairs(keys) do
+            local holder = redis.call('HGET', KEYS[1], key)
+            if holder and holder ~= id and (claimed[holder] or holder_is_live(holder)) then
+                existing = holder
+                break
+            end
+        end
+        if existing then
+            table.insert(results, existing)
+            table.insert(final_ids, existing)
+        else
+            if #keys > 0 then
+                for _, key in ipairs(keys) do
+                    redis.call('HSET', KEYS[1], key, id)
+                end
+                redis.call('HSET', KEYS[2], id, cjson.encode({keys = keys, claimed_at = now}))
+                claimed[id] = true
+            end
+            table.insert(results, '')
+            table.insert(final_ids, id)
+        end
+    end
+    if idempotency_key ~= '' then
+        redis.call('SET', idempotency_key, cjson.encode(final_ids), 'EX', tonumber(ARGV[3]))
+    end
+    return results
+    """
+)
+
+# Drops the index entries ARGV[1] claimed, skipping any that another task has taken over since.
+_dedup_release_script = default_redis_client.register_script(
+    """
+    local claim = redis.call('HGET', KEYS[2], ARGV[1])
+    if not claim then
+        return 0
+    end
+    local ok, decoded = pcall(cjson.decode, claim)
+    if ok and type(decoded) == 'table' and type(decoded['keys']) == 'table' then
+        for _, key in ipairs(decoded['keys']) do
+            if redis.call('HGET', KEYS[1], key) == ARGV[1] then
+                redis.call('HDEL', KEYS[1], key)
+            end
+        end
+    end
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 1
+    """
+)
+
+
+async def task_dedup_release(task_id: UUID, redis_client: Optional[Any] = None) -> None:
+    # Called once a task is done for good, the next push of the same file gets a fresh task.
+    if redis_client is None:
+        redis_client = default_redis_client
+    await _dedup_release_script(
+        keys=[REDIS_DOCPROC_DEDUP_INDEX, REDIS_DOCPROC_DEDUP_CLAIMS],
+        args=[str(task_id)],
+        client=redis_client,
+    )
+
+
+async def task_push_to_queue(
+    task: Task,
+    redis_client: Optional[Any] = None,
+    push_to_front: bool = False,
+    idempotency_key: Optional[str] = None,
+) -> Task:
+    # Returns the task that ended up queued, which is the already queued one if this is a duplicate.
+    logger = default_logger
+    assert isinstance(task, Task)
+    queued_task = (
+        await task_push_many_to_queue(
+            [task],
+            redis_client=redis_client,
+            push_to_front=push_to_front,
+            idempotency_key=idempotency_key,
+        )
+    )[0]
+    if queued_task.id == task.id:
+        logger.info(f"Pushed task of type {task.task_type.value} to queue: {task.id}")
+    return queued_task
+
+
+def queue_tasks_on_pipeline(tasks: List[Task], pipe: Any, push_to_front: bool = False) -> None:
+    # Adds the record writes, the list pushes and the doorbells for tasks onto the callers pipeline.
+    ids_by_key: dict = {}
+    pushed_by_stage: dict = {}
+    # Client clock, only compared against the aging period so a little skew between workers doesnt matter.
+    enqueued_at = time.time()
+    for task in tasks:
+        assert isinstance(task, Task)
+        task.updated_at = datetime.now()
+        string_id = str(task.id)
+        level_key = task_queue_key(task)
+        fair_share_key = task_fair_share_key(task)
+        ids_by_key.setdefault((level_key, fair_share_key), []).append(string_id)
+        stage = task_stage(task)
+        pushed_by_stage[stage] = pushed_by_stage.get(stage, 0) + 1
+        # No TTL while the task is waiting, the record is the only copy of the payload.
+        pipe.set(string_id, task.model_dump_json())
+        pipe.hset(REDIS_DOCPROC_QUEUE_ENQUEUED_AT, string_id, enqueued_at)
+        add_task_event_to_pipeline(pipe, string_id, TaskEventType.queued, stage=stage)
+        add_task_index_to_pipeline(
+            pipe, string_id, TaskStatus.queued, task.task_type, enqueued_at
+        )
+    for (level_key, fair_share_key), ids in ids_by_key.items():
+        pushkey = fair_share_list_key(level_key, fair_share_key)
+        if push_to_front:
+            # LPUSH prepends one at a time, reverse so the batch keeps its order at the front.
+            pipe.lpush(pushkey, *reversed(ids))
+        else:
+            pipe.rpush(pushkey, *ids)
+        # NX keeps the place of a sub queue thats already in the rotation.
+        pipe.zadd(fair_share_active_key(level_key), {fair_share_key: 0}, nx=True)
+    for stage, pushed in pushed_by_stage.items():
+        ring_queue_doorbell(pushed, pipe, stage=stage)
+
+
+async def task_push_many_to_queue(
+    tasks: List[Task],
+    redis_client: Optional[Any] = None,
+    push_to_front: bool = False,
+    idempotency_key: Optional[str] = None,
+) -> List[Task]:
+    # Claims the dedup index for the batch, then writes the list pushes, the task records and the doorbell in a single transaction.
+    # Returns one task per input, duplicates are swapped for the task that already holds their url, hash or idempotency key.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    if len(tasks) == 0:
+        return []
+    claim_args: List[Any] = [
+        DOCPROC_DEDUP_CLAIM_GRACE_SECONDS,
+        f"{REDIS_DOCPROC_IDEMPOTENCY_PREFIX}:{idempotency_key}"
+        if idempotency_key is not None
+        else "",
+        DOCPROC_IDEMPOTENCY_RETENTION_SECONDS,
+    ]
+    claiming = []
+    for index, task in enumerate(tasks):
+        keys = task_dedup_keys(task)
+        # With an idempotency key every task goes through the script, the stored ids have to cover the whole batch.
+        if len(keys) > 0 or idempotency_key is not None:
+            claiming.append(index)
+            claim_args += [str(task.id), len(keys)] + keys
+    existing_ids = {}
+    if len(claiming) > 0:
+        claim_outcome, *claim_results = await _dedup_claim_script(
+            keys=[
+                REDIS_DOCPROC_DEDUP_INDEX,
+                REDIS_DOCPROC_DEDUP_CLAIMS,
+                REDIS_DOCPROC_QUEUE_ENQUEUED_AT,
+                REDIS_DOCPROC_PROCESSING_LEASES,
+                REDIS_DOCPROC_RETRY_SCHEDULE,
+            ],
+            args=claim_args,
+            client=redis_client,
+        )
+        if claim_outcome == "replay":
+            # Same key as an earlier request, hand back what that one got even if its tasks are done.
+            logger.info(
+                f"Idempotency key {idempotency_key} was already used, returning its {len(claim_results)} tasks"
+            )
+            return await tasks_by_existing_ids(
+                dict(enumerate(claim_results)),
+                [tasks[min(index, len(tasks) - 1)] for index in range(len(claim_results))],
+                redis_client,
+            )
+        for index, existing_id in zip(claiming, claim_results):
+            if existing_id != "":
+                existing_ids[index] = existing_id
+    new_tasks = [task for index, task in enumerate(tasks) if index not in existing_ids]
+    if len(new_tasks) > 0:
+        pipe = redis_client.pipeline(transaction=True)
+        queue_tasks_on_pipeline(new_tasks, pipe, push_to_front=push_to_front)
+        await pipe.execute()
+    if len(existing_ids) == 0:
+        if len(tasks) > 1:
+            logger.info(f"Pushed {len(tasks)} tasks to queue")
+        return tasks
+    logger.info(
+        f"Pushed {len(new_tasks)} tasks to queue, {len(existing_ids)} were already queued or running"
+    )
+    return await tasks_by_existing_ids(existing_ids, tasks, redis_client)
+
+
+async def tasks_by_existing_ids(
+    existing_ids: Dict[int, str], tasks: List[Task], redis_client: Any
+) -> List[Task]:
+    # Swaps every task whose index is in existing_ids for the stored task with that id.
+    logger = default_logger
+    duplicate_ids = list(set(existing_ids.values()))
+    existing_records = dict(zip(duplicate_ids, await redis_client.mget(duplicate_ids)))
+    queued_tasks = []
+    for index, task in enumerate(tasks):
+        existing_id = existing_ids.get(index)
+        if existing_id is None:
+            queued_tasks.append(task)
+            continue
+        existing_record = existing_records.get(existing_id)
+        existing_task = (
+            parse_task_string(existing_record, logger=logger)
+            if existing_record is not None
+            else None
+        )
+        if existing_task is None:
+            # Claimed by a push thats still writing its record, or a replayed task whose record already
+            # expired, point the caller at that task id anyway.
+            existing_task = task.model_copy()
+            existing_task.id = UUID(existing_id)
+            existing_task.url = f"https://thaum.kessler.xyz/v1/status/{existing_id}"
+        queued_tasks.append(existing_task)
+    return queued_tasks
+
+
+async def task_advance_stage(
+    task: Task, stage: TaskStage, redis_client: Optional[Any] = None
 ) -> None:
+    # Hands the task to the next stage, the lease ack and the push go out in one transaction so a crash
+    # in between cant drop it, and the next stage cant lease it before this one lets go.
     logger = default_logger
     if redis_client is None:
         redis_client = default_redis_client
-    assert isinstance(task, Task)
-    priority = task.priority
-    if priority:
-        pushkey = REDIS_DOCPROC_QUEUE_KEY
-    else:
-        pushkey = REDIS_DOCPROC_PRIORITYQUEUE_KEY
-    json_str = task.model_dump_json()
-    if push_to_front:
-        redis_client.lpush(pushkey, json_str)
-    else:
-        redis_client.rpush(pushkey, json_str)
-    task_upsert(task, redis_client)
-    logger.info(f"Pushed task of type {task.task_type.value} to queue: {task.id}")
+    string_id = str(task.id)
+    previous_stage = task_stage(task)
+    task.stage = stage
+    pipe = redis_client.pipeline(transaction=True)
+    if previous_stage != stage:
+        add_task_event_to_pipeline(
+            pipe, string_id, TaskEventType.stage_finished, stage=previous_stage
+        )
+    pipe.zrem(REDIS_DOCPROC_PROCESSING_LEASES, string_id)
+    pipe.hdel(REDIS_DOCPROC_PROCESSING_PAYLOADS, string_id)
+    pipe.hdel(REDIS_DOCPROC_PROCESSING_ORIGINS, string_id)
+    queue_tasks_on_pipeline([task], pipe)
+    await pipe.execute()
+    logger.info(f"Moved task {task.id} to the {stage.value} stage")
+
 
+# Parks a failed task in the retry schedule until ARGV[3] seconds from now, server clock. The record
+# is written and the lease dropped in the same script, so the reaper cant requeue it early.
+_retry_schedule_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    redis.call('SET', ARGV[1], ARGV[2])
+    redis.call('ZADD', KEYS[4], now + tonumber(ARGV[3]), ARGV[1])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    return 1
+    """
+)
+
+_retry_due_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    return redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now, 'LIMIT', 0, tonumber(ARGV[1]))
+    """
+)
 
-def task_upsert(task, redis_client: Optional[Any] = None) -> None:
+
+async def task_schedule_retry(
+    task: Task, delay_seconds: float, redis_client: Optional[Any] = None
+) -> None:
+    # The worker gives up its slot right after this, the task goes back on the queue of its current stage once the delay is up.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    task.updated_at = datetime.now()
+    task.retry_at = datetime.fromtimestamp(time.time() + delay_seconds)
+    await _retry_schedule_script(
+        keys=_lease_keys + [REDIS_DOCPROC_RETRY_SCHEDULE],
+        args=[str(task.id), task.model_dump_json(), delay_seconds],
+        client=redis_client,
+    )
+    pipe = redis_client.pipeline(transaction=False)
+    add_task_event_to_pipeline(
+        pipe,
+        task.id,
+        TaskEventType.retry_scheduled,
+        stage=task_stage(task),
+        detail=task.error,
+    )
+    add_task_index_to_pipeline(
+        pipe,
+        task.id,
+        TaskStatus.retrying,
+        task.task_type,
+        task.updated_at.timestamp(),
+    )
+    await pipe.execute()
+    logger.info(
+        f"Retrying task {task.id} in {delay_seconds:.0f} seconds, attempt {task.attempts}"
+    )
+
+
+async def requeue_due_retries(
+    max_requeued: int = 500, redis_client: Optional[Any] = None
+) -> int:
+    # Moves retries whose backoff is up back onto their queues. Every worker calls this, the lock keeps two from pushing the same task.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    if not await redis_client.set(REDIS_DOCPROC_RETRY_DRAIN_LOCK, "1", nx=True, ex=30):
+        return 0
+    try:
+        due_ids = await _retry_due_script(
+            keys=[REDIS_DOCPROC_RETRY_SCHEDULE], args=[max_requeued], client=redis_client
+        )
+        if len(due_ids) == 0:
+            return 0
+        tasks = []
+        for due_id, record in zip(due_ids, await redis_client.mget(due_ids)):
+            task = parse_task_string(record, logger=logger) if record is not None else None
+            if task is None:
+                logger.error(f"Retry of task {due_id} has no record left, dropping it")
+                continue
+            task.retry_at = None
+            tasks.append(task)
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.zrem(REDIS_DOCPROC_RETRY_SCHEDULE, *due_ids)
+        # Straight onto the queues, these tasks still hold their dedup claims.
+        if len(tasks) > 0:
+            queue_tasks_on_pipeline(tasks, pipe)
+        await pipe.execute()
+    finally:
+        await redis_client.delete(REDIS_DOCPROC_RETRY_DRAIN_LOCK)
+    return len(tasks)
+
+
+async def scheduled_retry_count(redis_client: Optional[Any] = None) -> int:
+    if redis_client is None:
+        redis_client = default_redis_client
+    return int(await redis_client.zcard(REDIS_DOCPROC_RETRY_SCHEDULE))
+
+
+async def stage_queue_depths(
+    stage: TaskStage, redis_client: Optional[Any] = None
+) -> Tuple[List[int], Dict[str, int]]:
+    # Queued tasks per priority level, highest first, and per fair share key summed over the levels.
+    if redis_client is None:
+        redis_client = default_redis_client
+    level_keys = stage_queue_keys(stage)
+    pipe = redis_client.pipeline(transaction=False)
+    for level_key in level_keys:
+        pipe.zrange(fair_share_active_key(level_key), 0, -1)
+    members_by_level = await pipe.execute()
+    pipe = redis_client.pipeline(transaction=False)
+    sub_queues = []
+    for level, level_key in enumerate(level_keys):
+        # The level list can hold legacy entries without being in the rotation yet.
+        members = set(members_by_level[level]) | {""}
+        for fair_share_key in members:
+            sub_queues.append((level, fair_share_key))
+            pipe.llen(fair_share_list_key(level_key, fair_share_key))
+    level_lengths = [0] * len(level_keys)
+    key_lengths: Dict[str, int] = {}
+    for (level, fair_share_key), length in zip(sub_queues, await pipe.execute()):
+        length = int(length)
+        if length == 0:
+            continue
+        level_lengths[level] += length
+        key_lengths[fair_share_key] = key_lengths.get(fair_share_key, 0) + length
+    return level_lengths, key_lengths
+
+
+async def task_upsert(task, redis_client: Optional[Any] = None) -> None:
     task.updated_at = datetime.now()
     if redis_client is None:
         redis_client = default_redis_client
     assert isinstance(task, Task)
     json_str = task.model_dump_json()
     string_id = str(task.id)
-    redis_client.set(
+    # Records of unfinished tasks back the queue entries, only finished ones are left to expire.
+    # Their index entry is kept by whatever queued or popped them.
+    if not task.completed:
+        # KEEPTTL so a task popped without a lease keeps the TTL thats standing in for its lease.
+        await redis_client.set(string_id, json_str, keepttl=True)
+        return None
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(string_id, json_str, ex=TASK_RECORD_TTL_SECONDS)
+    add_task_index_to_pipeline(
+        pipe,
+        string_id,
+        task_status(task),
+        task.task_type,
+        task.updated_at.timestamp(),
+    )
+    add_task_event_to_pipeline(
+        pipe,
         string_id,
-        json_str,
+        TaskEventType.completed if task.success else TaskEventType.failed,
+        stage=task_stage(task),
+        detail=task.error,
     )
-    redis_client.expire(string_id, 60 * 60)
+    # The record above expires after an hour, the dead letter is what keeps a failed task around.
+    if not task.success:
+        add_dead_letter_to_pipeline(pipe, task)
+    await pipe.execute()
 
 
-def task_get(task_id: UUID, redis_client: Optional[Any] = None) -> Optional[Task]:
+async def task_get(task_id: UUID, redis_client: Optional[Any] = None) -> Optional[Task]:
     if redis_client is None:
         redis_client = default_redis_client
     uuid_str = str(task_id)
-    task_str = redis_client.get(uuid_str)
-    redis_client.expire(uuid_str, 60 * 60)
+    task_str = await redis_client.get(uuid_str)
     if task_str is None:
         return None
     try:
@@ -98,27 +1413,539 @@ def task_get(task_id: UUID, redis_client: Optional[Any] = None) -> Optional[Task
     except Exception as e:
         default_logger.error(e)
         return None
+    # Queued tasks must keep their record, only a finished one gets its expiry pushed back on read.
+    if task.completed:
+        await redis_client.expire(uuid_str, TASK_RECORD_TTL_SECONDS)
     return task
 
 
-def increment_doc_counter(
-    increment: int,
+def task_trace_key(task_id: Union[UUID, str]) -> str:
+    return f"{REDIS_DOCPROC_TASK_TRACE_PREFIX}:{task_id}"
+
+
+def timing_samples_key(stage: Optional[TaskStage], name: str) -> str:
+    stage_name = stage.value if stage is not None else ""
+    return f"{REDIS_DOCPROC_TIMING_SAMPLES_PREFIX}:{stage_name}:{name}"
+
+
+async def task_trace_save(trace: TaskTrace, redis_client: Optional[Any] = None) -> None:
+    if redis_client is None:
+        redis_client = default_redis_client
+    if len(trace.spans) == 0:
+        return None
+    trace_key = task_trace_key(trace.task_id)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.rpush(trace_key, *[span.model_dump_json() for span in trace.spans])
+    pipe.ltrim(trace_key, -DOCPROC_TASK_TRACE_MAX_SPANS, -1)
+    pipe.expire(trace_key, DOCPROC_TASK_TRACE_TTL_SECONDS)
+    for span in trace.spans:
+        samples_key = timing_samples_key(span.stage, span.name)
+        pipe.lpush(samples_key, span.duration_seconds)
+        pipe.ltrim(samples_key, 0, DOCPROC_TIMING_SAMPLES_PER_SPAN - 1)
+        pipe.sadd(REDIS_DOCPROC_TIMING_SAMPLE_KEYS, samples_key)
+    await pipe.execute()
+
+
+async def task_trace_get(
+    task_id: UUID, redis_client: Optional[Any] = None
+) -> List[TraceSpan]:
+    if redis_client is None:
+        redis_client = default_redis_client
+    span_strs = await redis_client.lrange(task_trace_key(task_id), 0, -1)
+    return [TraceSpan.model_validate_json(span_str) for span_str in span_strs]
+
+
+async def timing_percentiles_by_span(
     redis_client: Optional[Any] = None,
+) -> Dict[str, TimingPercentiles]:
+    # Keyed by "stage:span" over the most recent samples of each.
+    if redis_client is None:
+        redis_client = default_redis_client
+    samples_keys = sorted(await redis_client.smembers(REDIS_DOCPROC_TIMING_SAMPLE_KEYS))
+    if len(samples_keys) == 0:
+        return {}
+    pipe = redis_client.pipeline(transaction=False)
+    for samples_key in samples_keys:
+        pipe.lrange(samples_key, 0, -1)
+    results = {}
+    prefix = REDIS_DOCPROC_TIMING_SAMPLES_PREFIX + ":"
+    for samples_key, samples in zip(samples_keys, await pipe.execute()):
+        percentiles = timing_percentiles([float(sample) for sample in samples])
+        if percentiles is not None:
+            results[samples_key.removeprefix(prefix)] = percentiles
+    return results
+
+
+def checkpoint_key(hash: str, lang: str) -> str:
+    return f"{REDIS_DOCPROC_CHECKPOINT_PREFIX}:{hash}:{lang}"
+
+
+async def checkpoint_get(
+    hash: str, lang: str, redis_client: Optional[Any] = None
+) -> Optional[DocProcCheckpoint]:
+    if redis_client is None:
+        redis_client = default_redis_client
+    checkpoint_str = await redis_client.get(checkpoint_key(hash, lang))
+    if checkpoint_str is None:
+        return None
+    try:
+        return DocProcCheckpoint.model_validate_json(checkpoint_str)
+    except Exception as e:
+        default_logger.error(e)
+        return None
+
+
+async def checkpoint_set(
+    checkpoint: DocProcCheckpoint, redis_client: Optional[Any] = None
 ) -> None:
     if redis_client is None:
         redis_client = default_redis_client
-    counter = redis_client.get(REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS)
-    default_logger.info(counter)
-    redis_client.set(REDIS_DOCPROC_CURRENTLY_PROCESSING_DOCS, int(counter) + increment)
+    await redis_client.set(
+        checkpoint_key(checkpoint.hash, checkpoint.lang),
+        checkpoint.model_dump_json(),
+        ex=DOCPROC_CHECKPOINT_TTL_SECONDS,
+    )
+
+
+async def hash_registry_get(
+    hash: str, redis_client: Optional[Any] = None
+) -> Optional[HashRegistryEntry]:
+    if redis_client is None:
+        redis_client = default_redis_client
+    entry_str = await redis_client.hget(REDIS_DOCPROC_HASH_REGISTRY, hash)
+    if entry_str is None:
+        return None
+    try:
+        return HashRegistryEntry.model_validate_json(entry_str)
+    except Exception as e:
+        default_logger.error(e)
+        return None
+
+
+async def hash_registry_record(
+    obj: CompleteFileSchema, redis_client: Optional[Any] = None
+) -> Optional[HashRegistryEntry]:
+    # Only called once a file is processed and in the db, so anything in the registry is safe to skip.
+    if redis_client is None:
+        redis_client = default_redis_client
+    if obj.hash == "" or obj.id == UUID("00000000-0000-0000-0000-000000000000"):
+        return None
+    entry = HashRegistryEntry(
+        hash=obj.hash,
+        file_id=obj.id,
+        extension=obj.extension,
+        processed_at=datetime.now(),
+    )
+    await redis_client.hset(REDIS_DOCPROC_HASH_REGISTRY, obj.hash, entry.model_dump_json())
+    return entry
+
+
+def dead_letter_task_json(task: Task) -> str:
+    # The dead letter tasks never expire, so leave the document text out. A replay starts the task
+    # over and gets its text back from the stage checkpoints in s3.
+    return task.model_dump_json(exclude={"obj": {"doc_texts"}})
+
+
+def add_dead_letter_to_pipeline(pipe: Any, task: Task) -> None:
+    failed_at = datetime.now()
+    entry = DeadLetter(
+        task_id=task.id,
+        task_type=task.task_type,
+        stage=task.failed_stage if task.failed_stage is not None else task_stage(task),
+        failure_class=task.failure_class,
+        error=task.error,
+        error_group=dead_letter_error_group(task.error),
+        traceback=task.error_traceback,
+        attempts=task.attempts,
+        failed_at=failed_at,
+    )
+    string_id = str(task.id)
+    pipe.hset(REDIS_DOCPROC_DEAD_LETTERS, string_id, entry.model_dump_json())
+    pipe.hset(REDIS_DOCPROC_DEAD_LETTER_TASKS, string_id, dead_letter_task_json(task))
+    pipe.zadd(REDIS_DOCPROC_DEAD_LETTER_INDEX, {string_id: failed_at.timestamp()})
+
+
+async def dead_letter_count(redis_client: Optional[Any] = None) -> int:
+    if redis_client is None:
+        redis_client = default_redis_client
+    return await redis_client.zcard(REDIS_DOCPROC_DEAD_LETTER_INDEX)
 
 
-def clear_file_queue(
+async def dead_letter_scan(
+    filter: DeadLetterFilter,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    redis_client: Optional[Any] = None,
+) -> Tuple[List[DeadLetter], Optional[int]]:
+    # Newest first. Returns the matches and the offset to carry on from, None once the end of the index was reached.
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    entries = []
+    position = offset
+    while True:
+        ids = await redis_client.zrevrange(
+            REDIS_DOCPROC_DEAD_LETTER_INDEX,
+            position,
+            position + DOCPROC_DEAD_LETTER_SCAN_BATCH - 1,
+        )
+        if len(ids) == 0:
+            return entries, None
+        for entry_str in await redis_client.hmget(REDIS_DOCPROC_DEAD_LETTERS, ids):
+            position += 1
+            if entry_str is None:
+                continue
+            try:
+                entry = DeadLetter.model_validate_json(entry_str)
+            except Exception as e:
+                logger.error(f"Unable to parse dead letter: {e}")
+                continue
+            if not dead_letter_matches(entry, filter):
+                continue
+            entries.append(entry)
+            if limit is not None and len(entries) >= limit:
+                return entries, position
+        if len(ids) < DOCPROC_DEAD_LETTER_SCAN_BATCH:
+            return entries, None
+
+
+# Removes the dead letters in one go and hands back their summaries and tasks, so two replays cant both requeue the same one.
+_dead_letter_take_script = default_redis_client.register_script(
+    """
+    local taken = {}
+    for _, id in ipairs(ARGV) do
+        local entry = redis.call('HGET', KEYS[1], id)
+        local task = redis.call('HGET', KEYS[2], id)
+        if entry and task then
+            table.insert(taken, entry)
+            table.insert(taken, task)
+        end
+        redis.call('HDEL', KEYS[1], id)
+        redis.call('HDEL', KEYS[2], id)
+        redis.call('ZREM', KEYS[3], id)
+    end
+    return taken
+    """
+)
+
+_dead_letter_keys = [
+    REDIS_DOCPROC_DEAD_LETTERS,
+    REDIS_DOCPROC_DEAD_LETTER_TASKS,
+    REDIS_DOCPROC_DEAD_LETTER_INDEX,
+]
+
+
+async def dead_letter_take(
+    task_ids: List[Union[UUID, str]], redis_client: Optional[Any] = None
+) -> List[Tuple[DeadLetter, Task]]:
+    logger = default_logger
+    if redis_client is None:
+        redis_client = default_redis_client
+    if len(task_ids) == 0:
+        return []
+    taken = await _dead_letter_take_script(
+        keys=_dead_letter_keys,
+        args=[str(task_id) for task_id in task_ids],
+        client=redis_client,
+    )
+    results = []
+    for entry_str, task_str in zip(taken[0::2], taken[1::2]):
+        task = parse_task_string(task_str, logger=logger)
+        if task is None:
+            continue
+        results.append((DeadLetter.model_validate_json(entry_str), task))
+    return results
+
+
+async def dead_letter_restore(
+    dead_letters: List[Tuple[DeadLetter, Task]], redis_client: Optional[Any] = None
+) -> None:
+    # Puts taken dead letters back as they were, for when requeueing them fails.
+    if redis_client is None:
+        redis_client = default_redis_client
+    if len(dead_letters) == 0:
+        return None
+    pipe = redis_client.pipeline(transaction=True)
+    for entry, task in dead_letters:
+        string_id = str(entry.task_id)
+        pipe.hset(REDIS_DOCPROC_DEAD_LETTERS, string_id, entry.model_dump_json())
+        pipe.hset(REDIS_DOCPROC_DEAD_LETTER_TASKS, string_id, dead_letter_task_json(task))
+        pipe.zadd(
+            REDIS_DOCPROC_DEAD_LETTER_INDEX, {string_id: entry.failed_at.timestamp()}
+        )
+    await pipe.execute()
+
+
+# Cluster wide concurrency semaphores, one per stage. Every holder has a lease in a sorted set scored by its
+# expiry time, all the scripts use the valkey server clock so replicas with skewed clocks agree.
+# Expired leases are pruned before counting, which is how slots held by dead workers come back.
+_semaphore_acquire_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    local expires = now + tonumber(ARGV[3])
+    if redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+        redis.call('ZADD', KEYS[1], expires, ARGV[1])
+        return 1
+    end
+    if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+        redis.call('ZADD', KEYS[1], expires, ARGV[1])
+        return 1
+    end
+    return 0
+    """
+)
+
+_semaphore_acquire_many_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    local expires = now + tonumber(ARGV[2])
+    local free = tonumber(ARGV[1]) - redis.call('ZCARD', KEYS[1])
+    local granted = {}
+    for i = 3, #ARGV do
+        if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+            redis.call('ZADD', KEYS[1], expires, ARGV[i])
+            table.insert(granted, ARGV[i])
+        elseif free > 0 then
+            redis.call('ZADD', KEYS[1], expires, ARGV[i])
+            table.insert(granted, ARGV[i])
+            free = free - 1
+        end
+    end
+    return granted
+    """
+)
+
+_semaphore_count_script = default_redis_client.register_script(
+    """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    return redis.call('ZCARD', KEYS[1])
+    """
+)
+
+
+async def semaphore_acquire(
+    holder: str,
+    limit: int,
+    lease_seconds: int = DOCPROC_SEMAPHORE_LEASE_SECONDS,
+    stage: TaskStage = TaskStage.fetch,
+    redis_client: Optional[Any] = None,
+) -> bool:
+    if redis_client is None:
+        redis_client = default_redis_client
+    acquired = await _semaphore_acquire_script(
+        keys=[stage_semaphore_key(stage)],
+        args=[holder, limit, lease_seconds],
+        client=redis_client,
+    )
+    return int(acquired) == 1
+
+
+async def semaphore_acquire_many(
+    holders: List[str],
+    limit: int,
+    lease_seconds: int = DOCPROC_SEMAPHORE_LEASE_SECONDS,
+    stage: TaskStage = TaskStage.fetch,
+    redis_client: Optional[Any] = None,
+) -> List[str]:
+    # Returns the holders that got a slot, in order, the rest should be handed back to the queue.
+    if redis_client is None:
+        redis_client = default_redis_client
+    if len(holders) == 0:
+        return []
+    granted = await _semaphore_acquire_many_script(
+        keys=[stage_semaphore_key(stage)],
+        args=[limit, lease_seconds] + holders,
+        client=redis_client,
+    )
+    return [str(holder) for holder in granted]
+
+
+async def semaphore_renew(
+    holder: str,
+    lease_seconds: int = DOCPROC_SEMAPHORE_LEASE_SECONDS,
+    stage: TaskStage = TaskStage.fetch,
+    redis_client: Optional[Any] = None,
+) -> bool:
+    # Returns False if the lease already expired and was reaped, the slot has been given away at that point.
+    if redis_client is None:
+        redis_client = default_redis_client
+    renewed = await _lease_renew_script(
+        keys=[stage_semaphore_key(stage)],
+        args=[holder, lease_seconds],
+        client=redis_client,
+    )
+    return int(renewed) == 1
+
+
+async def semaphore_release(
+    holder: str,
+    stage: TaskStage = TaskStage.fetch,
+    redis_client: Optional[Any] = None,
+) -> None:
+    if redis_client is None:
+        redis_client = default_redis_client
+    await redis_client.zrem(stage_semaphore_key(stage), holder)
+
+
+async def semaphore_in_flight_count(
+    stage: TaskStage = TaskStage.fetch, redis_client: Optional[Any] = None
+) -> int:
+    if redis_client is None:
+        redis_client = default_redis_client
+    return int(
+        await _semaphore_count_script(
+            keys=[stage_semaphore_key(stage)], client=redis_client
+        )
+    )
+
+
+async def publish_daemon_state(state: DaemonState, redis_client: Optional[Any] = None) -> None:
+    # Saves the config and tells every worker about it, the message carries the whole config so subscribers dont need a GET.
+    if redis_client is None:
+        redis_client = default_redis_client
+    state_str = DaemonState.model_dump_json(state)
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.set(REDIS_MAIN_PROCESS_LOOP_CONFIG, state_str)
+    pipe.publish(REDIS_MAIN_PROCESS_LOOP_CONFIG_CHANNEL, state_str)
+    await pipe.execute()
+
+
+class DaemonStateCache:
+    # In process copy of the daemon config. It is replaced whenever set-daemon-state publishes a
+    # new one, and re-read from redis every refresh_seconds in case a message was missed, so the
+    # hot loop never has to touch redis for config.
+    def __init__(
+        self,
+        redis_client: Optional[Any] = None,
+        refresh_seconds: float = DAEMON_STATE_REFRESH_SECONDS,
+        logger: Optional[Any] = None,
+    ) -> None:
+        if redis_client is None:
+            redis_client = default_redis_client
+        if logger is None:
+            logger = default_logger
+        self.redis_client = redis_client
+        self.refresh_seconds = refresh_seconds
+        self.logger = logger
+        self.state: Optional[DaemonState] = None
+        self.refreshed_at = 0.0
+
+    def set(self, state: DaemonState) -> DaemonState:
+        self.state = state
+        self.refreshed_at = time.monotonic()
+        return state
+
+    async def refresh(self) -> DaemonState:
+        state_str = await self.redis_client.get(REDIS_MAIN_PROCESS_LOOP_CONFIG)
+        return self.set(DaemonState.model_validate_json(state_str))
+
+    async def get(self) -> DaemonState:
+        if (
+            self.state is None
+            or time.monotonic() - self.refreshed_at > self.refresh_seconds
+        ):
+            return await self.refresh()
+        return self.state
+
+    async def listen(self) -> None:
+        # Runs for the lifetime of the worker, resubscribing after connection errors.
+        while True:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(REDIS_MAIN_PROCESS_LOOP_CONFIG_CHANNEL)
+                # Anything published while we were not subscribed is picked up by this read.
+                await self.refresh()
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    self.set(DaemonState.model_validate_json(message["data"]))
+                    self.logger.info(f"Daemon state updated: {self.state}")
+            except Exception as e:
+                self.logger.error(f"Lost daemon state subscription, retrying: {e}")
+                await asyncio.sleep(2)
+            finally:
+                await pubsub.aclose()
+
+
+def run_redis_sync(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    # Sync shim for scripts that run outside the event loop, eg run_redis_sync(task_get, task_id).
+    # The call gets its own short lived client since the shared pool belongs to the server's event loop.
+    async def run() -> Any:
+        client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+        try:
+            return await func(*args, redis_client=client, **kwargs)
+        finally:
+            await client.aclose()
+
+    return asyncio.run(run())
+
+
+# Empties one stage, KEYS[1] is the enqueued at hash, KEYS[2] the stages scheduler hash and KEYS[3..]
+# its level lists. Every sub queue in a levels rotation goes with the level list, then the rotations
+# and the scheduler credit. Returns the entries that were removed.
+_clear_stage_queues_script = default_redis_client.register_script(
+    """
+    local removed = {}
+    for i = 3, #KEYS do
+        local active_key = KEYS[i] .. ':active'
+        local lists = {KEYS[i]}
+        for _, member in ipairs(redis.call('ZRANGE', active_key, 0, -1)) do
+            if member ~= '' then
+                table.insert(lists, KEYS[i] .. '#' .. member)
+            end
+        end
+        for _, list_key in ipairs(lists) do
+            for _, entry in ipairs(redis.call('LRANGE', list_key, 0, -1)) do
+                redis.call('HDEL', KEYS[1], entry)
+                table.insert(removed, entry)
+            end
+            redis.call('DEL', list_key)
+        end
+        redis.call('DEL', active_key)
+    end
+    redis.call('DEL', KEYS[2])
+    return removed
+    """
+)
+
+
+async def clear_file_queue(
     redis_client: Optional[Any] = None,
 ) -> None:
     if redis_client is None:
         redis_client = default_redis_client
-    redis_client.ltrim(REDIS_DOCPROC_PRIORITYQUEUE_KEY, 0, 0)
-    redis_client.ltrim(REDIS_DOCPROC_QUEUE_KEY, 0, 0)
+    removed_ids = []
+    for stage in TaskStage:
+        removed = await _clear_stage_queues_script(
+            keys=[REDIS_DOCPROC_QUEUE_ENQUEUED_AT, stage_scheduler_key(stage)]
+            + stage_queue_keys(stage),
+            client=redis_client,
+        )
+        for entry in removed:
+            # Legacy entries are the whole task, only their id matters here.
+            if entry.startswith("{"):
+                task = parse_task_string(entry)
+                if task is None:
+                    continue
+                entry = str(task.id)
+            removed_ids.append(entry)
+    # The cleared tasks never run, let go of their files so the next push of one queues a fresh task.
+    if len(removed_ids) == 0:
+        return None
+    pipe = redis_client.pipeline(transaction=False)
+    for task_id in removed_ids:
+        await _dedup_release_script(
+            keys=[REDIS_DOCPROC_DEDUP_INDEX, REDIS_DOCPROC_DEDUP_CLAIMS],
+            args=[task_id],
+            client=pipe,
+        )
+    await pipe.execute()
 
 
 # def convert_model_to_results_and_push(
@@ -178,3 +2005,44 @@ def clear_file_queue(
 #
 #     convert_model_to_results_and_push(schemas=files_to_convert)
 #     return len(files_to_convert) == max_documents
+
+
+def s3_known_hash_exists(hash: str, redis_client: Optional[Any] = None) -> bool:
+    # Sync, only a positive answer can be trusted, anything not in the set still needs a HEAD.
+    if redis_client is None:
+        redis_client = default_sync_redis_client
+    return bool(redis_client.sismember(REDIS_S3_KNOWN_HASHES, hash))
+
+
+def s3_known_hashes_add(hashes: List[str], redis_client: Optional[Any] = None) -> None:
+    if redis_client is None:
+        redis_client = default_sync_redis_client
+    if len(hashes) == 0:
+        return
+    redis_client.sadd(REDIS_S3_KNOWN_HASHES, *hashes)
+
+
+async def s3_known_hashes_claim_warm(redis_client: Optional[Any] = None) -> bool:
+    # Only one worker relists the bucket per rewarm period, the claim expiring is what schedules the next one.
+    if redis_client is None:
+        redis_client = default_redis_client
+    return bool(
+        await redis_client.set(
+            REDIS_S3_KNOWN_HASHES_WARM_CLAIM,
+            "1",
+            nx=True,
+            ex=S3_KNOWN_HASHES_REWARM_SECONDS,
+        )
+    )
+
+
+async def s3_known_hashes_release_warm(redis_client: Optional[Any] = None) -> None:
+    if redis_client is None:
+        redis_client = default_redis_client
+    await redis_client.delete(REDIS_S3_KNOWN_HASHES_WARM_CLAIM)
+
+
+async def s3_known_hashes_count(redis_client: Optional[Any] = None) -> int:
+    if redis_client is None:
+        redis_client = default_redis_client
+    return await redis_client.scard(REDIS_S3_KNOWN_HASHES)